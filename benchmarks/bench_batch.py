@@ -0,0 +1,53 @@
+# coding: utf-8
+""" Benchmarks of the threaded batch solvers.
+"""
+import numpy as np
+from pybold.batch import deconv_batch, bd_batch
+from .common import gen_signals
+
+
+# the numbers of threads
+N_JOBS = [1, 2, 4]
+
+
+class DeconvBatch:
+    """ Time the threaded deconvolution of a batch of signals with a fixed
+    budget of iterations.
+    """
+    params = [[500, 1000], N_JOBS]
+    param_names = ['n_scans', 'n_jobs']
+    timeout = 300
+    n_voxels = 200
+
+    def setup(self, n_scans, n_jobs):
+        y, _, self.hrf = gen_signals(n_scans, 1.0, self.n_voxels)
+        self.y = np.ascontiguousarray(y.T)
+        deconv_batch(self.y[:, :2 * n_jobs], 1.0, self.hrf, n_jobs=n_jobs,
+                     lbda=1.0, nb_iter=2)  # compile the kernels
+
+    def time_deconv_batch(self, n_scans, n_jobs):
+        deconv_batch(self.y, 1.0, self.hrf, n_jobs=n_jobs, lbda=1.0,
+                     nb_iter=50, early_stopping=False)
+
+
+class BlindDeconvBatch:
+    """ Time the threaded blind deconvolution of a batch of signals with a
+    fixed budget of iterations (nb_sub_iter iterations per deconvolution
+    step).
+    """
+    params = [[300, 1000], N_JOBS]
+    param_names = ['n_scans', 'n_jobs']
+    timeout = 600
+    n_voxels = 8
+    nb_sub_iter = 50
+
+    def setup(self, n_scans, n_jobs):
+        y, _, _ = gen_signals(n_scans, 1.0, self.n_voxels)
+        self.y = np.ascontiguousarray(y.T)
+        bd_batch(self.y[:10, :n_jobs], 1.0, n_jobs=n_jobs,
+                 nb_iter=1)  # compile the kernels
+
+    def time_bd_batch(self, n_scans, n_jobs):
+        bd_batch(self.y, 1.0, n_jobs=n_jobs, lbda=1.0, nb_iter=5,
+                 nb_sub_iter=self.nb_sub_iter,
+                 nb_last_iter=self.nb_sub_iter)
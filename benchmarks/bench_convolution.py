@@ -0,0 +1,30 @@
+# coding: utf-8
+""" Benchmarks of the convolution backends.
+"""
+from pybold.convolution import (spectral_convolve, simple_convolve,
+                                toeplitz_from_kernel)
+from .common import gen_signals, N_SCANS, T_R, N_VOXELS
+
+
+class Convolution:
+    """ Time the convolution of a batch of signals with the HRF.
+    """
+    params = [N_SCANS, T_R, N_VOXELS]
+    param_names = ['n_scans', 't_r', 'n_voxels']
+
+    def setup(self, n_scans, t_r, n_voxels):
+        _, self.ai_s, self.hrf = gen_signals(n_scans, t_r, n_voxels)
+        simple_convolve(self.hrf, self.ai_s[:, :10])  # compile the kernel
+
+    def time_spectral_convolve(self, n_scans, t_r, n_voxels):
+        spectral_convolve(self.hrf, self.ai_s)
+
+    def time_simple_convolve(self, n_scans, t_r, n_voxels):
+        simple_convolve(self.hrf, self.ai_s)
+
+    def time_toeplitz_convolve(self, n_scans, t_r, n_voxels):
+        H = toeplitz_from_kernel(self.hrf, n_scans)
+        self.ai_s.dot(H.T)
+
+    def time_toeplitz_from_kernel(self, n_scans, t_r, n_voxels):
+        toeplitz_from_kernel(self.hrf, n_scans)
@@ -0,0 +1,32 @@
+# coding: utf-8
+""" Benchmarks of the HRF generation.
+"""
+import numpy as np
+from pybold.hrf_model import spm_hrf, spm_hrf_bank
+
+
+class SPMHRF:
+    """ Time the generation of one SPM HRF.
+    """
+    params = [[0.5, 1.0, 2.0], [20.0, 60.0]]
+    param_names = ['t_r', 'dur']
+
+    def setup(self, t_r, dur):
+        spm_hrf(1.0, t_r=t_r, dur=dur)  # lazy imports
+
+    def time_spm_hrf(self, t_r, dur):
+        spm_hrf(1.0, t_r=t_r, dur=dur)
+
+
+class SPMHRFBank:
+    """ Time the generation of a bank of SPM HRFs.
+    """
+    params = [[0.5, 2.0], [1, 100, 10000]]
+    param_names = ['t_r', 'n_hrfs']
+
+    def setup(self, t_r, n_hrfs):
+        self.deltas = np.linspace(0.5, 2.0, n_hrfs)
+        spm_hrf_bank(self.deltas[:1], t_r=t_r, dur=20.0)  # lazy imports
+
+    def time_spm_hrf_bank(self, t_r, n_hrfs):
+        spm_hrf_bank(self.deltas, t_r=t_r, dur=20.0)
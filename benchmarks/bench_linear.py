@@ -0,0 +1,30 @@
+# coding: utf-8
+""" Benchmarks of the Lipschitz constant estimation of the deconvolution
+operator.
+"""
+from pybold.linear import ConvAndLinear, DiscretInteg, lipschitz_est
+from pybold.utils import spectral_radius_est
+from .common import gen_signals, N_SCANS, T_R
+
+
+class LipschitzEst:
+    """ Time the estimation of the Lipschitz constant of the gradient of the
+    deconvolution data-fidelity term.
+    """
+    params = [N_SCANS, T_R]
+    param_names = ['n_scans', 't_r']
+    timeout = 300
+
+    def setup(self, n_scans, t_r):
+        _, _, hrf = gen_signals(n_scans, t_r, 1)
+        self.H = ConvAndLinear(DiscretInteg(), hrf, dim_in=n_scans,
+                               dim_out=n_scans)
+
+    def time_spectral_radius_est(self, n_scans, t_r):
+        spectral_radius_est(self.H, (self.H.dim_in,))
+
+    def time_lipschitz_est_power(self, n_scans, t_r):
+        lipschitz_est(self.H, method='power', cache=False)
+
+    def time_lipschitz_est_bound(self, n_scans, t_r):
+        lipschitz_est(self.H, method='bound', cache=False)
@@ -0,0 +1,18 @@
+# coding: utf-8
+""" Benchmarks of the padding.
+"""
+from pybold.padding import custom_padd
+from .common import gen_signals, N_SCANS, N_VOXELS
+
+
+class CustomPadd:
+    """ Time the zeros-mirror-zeros padding of a batch of signals.
+    """
+    params = [N_SCANS, N_VOXELS]
+    param_names = ['n_scans', 'n_voxels']
+
+    def setup(self, n_scans, n_voxels):
+        self.y, _, _ = gen_signals(n_scans, 1.0, n_voxels)
+
+    def time_custom_padd(self, n_scans, n_voxels):
+        custom_padd(self.y)
@@ -0,0 +1,74 @@
+# coding: utf-8
+""" Benchmarks of the deconvolution solvers.
+"""
+import numpy as np
+from pybold.bold_signal import deconv, bd
+from .common import gen_signals, N_SCANS, T_R, N_VOXELS
+
+
+class Deconv:
+    """ Time the deconvolution of a batch of signals with a fixed budget of
+    iterations.
+    """
+    params = [N_SCANS, T_R, N_VOXELS, [np.float64, np.float32]]
+    param_names = ['n_scans', 't_r', 'n_voxels', 'dtype']
+    timeout = 300
+
+    def setup(self, n_scans, t_r, n_voxels, dtype):
+        y, _, self.hrf = gen_signals(n_scans, t_r, n_voxels)
+        self.y = np.ascontiguousarray(y.T)
+        deconv(self.y[:, :10], t_r, self.hrf, lbda=1.0, nb_iter=2,
+               dtype=dtype)  # compile the kernels
+
+    def time_deconv(self, n_scans, t_r, n_voxels, dtype):
+        deconv(self.y, t_r, self.hrf, lbda=1.0, nb_iter=50,
+               early_stopping=False, dtype=dtype)
+
+
+class BlindDeconv:
+    """ Time the blind deconvolution of a signal with a fixed budget of
+    iterations (nb_sub_iter iterations per deconvolution step).
+    """
+    params = [N_SCANS, T_R]
+    param_names = ['n_scans', 't_r']
+    timeout = 600
+    nb_sub_iter = 50
+
+    def setup(self, n_scans, t_r):
+        y, _, _ = gen_signals(n_scans, t_r, 1)
+        self.y = y[0]
+        bd(self.y[:10], t_r, nb_iter=1)  # compile the kernels
+
+    def time_bd(self, n_scans, t_r):
+        bd(self.y, t_r, lbda=1.0, nb_iter=5, nb_sub_iter=self.nb_sub_iter,
+           nb_last_iter=self.nb_sub_iter)
+
+
+class BlindDeconvSchedule:
+    """ Time the blind deconvolution of a signal with the deconvolution
+    steps of the former fixed budget (nb_iter iterations per step), with
+    exact steps (nb_sub_iter and nb_last_iter budgets) and with inexact
+    steps (tolerance tightened as theta converges), and track the reached
+    cost-function.
+    """
+    params = [[300, 1000], ['fixed', 'exact', 'inexact']]
+    param_names = ['n_scans', 'schedule']
+    timeout = 600
+    nb_iter = 20
+
+    def setup(self, n_scans, schedule):
+        y, _, _ = gen_signals(n_scans, 1.0, 1)
+        self.y = y[0]
+        self.kwargs = {'fixed': dict(nb_sub_iter=self.nb_iter,
+                                     nb_last_iter=self.nb_iter),
+                       'exact': dict(),
+                       'inexact': dict(sub_tol=1.0e-2)}[schedule]
+        bd(self.y[:10], 1.0, nb_iter=1)  # compile the kernels
+
+    def time_bd(self, n_scans, schedule):
+        bd(self.y, 1.0, lbda=1.0, nb_iter=self.nb_iter, **self.kwargs)
+
+    def track_cost(self, n_scans, schedule):
+        _, _, _, _, d = bd(self.y, 1.0, lbda=1.0, nb_iter=self.nb_iter,
+                           **self.kwargs)
+        return d['J'][-1]
@@ -0,0 +1,32 @@
+# coding: utf-8
+""" Deterministic inputs of the benchmarks.
+"""
+from pybold.data import gen_rnd_ai_s_batch, add_gaussian_noise
+from pybold.convolution import simple_convolve
+from pybold.hrf_model import spm_hrf
+
+
+# the lengths of the signals (number of scans)
+N_SCANS = [100, 500, 1000, 5000]
+# the TR (in second)
+T_R = [0.5, 2.0]
+# the number of signals processed at once
+N_VOXELS = [1, 100]
+
+
+def gen_signals(n_scans, t_r, n_voxels, snr=1.0, random_state=0):
+    """ Return n_voxels noisy BOLD signals of n_scans scans (of shape
+    (n_voxels, n_scans)), their block signals and their HRF (delta=1.0).
+    """
+    nb_events = max(1, int(n_scans * t_r / 60.0))
+    ai_s, _, _ = gen_rnd_ai_s_batch(n_voxels, dur=n_scans * t_r / 60.0,
+                                    tr=t_r, nb_events=nb_events, avg_dur=5,
+                                    std_dur=1, overlapping=True,
+                                    unitary_block=True,
+                                    random_state=random_state)
+    ai_s = ai_s[:, :n_scans]
+    hrf, _ = spm_hrf(1.0, t_r=t_r, dur=20.0)
+    ar_s = simple_convolve(hrf, ai_s)
+    noisy_ar_s, _ = add_gaussian_noise(ar_s, snr, random_state=random_state)
+
+    return noisy_ar_s, ai_s, hrf
@@ -8,7 +8,7 @@ from glob import glob
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from joblib import Memory, Parallel, delayed
+from joblib import Memory
 from nilearn.input_data import NiftiMasker
 from nilearn.plotting import plot_stat_map
 from nistats.reporting import plot_design_matrix
@@ -198,11 +198,8 @@ def _hcp_hrf_comparison(fmri_img, subject_id, n_voxels=10, hrf_dur=30.0,
         voxels[trial] = masker.fit_transform(fmri_img)
         voxels[trial] -= savgol_filter(voxels[trial], 91, 3, axis=0)
 
-        res = Parallel(n_jobs=n_jobs, verbose=0)(delayed(hrf_estim)(
-                                 p_e, voxel, t_r=TR_HCP,
-                                 dur=hrf_dur, bounds=True, verbose=0)
-                                 for voxel in voxels[trial].T)
-        est_hrfs[trial] = np.vstack([hrf for hrf, J in res]).T
+        est_hrfs[trial], _, _ = hrf_estim(p_e, voxels[trial], t_r=TR_HCP,
+                                          dur=hrf_dur, verbose=0)
 
         hrfs_coef, _ = glm(trial_type, onset, TR_HCP, voxels[trial],
                            drifts=np.zeros((voxels[trial].shape[0], 1)),
@@ -0,0 +1,323 @@
+# coding: utf-8
+""" This module gathers the batch (many voxels) execution of the
+deconvolution functions.
+
+The voxels are processed by a pool of threads of the current process: the
+numba kernels release the GIL (nogil) as do the BLAS and FFT calls, so the
+threads share the voxel matrix and the compiled kernels instead of copying
+them to worker processes.
+"""
+import numpy as np
+from .bold_signal import bd, deconv
+from .hrf_model import spm_hrf
+from .utils import check_dtype, get_n_jobs, chunk_slices, thread_map
+
+
+def operator_memory(n_scans, n_voxels=1, spectral_conv=False,
+                    dtype=np.float64):
+    """ Estimate the memory (in bytes) of the deconvolution operator
+    (ConvAndLinear with the time integration) applied on n_voxels signals.
+
+    Parameters:
+    -----------
+    n_scans : int,
+        the length of the signals.
+
+    n_voxels : int (default=1),
+        the number of signals processed at once.
+
+    spectral_conv : bool (default=False),
+        the backend, the Toeplitz one (used by deconv and bd) or the Fourier
+        one.
+
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
+
+    Results:
+    --------
+    fixed : int,
+        the peak memory of the operator precomputations.
+
+    per_voxel : int,
+        the memory of the workspaces, per signal.
+    """
+    itemsize = check_dtype(dtype).itemsize
+    if not spectral_conv:
+        # Toeplitz and Gram matrices, the Gram matrix being computed in
+        # float64 then cast (two float64 (N, N) temporaries)
+        fixed = n_scans**2 * (itemsize + max(16, 8 + itemsize))
+        per_voxel = n_scans * itemsize
+    else:
+        # |K(f)|^2 and the workspaces on the (power of 2) Fourier grid: the
+        # zero-padded signal, its spectrum and the inverse transform
+        nfft = int(np.power(2, np.ceil(np.log2(2 * n_scans))))
+        fixed = nfft * itemsize
+        per_voxel = nfft * 4 * itemsize
+    return int(fixed), int(per_voxel)
+
+
+def estimate_memory(n_scans, n_voxels=1, solver='deconv',
+                    spectral_conv=False, dtype=np.float64, nb_iter=1000,
+                    wind=6):
+    """ Estimate the peak memory (in bytes) of one deconv call on n_voxels
+    signals, or of one bd call (one voxel), the input signals excluded.
+
+    Parameters:
+    -----------
+    n_scans : int,
+        the length of the signals.
+
+    n_voxels : int (default=1),
+        the number of signals deconvolved at once, 1 for bd.
+
+    solver : str (default='deconv'),
+        'deconv' or 'bd'.
+
+    spectral_conv : bool (default=False),
+        the backend of the operator (see operator_memory).
+
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
+
+    nb_iter : int (default=1000),
+        the number of iterations, the cost-function being stored per
+        iteration.
+
+    wind : int (default=6),
+        the early stopping window of deconv (stored iterates).
+
+    Results:
+    --------
+    mem : int,
+        the estimated peak memory.
+    """
+    itemsize = check_dtype(dtype).itemsize
+    fixed, per_voxel = operator_memory(n_scans, n_voxels=n_voxels,
+                                       spectral_conv=spectral_conv,
+                                       dtype=dtype)
+    if solver == 'deconv':
+        # signal, iterates, gradient, adjoint, outputs... and the window
+        per_voxel += (9 + wind) * n_scans * itemsize
+        # the cost-function evolution (float64)
+        per_voxel += 3 * 8 * nb_iter
+        return int(fixed + n_voxels * per_voxel)
+    elif solver == 'bd':
+        if n_voxels != 1:
+            raise ValueError("bd deconvolves one voxel per call, "
+                             "got n_voxels={0}".format(n_voxels))
+        # the operator of the previous outer iteration is still alive while
+        # the new one is computed
+        if not spectral_conv:
+            fixed += 2 * n_scans**2 * itemsize
+        return int(fixed + per_voxel + 16 * n_scans * 8 + 3 * 8 * nb_iter)
+    else:
+        raise ValueError("solver should be 'deconv' or 'bd', "
+                         "got {0}".format(solver))
+
+
+def plan_batch(n_scans, n_voxels, mem_budget, solver='deconv', n_jobs=-1,
+               **kwargs):
+    """ Choose the chunk size and the number of threads of deconv_batch (or
+    the number of threads of bd_batch) so that the estimated peak memory
+    fits in mem_budget.
+
+    Parameters:
+    -----------
+    n_scans : int,
+        the length of the signals.
+
+    n_voxels : int,
+        the number of voxels.
+
+    mem_budget : int,
+        the memory budget (in bytes), the input signals excluded.
+
+    solver : str (default='deconv'),
+        'deconv' or 'bd'.
+
+    n_jobs : int (default=-1),
+        the maximum number of threads.
+
+    kwargs : dict,
+        the other parameters of estimate_memory (spectral_conv, dtype,
+        nb_iter, wind).
+
+    Results:
+    --------
+    chunk_size : int,
+        the number of voxels per chunk (1 for bd).
+
+    n_jobs : int,
+        the number of threads.
+    """
+    n_jobs = min(get_n_jobs(n_jobs), max(1, n_voxels))
+    itemsize = check_dtype(kwargs.get('dtype', np.float64)).itemsize
+    # outputs (x, z, diff_z): per chunk then stacked
+    avail = mem_budget - 6 * n_scans * n_voxels * itemsize
+
+    if solver == 'bd':
+        worker = estimate_memory(n_scans, 1, solver='bd', **kwargs)
+        if avail < worker:
+            raise MemoryError("a memory budget of {0} bytes is too small "
+                              "for bd on {1} scans, at least {2} bytes are "
+                              "needed".format(mem_budget, n_scans,
+                                              mem_budget - avail + worker))
+        return 1, min(n_jobs, int(avail // worker))
+
+    fixed = estimate_memory(n_scans, 0, solver=solver, **kwargs)
+    per_voxel = estimate_memory(n_scans, 1, solver=solver, **kwargs) - fixed
+    if avail < fixed + per_voxel:
+        raise MemoryError("a memory budget of {0} bytes is too small for "
+                          "deconv on {1} scans, at least {2} bytes are "
+                          "needed".format(mem_budget, n_scans,
+                                          mem_budget - avail + fixed +
+                                          per_voxel))
+    n_jobs = min(n_jobs, int(avail // (fixed + per_voxel)))
+    chunk_size = int((avail / n_jobs - fixed) // per_voxel)
+    chunk_size = min(chunk_size, int(np.ceil(n_voxels / float(n_jobs))))
+
+    return max(1, chunk_size), n_jobs
+
+
+def _estimate_kwargs(kwargs):
+    """ Private helper to pick the parameters of estimate_memory among the
+    parameters of deconv / bd.
+    """
+    return {name: kwargs[name]
+            for name in ['dtype', 'nb_iter', 'wind', 'spectral_conv']
+            if name in kwargs}
+
+
+def deconv_batch(Y, t_r, hrf, n_jobs=1, chunk_size=None, mem_budget=None,
+                 **kwargs):
+    """ Deconvolve the voxels (columns) of Y given the HRF, by chunks of
+    voxels processed in a pool of threads, each chunk being deconvolved at
+    once (see deconv).
+
+    Parameters:
+    -----------
+    Y : 2d np.ndarray,
+        the observed BOLD signals, of shape (n_scans, n_voxels).
+
+    t_r : float,
+        the TR.
+
+    hrf : 1d np.ndarray,
+        the HRF.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    chunk_size : int or None (default=None),
+        the number of voxels per chunk, if None the voxels are evenly split
+        between the threads.
+
+    mem_budget : int or None (default=None),
+        the memory budget (in bytes), if given the chunk size and the number
+        of threads are reduced to fit in it (see plan_batch).
+
+    kwargs : dict,
+        the other parameters of deconv.
+
+    Results:
+    --------
+    x : 2d np.ndarray,
+        the estimated convolved signals.
+
+    z : 2d np.ndarray,
+        the estimated bloc signals.
+
+    diff_z : 2d np.ndarray,
+        the estimated spike signals.
+
+    J : list,
+        the cost-function evolution of each chunk.
+    """
+    Y = np.asarray(Y)
+    n_scans, n_voxels = Y.shape
+    if n_voxels == 0:
+        empty = np.empty((n_scans, 0),
+                         dtype=check_dtype(kwargs.get('dtype', np.float64)))
+        return empty, empty.copy(), empty.copy(), []
+    if mem_budget is not None:
+        max_chunk_size, n_jobs = plan_batch(
+                                n_scans, n_voxels, mem_budget, 'deconv',
+                                n_jobs=n_jobs, **_estimate_kwargs(kwargs))
+        chunk_size = min(chunk_size or max_chunk_size, max_chunk_size)
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n_voxels / float(get_n_jobs(n_jobs))))
+    chunk_size = max(1, chunk_size)
+
+    def _deconv_chunk(chunk):
+        return deconv(Y[:, chunk], t_r, hrf, **kwargs)
+
+    res = thread_map(_deconv_chunk, chunk_slices(n_voxels, chunk_size),
+                     n_jobs=n_jobs)
+    x = np.hstack([r[0] for r in res])
+    z = np.hstack([r[1] for r in res])
+    diff_z = np.hstack([r[2] for r in res])
+
+    return x, z, diff_z, [r[3] for r in res]
+
+
+def bd_batch(Y, t_r, n_jobs=1, mem_budget=None, **kwargs):
+    """ Blind deconvolution of each voxel (column) of Y, the voxels being
+    processed in a pool of threads (see bd).
+
+    Parameters:
+    -----------
+    Y : 2d np.ndarray,
+        the observed BOLD signals, of shape (n_scans, n_voxels).
+
+    t_r : float,
+        the TR.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    mem_budget : int or None (default=None),
+        the memory budget (in bytes), if given the number of threads is
+        reduced to fit in it (see plan_batch).
+
+    kwargs : dict,
+        the other parameters of bd.
+
+    Results:
+    --------
+    x : 2d np.ndarray,
+        the estimated convolved signals.
+
+    z : 2d np.ndarray,
+        the estimated bloc signals.
+
+    diff_z : 2d np.ndarray,
+        the estimated spike signals.
+
+    hrfs : 2d np.ndarray,
+        the estimated HRFs, of shape (n_taps, n_voxels).
+
+    d : list of dict,
+        the cost-function evolutions of each voxel.
+    """
+    Y = np.asarray(Y)
+    n_scans, n_voxels = Y.shape
+    if n_voxels == 0:
+        empty = np.empty((n_scans, 0),
+                         dtype=check_dtype(kwargs.get('dtype', np.float64)))
+        n_taps = len(spm_hrf(1.0, t_r, kwargs.get('hrf_dur', 20.0))[0])
+        return (empty, empty.copy(), empty.copy(), np.empty((n_taps, 0)),
+                [])
+    if mem_budget is not None:
+        _, n_jobs = plan_batch(n_scans, n_voxels, mem_budget, 'bd',
+                               n_jobs=n_jobs, **_estimate_kwargs(kwargs))
+
+    def _bd_voxel(idx):
+        return bd(Y[:, idx], t_r, **kwargs)
+
+    res = thread_map(_bd_voxel, range(n_voxels), n_jobs=n_jobs)
+    x = np.vstack([r[0] for r in res]).T
+    z = np.vstack([r[1] for r in res]).T
+    diff_z = np.vstack([r[2] for r in res]).T
+    hrfs = np.vstack([r[3] for r in res]).T
+
+    return x, z, diff_z, hrfs, [r[4] for r in res]
@@ -3,22 +3,196 @@
 """
 import numpy as np
 import numba
-from scipy.optimize import fmin_l_bfgs_b
-from .hrf_model import spm_hrf, MIN_DELTA, MAX_DELTA
-from .linear import DiscretInteg, ConvAndLinear
-from .convolution import spectral_convolve, toeplitz_from_kernel
-from .utils import Tracker, mad_daub_noise_est, spectral_radius_est
+from numpy.fft import rfft, irfft
+from .hrf_model import (spm_hrf, spm_hrf_bank, spm_hrf_basis, MIN_DELTA,
+                        MAX_DELTA)
+from .linear import DiscretInteg, ConvAndLinear, lipschitz_est
+from .convolution import spectral_convolve
+from .padding import custom_padd, unpadd
+from .utils import Tracker, mad_daub_noise_est, check_dtype, get_profile
+from .jit import jit
+
+
+@jit([(numba.float64[:, :], numba.float64[:, :], numba.float64[:, :],
+       numba.float64[:, :], numba.float64, numba.float64[:],
+       numba.float64, numba.float64[:, :]),
+      (numba.float32[:, :], numba.float32[:, :], numba.float32[:, :],
+       numba.float32[:, :], numba.float64, numba.float64[:],
+       numba.float64, numba.float64[:, :])],
+     cache=True, nopython=True, nogil=True)
+def _prox_momentum_update(diff_z, grad_z, normal_z, H_adj_y, step, th,
+                          momentum, crit):
+    """ Fused in-place FISTA update of the columns of diff_z (the extrapolated
+    point): gradient step (written in grad_z), soft-thresholding (with the
+    per-column threshold th) and momentum, taken, as in the original loop,
+    relatively to the gradient step. crit receives, per column, the squared
+    norm of the difference between the new extrapolated point and the
+    gradient step, the squared norm and the l1 norm of the former.
+    """
+    N, V = diff_z.shape
+    for v in range(V):
+        crit[0, v] = 0.0
+        crit[1, v] = 0.0
+        crit[2, v] = 0.0
+    for i in range(N):
+        for v in range(V):
+            g = diff_z[i, v] - step * (normal_z[i, v] - H_adj_y[i, v])
+            abs_z = np.abs(g) - th[v]
+            z = np.sign(g) * abs_z if abs_z > 0.0 else 0.0
+            z = z + momentum * (z - g)
+            crit[0, v] += (z - g) ** 2
+            crit[1, v] += z ** 2
+            crit[2, v] += np.abs(z)
+            grad_z[i, v] = g
+            diff_z[i, v] = z
+
+
+@jit([(numba.float64[:, :, :], numba.int64, numba.int64,
+       numba.float64[:, :]),
+      (numba.float32[:, :, :], numba.int64, numba.int64,
+       numba.float64[:, :])],
+     cache=True, nopython=True, nogil=True)
+def _window_crit(xx, last, sub_wind_len, crit):
+    """ Early stopping criterion on the ring buffer of iterates xx (the last
+    one being at index last): squared norm of the difference between the mean
+    of the sub_wind_len last iterates and the mean of the older ones, and
+    squared norm of the former, per column.
+    """
+    wind, N, V = xx.shape
+    for v in range(V):
+        crit[0, v] = 0.0
+        crit[1, v] = 0.0
+    for i in range(N):
+        for v in range(V):
+            new_iter = 0.0
+            old_iter = 0.0
+            for s in range(wind - 1, -1, -1):  # from the oldest one
+                slot = (last - s + wind) % wind
+                if s < sub_wind_len:
+                    new_iter += xx[slot, i, v]
+                else:
+                    old_iter += xx[slot, i, v]
+            new_iter /= sub_wind_len
+            old_iter /= (wind - sub_wind_len)
+            crit[0, v] += (new_iter - old_iter) ** 2
+            crit[1, v] += new_iter ** 2
+
+
+def _fista(H, H_adj_y, diff_z, th, step, nb_iter, early_stopping, wind, tol,
+           y=None, lbda=None, verbose=0, prof=None):
+    """ Private helper for the FISTA deconvolution loop, on the 2d array
+    diff_z (signals stacked as columns) updated in-place, the final
+    extrapolated point being returned in it.
+
+    All the signals are advanced together (one GEMM, or one batched FFT, per
+    iteration). With early stopping, the converged signals are frozen: they
+    are written back and dropped from the (compacted) working arrays.
+
+    Return the cost-function evolution (nb of iterations, nb of signals) if y
+    and lbda are given (frozen signals keeping their last value), None
+    otherwise. The operator applications and the number of iterations are
+    reported to the Profile prof, if given.
+    """
+    n_signals = diff_z.shape[1]
+    th = np.array(np.broadcast_to(th, (n_signals,)), dtype=np.float64)
+    active = np.arange(n_signals)
+    w_z, w_H_adj_y = diff_z, H_adj_y
+    normal_z = np.empty_like(diff_z)
+    crit = np.empty((3, n_signals))
+    if early_stopping:
+        sub_wind_len = int(wind/2)
+        # as in the original loop, each iterate of the window is replaced by
+        # the gradient step of the next iteration, except the last one
+        xx = np.empty((wind,) + diff_z.shape, dtype=diff_z.dtype)
+        wind_crit = np.empty((2, n_signals))
+    else:
+        grad_z = np.empty_like(diff_z)
+    if y is not None:
+        lbda = np.array(np.broadcast_to(lbda, (n_signals,)),
+                        dtype=np.float64)
+        w_y = y
+        x = np.empty_like(diff_z)
+        j = np.empty(n_signals)
+        J = np.empty((nb_iter, n_signals))
+    t_old = 1.0
+
+    for idx in range(nb_iter):
+
+        if early_stopping:
+            grad_z = xx[(idx - 1) % wind]
+        H.normal(w_z, out=normal_z)
+        t = 0.5 * (1.0 + np.sqrt(1 + 4*t_old**2))
+        _prox_momentum_update(w_z, grad_z, normal_z, w_H_adj_y, step, th,
+                              (t_old-1)/t, crit)
+        t_old = t
+
+        if y is not None:
+            H.op(w_z, out=x)
+            x -= w_y
+            if idx > 0:
+                J[idx] = J[idx - 1]
+            np.einsum('ij,ij->j', x, x, out=j)
+            j *= 0.5
+            j += lbda * crit[2]
+            J[idx, active] = j
+            if verbose > 0:
+                grad = normal_z - w_H_adj_y
+                print("Main loop: iteration {0:03d}, |grad| = {1:0.6f},"
+                      " j = {2:0.6f}".format(idx, np.linalg.norm(grad),
+                                             J[idx].sum()))
+
+        if early_stopping:
+            np.copyto(xx[idx % wind], w_z)
+            if idx > wind:
+                _window_crit(xx, idx % wind, sub_wind_len, wind_crit)
+                diff = (np.sqrt(wind_crit[0]) /
+                        (np.sqrt(wind_crit[1]) + 1.0e-10))
+                converged = diff < tol
+                if np.all(converged):
+                    break
+                if np.any(converged):  # freeze the converged signals
+                    done, keep = active[converged], ~converged
+                    diff_z[:, done] = w_z[:, converged]
+                    active = active[keep]
+                    w_z = np.ascontiguousarray(w_z[:, keep])
+                    w_H_adj_y = np.ascontiguousarray(w_H_adj_y[:, keep])
+                    th = th[keep]
+                    normal_z = np.empty_like(w_z)
+                    crit = np.empty((3, len(active)))
+                    xx = np.ascontiguousarray(xx[:, :, keep])
+                    wind_crit = np.empty((2, len(active)))
+                    if y is not None:
+                        w_y = np.ascontiguousarray(w_y[:, keep])
+                        lbda = lbda[keep]
+                        x = np.empty_like(w_z)
+                        j = np.empty(len(active))
+
+    if w_z is not diff_z:
+        diff_z[:, active] = w_z
+
+    if prof is not None:
+        prof.count('normal', idx + 1)
+        if y is not None:
+            prof.count('op', idx + 1)
+        prof.record('nb_inner_iter', idx + 1)
+
+    return J[:idx+1] if y is not None else None
 
 
 def deconv(y, t_r, hrf, lbda=None, early_stopping=True, tol=1.0e-6,  # noqa
-           wind=6, nb_iter=1000, nb_sub_iter=1000, verbose=0):
+           wind=6, nb_iter=1000, nb_sub_iter=1000, dtype=np.float64,
+           spectral_conv=False, profile=None, verbose=0):
     """ Deconvolve the given BOLD signal given an HRF convolution kernel.
     The source signal is supposed to be a bloc signal.
 
+    Several signals (voxels) can be deconvolved at once: the operator and its
+    Lipschitz constant are then computed once, and the iterations advance all
+    the signals together.
+
     Parameters:
     ----------
-    y : 1d np.ndarray,
-        the observed bold signal.
+    y : 1d np.ndarray or 2d np.ndarray,
+        the observed bold signal, or signals of shape (n_scans, n_voxels).
 
     t_r : float,
         the TR.
@@ -26,139 +200,139 @@ def deconv(y, t_r, hrf, lbda=None, early_stopping=True, tol=1.0e-6,  # noqa
     hrf : 1d np.ndarray,
         the HRF.
 
-    lbda : float (default=1.0),
-        the regularization parameter.
+    lbda : float or 1d np.ndarray (default=None),
+        the regularization parameter, or one per voxel, if None it is
+        estimated (per voxel) from the noise level.
+
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision. float32 halves the memory traffic, the
+        estimated signals then differ from the float64 ones by up to 1.0e-3
+        (relative l2-norm, the integration amplifies the rounding errors)
+        and the cost-function by about 1.0e-5 (relative), the cost-function
+        being still accumulated in float64.
+
+    spectral_conv : bool (default=False),
+        the backend of the operator: the Toeplitz one (dense, O(N^2) memory)
+        or the Fourier one (O(N log N) per iteration and O(N) memory, for
+        long signals).
+
+    profile : dict or None (default=None),
+        if given, filled with the profile of the call ('time' per stage,
+        'count' and 'nb_inner_iter', see bd), the returned values being
+        unchanged.
 
     verbose : int (default=0),
         the verbosity level.
 
     Return:
     ------
-    x : 1d np.ndarray,
+    x : 1d np.ndarray or 2d np.ndarray,
         the estimated convolved signal.
 
-    z : 1d np.ndarray,
+    z : 1d np.ndarray or 2d np.ndarray,
         the estimated convolved signal.
 
-    diff_z : 1d np.ndarray,
+    diff_z : 1d np.ndarray or 2d np.ndarray,
         the estimated convolved signal.
 
-    J : 1d np.ndarray,
-        the evolution of the cost-function.
-    """
-    diff_z = np.zeros_like(y)
-    H = ConvAndLinear(DiscretInteg(), hrf, dim_in=len(y), dim_out=len(y))
-    H_adj_y = H.adj(y)
-    grad_lipschitz_cst = 0.9 * spectral_radius_est(H, diff_z.shape)
-    step = 1.0 / grad_lipschitz_cst
-
-    if lbda is not None:
-
-        th = lbda / grad_lipschitz_cst
-        diff_z_old = np.zeros_like(y)
-        J, xx = [], []
-        t = t_old = 1
+    J : 1d np.ndarray or 2d np.ndarray,
+        the evolution of the cost-function, of shape (nb of iterations,
+        n_voxels) for 2d y.
 
-        for idx in range(nb_iter):
+    R : list or None,
+        the evolution of the residual, if lbda is None.
 
-            grad = H.adj(H.op(diff_z)) - H_adj_y
-            diff_z -= step * grad
-            diff_z = np.sign(diff_z) * np.maximum(np.abs(diff_z) - th, 0)
+    G : list or None,
+        the evolution of the regularization, if lbda is None.
 
-            t = 0.5 * (1.0 + np.sqrt(1 + 4*t_old**2))
-            diff_z = diff_z + (t_old-1)/t * (diff_z - diff_z_old)
+    The profile holds the wall time per stage ('toeplitz' for the operator,
+    'deconv', 'cost' and 'total'), the operator applications ('op', 'adj',
+    'normal') and the number of iterations of each FISTA loop
+    ('nb_inner_iter').
+    """
+    prof = get_profile(profile is not None)
+    dtype = check_dtype(dtype)
+    y = np.asarray(y, dtype=dtype)
+    is_1d = (y.ndim == 1)
+    # the FISTA loop works in-place on column-stacked signals
+    y_2d = np.ascontiguousarray(y[:, None] if is_1d else y)
+    n_scans, n_voxels = y_2d.shape
+    diff_z_2d = np.zeros_like(y_2d)
+    with prof.stage('toeplitz'):
+        H = ConvAndLinear(DiscretInteg(), hrf, dim_in=n_scans,
+                          dim_out=n_scans, spectral_conv=spectral_conv,
+                          dtype=dtype)
+        H_adj_y_2d = H.adj(y_2d)
+        grad_lipschitz_cst = 0.9 * lipschitz_est(H)
+    prof.count('adj')
+    step = 1.0 / grad_lipschitz_cst
 
-            t_old = t
-            diff_z_old = diff_z
+    def _squeeze(a):
+        if not is_1d:
+            return a
+        return a[:, 0] if a.ndim == 2 else a[0]
 
-            z = np.cumsum(diff_z)
-            x = spectral_convolve(hrf, z)
-            J.append(0.5 * np.sum(np.square(x - y)) +
-                     lbda * np.sum(np.abs(diff_z)))
+    def _return(*res):
+        profile_ = prof.finish()
+        if profile is not None:
+            profile.update(profile_)
+        return res
 
-            print("Main loop: iteration {0:03d}, |grad| = {1:0.6f},"
-                  " j = {2:0.6f}".format(idx, np.linalg.norm(grad), J[idx]))
+    if lbda is not None:
 
-            xx.append(diff_z_old)
-            if len(xx) > wind:
-                xx = xx[1:]
+        th = np.asarray(lbda) / grad_lipschitz_cst
+        with prof.stage('deconv'):
+            J = _fista(H, H_adj_y_2d, diff_z_2d, th, step, nb_iter,
+                       early_stopping, wind, tol, y=y_2d, lbda=lbda,
+                       verbose=verbose, prof=prof)
 
-            if early_stopping:
-                if idx > wind:
-                    sub_wind_len = int(wind/2)
-                    old_iter = np.mean(xx[:-sub_wind_len], axis=0)
-                    new_iter = np.mean(xx[-sub_wind_len:], axis=0)
-                    crit_num = np.linalg.norm(new_iter - old_iter)
-                    crit_deno = np.linalg.norm(new_iter)
-                    diff = crit_num / (crit_deno + 1.0e-10)
-                    if diff < tol:
-                        break
+        with prof.stage('cost'):
+            z = np.cumsum(diff_z_2d, axis=0)
+            x = spectral_convolve(hrf, z, axis=0, dtype=dtype)
+        prof.count('op')
 
-        return x, z, diff_z, np.array(J) / (J[0] + 1.0e-30), None, None
+        return _return(_squeeze(x), _squeeze(z), _squeeze(diff_z_2d),
+                       _squeeze(J / (J[0] + 1.0e-30)), None, None)
 
     else:
         l_alpha, J, R, G = [], [], [], []
-        diff_z = np.zeros(len(y))
-        diff_z_old = np.zeros(len(y))
-        sigma = mad_daub_noise_est(y)
-        alpha = 1.0
+        sigma = mad_daub_noise_est(y_2d, axis=0)
+        alpha = np.ones(n_voxels)
         lbda = 1.0 / (2.0 * alpha)
         mu = 1.0e-4
         for i in range(nb_iter):
 
             # deconvolution step
             th = lbda / grad_lipschitz_cst
-            xx = []
-            t = t_old = 1
-
-            for j in range(nb_sub_iter):
-
-                diff_z -= step * (H.adj(H.op(diff_z)) - H_adj_y)
-                diff_z = np.sign(diff_z) * np.maximum(np.abs(diff_z) - th, 0)
-
-                t = 0.5 * (1.0 + np.sqrt(1 + 4*t_old**2))
-                diff_z = diff_z + (t_old-1)/t * (diff_z - diff_z_old)
-
-                t_old = t
-                diff_z_old = diff_z
-
-                xx.append(diff_z_old)
-                if len(xx) > wind:
-                    xx = xx[1:]
-
-                if early_stopping:
-                    if j > wind:
-                        sub_wind_len = int(wind/2)
-                        old_iter = np.mean(xx[:-sub_wind_len], axis=0)
-                        new_iter = np.mean(xx[-sub_wind_len:], axis=0)
-                        crit_num = np.linalg.norm(new_iter - old_iter)
-                        crit_deno = np.linalg.norm(new_iter)
-                        diff = crit_num / (crit_deno + 1.0e-10)
-                        if diff < tol:
-                            break
+            with prof.stage('deconv'):
+                _fista(H, H_adj_y_2d, diff_z_2d, th, step, nb_sub_iter,
+                       early_stopping, wind, tol, prof=prof)
 
             # lambda optimization
-            z = np.cumsum(diff_z)
-            x = spectral_convolve(hrf, z)
-            grad = np.sum(np.square(x - y)) - len(y) * sigma**2
+            with prof.stage('cost'):
+                z = np.cumsum(diff_z_2d, axis=0)
+                x = spectral_convolve(hrf, z, axis=0, dtype=dtype)
+                r = np.sum(np.square(x - y_2d), axis=0, dtype=np.float64)
+            prof.count('op')
+            grad = r - n_scans * sigma**2
             alpha += mu * grad
             lbda = 1.0 / (2.0 * alpha)
 
             # iterate update and saving
-            l_alpha.append(alpha)
+            l_alpha.append(alpha.copy())
             if len(l_alpha) > wind:  # only hold the 'wind' last iterates
                 l_alpha = l_alpha[1:]
 
             # metrics evolution
-            r = np.sum(np.square(x - y))
-            g = np.sum(np.abs(diff_z))
-            R.append(r)
-            G.append(g)
-            J.append(0.5 * r + lbda * g)
+            g = np.sum(np.abs(diff_z_2d), axis=0, dtype=np.float64)
+            R.append(_squeeze(r))
+            G.append(_squeeze(g))
+            J.append(_squeeze(0.5 * r + lbda * g))
             if verbose > 0:
                 print("Main loop: iteration {0:03d},"
                       " |grad| = {1:0.6f},"
-                      " lbda = {2:0.6f},".format(i+1, np.abs(grad), lbda))
+                      " lbda = {2:0.6f},".format(i+1, np.abs(grad).sum(),
+                                                 lbda.mean()))
 
             # early stopping
             if early_stopping:
@@ -169,49 +343,28 @@ def deconv(y, t_r, hrf, lbda=None, early_stopping=True, tol=1.0e-6,  # noqa
                     crit_num = np.abs(new_iter - old_iter)
                     crit_deno = np.abs(new_iter)
                     diff = crit_num / crit_deno
-                    if diff < tol:
+                    if np.all(diff < tol):
                         if verbose > 1:
                             print("\n-----> early-stopping "
                                   "done at {0:03d}/{1:03d}, "
-                                  "cost function = {2:.6f}".format(i, nb_iter,
-                                                                   J[i]))
+                                  "cost function = {2:.6f}".format(
+                                                    i, nb_iter,
+                                                    np.sum(J[i])))
                         break
 
         # last deconvolution with larger number of iterations
         th = lbda / grad_lipschitz_cst
-        xx = []
-        t = t_old = 1
-
-        for j in range(nb_sub_iter):
-
-            diff_z -= step * (H.adj(H.op(diff_z)) - H_adj_y)
-            diff_z = np.sign(diff_z) * np.maximum(np.abs(diff_z) - th, 0)
-
-            t = 0.5 * (1.0 + np.sqrt(1 + 4*t_old**2))
-            diff_z = diff_z + (t_old-1)/t * (diff_z - diff_z_old)
-
-            t_old = t
-            diff_z_old = diff_z
+        with prof.stage('deconv'):
+            _fista(H, H_adj_y_2d, diff_z_2d, th, step, nb_sub_iter,
+                   early_stopping, wind, tol, prof=prof)
 
-            xx.append(diff_z_old)
-            if len(xx) > wind:
-                xx = xx[1:]
+        with prof.stage('cost'):
+            z = np.cumsum(diff_z_2d, axis=0)
+            x = spectral_convolve(hrf, z, axis=0, dtype=dtype)
+        prof.count('op')
 
-            if early_stopping:
-                if j > wind:
-                    sub_wind_len = int(wind/2)
-                    old_iter = np.mean(xx[:-sub_wind_len], axis=0)
-                    new_iter = np.mean(xx[-sub_wind_len:], axis=0)
-                    crit_num = np.linalg.norm(new_iter - old_iter)
-                    crit_deno = np.linalg.norm(new_iter)
-                    diff = crit_num / (crit_deno + 1.0e-10)
-                    if diff < tol:
-                        break
-
-        z = np.cumsum(diff_z)
-        x = spectral_convolve(hrf, z)
-
-        return x, z, diff_z, J, R, G
+        return _return(_squeeze(x), _squeeze(z), _squeeze(diff_z_2d), J, R,
+                       G)
 
 
 def hrf_fit_err(theta, z, y, t_r, hrf_dur):
@@ -222,9 +375,161 @@ def hrf_fit_err(theta, z, y, t_r, hrf_dur):
     return 0.5 * np.sum(np.square(y - spectral_convolve(h, z)))
 
 
-def hrf_estim(z, y, t_r, dur, verbose=0):
-    """ Private function HRF estimation.
+def _hrf_estim_batch(z, y, t_r, dur, xtol=1.0e-8, verbose=0):
+    """ Private helper to estimate the HRFs of the voxels (columns) of y, by
+    a golden-section search of each delta run for all the voxels at once:
+    the spectrum of the bloc signal(s) is computed once, each iteration
+    evaluating one bank of HRFs (one per voxel).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n_voxels = y.shape[1]
+    z_padd, p = custom_padd(np.asarray(z, dtype=np.float64), axis=0)
+    N = z_padd.shape[0]
+    fft_z = rfft(z_padd, n=N, axis=0)
+    fft_z = fft_z[:, None] if fft_z.ndim == 1 else fft_z
+
+    def _cost(deltas):
+        hrfs, _ = spm_hrf_bank(deltas, t_r=t_r, dur=dur,
+                               normalized_hrf=False)
+        fft_h = rfft(hrfs, n=N, axis=1).T
+        x = unpadd(irfft(fft_h * fft_z, n=N, axis=0), p, axis=0)
+        return 0.5 * np.sum(np.square(y - x), axis=0)
+
+    inv_phi = (np.sqrt(5.0) - 1.0) / 2.0
+    a = np.full(n_voxels, MIN_DELTA + 1.0e-1)
+    b = np.full(n_voxels, MAX_DELTA - 1.0e-1)
+    c, d = b - inv_phi * (b - a), a + inv_phi * (b - a)
+    f_c, f_d = _cost(c), _cost(d)
+    J = [np.minimum(f_c, f_d)]
+    nb_iter = int(np.ceil(np.log(xtol / (b[0] - a[0])) / np.log(inv_phi)))
+    for i in range(max(0, nb_iter)):
+        left = f_c < f_d  # the minimum is in [a, d]
+        b, a = np.where(left, d, b), np.where(left, a, c)
+        c_new, d_new = b - inv_phi * (b - a), a + inv_phi * (b - a)
+        c, d = np.where(left, c_new, d), np.where(left, c, d_new)
+        f_new = _cost(np.where(left, c, d))
+        f_c, f_d = np.where(left, f_new, f_d), np.where(left, f_c, f_new)
+        J.append(np.minimum(f_c, f_d))
+        if verbose > 2:
+            print("At iterate {0}, tracked function = "
+                  "{1:.6f}".format(i + 1, np.sum(J[-1])))
+
+    theta = np.where(f_c < f_d, c, d)
+    hrfs, _ = spm_hrf_bank(theta, t_r=t_r, dur=dur, normalized_hrf=False)
+
+    return hrfs.T, theta, np.array(J)
+
+
+def _hrf_basis_lstsq(z, y, t_r, dur, delta_0=1.0, n_derivatives=2):
+    """ Private helper to fit the voxels (columns) of y with the HRFs
+    h = h_0 + sum_k beta_k h_k, with h_0 the HRF at delta_0 (its amplitude
+    being fixed, as in the scaled model) and h_k its derivatives with
+    respect to delta, by least squares: one QR of the convolved basis for a
+    shared bloc signal, the stacked normal equations of the voxels for
+    per-voxel bloc signals. Return the HRFs, beta and the cost of each
+    voxel.
+    """
+    from scipy.linalg import solve_triangular  # lazy: heavy import
+
+    basis, _ = spm_hrf_basis(delta_0, t_r=t_r, dur=dur,
+                             n_derivatives=n_derivatives, normalized_hrf=False)
+    z = np.asarray(z, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    if z.ndim == 1:
+        D = np.vstack([spectral_convolve(b, z) for b in basis.T]).T
+        Q, R = np.linalg.qr(D[:, 1:])
+        beta = solve_triangular(R, Q.T.dot(y - D[:, :1]))
+        x = D[:, :1] + D[:, 1:].dot(beta)
+    else:
+        D = np.stack([spectral_convolve(b, z, axis=0) for b in basis.T],
+                     axis=-1)
+        A = np.einsum('nvk,nvl->vkl', D[:, :, 1:], D[:, :, 1:])
+        b = np.einsum('nvk,nv->vk', D[:, :, 1:], y - D[:, :, 0])[:, :, None]
+        try:
+            beta = np.linalg.solve(A, b)[:, :, 0].T
+        except np.linalg.LinAlgError:  # a null bloc signal
+            beta = np.matmul(np.linalg.pinv(A), b)[:, :, 0].T
+        x = D[:, :, 0] + np.einsum('nvk,kv->nv', D[:, :, 1:], beta)
+    hrfs = basis[:, :1] + basis[:, 1:].dot(beta)
+    J = 0.5 * np.sum(np.square(y - x), axis=0)
+
+    return hrfs, beta, J
+
+
+def _hrf_basis_fit(z, y, t_r, dur, bounds=None):
+    """ Private helper to estimate the HRFs of the voxels (columns) of y in
+    the basis of the canonical HRF and its derivatives (see
+    _hrf_basis_lstsq), theta being the delta of the closest scaled HRF (on
+    a 0.01 grid).
+    """
+    (lower, upper), = ([(MIN_DELTA + 1.0e-1, MAX_DELTA - 1.0e-1)]
+                       if bounds is None else bounds)
+    hrfs, _, J = _hrf_basis_lstsq(z, y, t_r, dur)
+
+    grid = np.linspace(lower, upper, int(round((upper - lower) / 1.0e-2)) + 1)
+    bank, _ = spm_hrf_bank(grid, t_r=t_r, dur=dur, normalized_hrf=False)
+    dist = np.sum(np.square(bank), axis=1)[:, None] - 2.0 * bank.dot(hrfs)
+    theta = grid[np.argmin(dist, axis=0)]
+
+    return hrfs, theta, J
+
+
+def hrf_estim(z, y, t_r, dur, model='scaled', verbose=0):
+    """ HRF estimation (the time scaling parameter delta of the scaled SPM
+    HRF) given the bloc signal z and the observed BOLD signal y.
+
+    Parameters:
+    -----------
+    z : 1d np.ndarray or 2d np.ndarray,
+        the bloc signal, or the bloc signals of shape (n_scans, n_voxels).
+
+    y : 1d np.ndarray or 2d np.ndarray,
+        the observed BOLD signal, or the signals of shape (n_scans,
+        n_voxels), the voxels then sharing z if it is 1d.
+
+    t_r : float,
+        the TR.
+
+    dur : float,
+        the duration of the HRF.
+
+    model : str (default='scaled'),
+        'scaled' for the scaled SPM HRF (bounded nonlinear fit of delta) or
+        'basis' for the SPM HRF plus its first and second derivatives with
+        respect to delta (closed-form least squares, the amplitude of the
+        canonical HRF being fixed), faster but only accurate for a delta
+        close to 1.0.
+
+    verbose : int (default=0),
+        the verbosity level.
+
+    Results:
+    --------
+    h : 1d np.ndarray or 2d np.ndarray,
+        the estimated HRF, or HRFs of shape (n_taps, n_voxels).
+
+    theta : np.ndarray, only if y is 2d,
+        the estimated delta of each voxel.
+
+    J : list or 2d np.ndarray,
+        the cost-function evolution, of shape (n_iter, n_voxels) if y is
+        2d.
     """
+    if model not in ['scaled', 'basis']:
+        raise ValueError("model should be 'scaled' or 'basis', "
+                         "got {0}".format(model))
+    if model == 'basis':
+        if np.ndim(y) == 2:
+            hrfs, theta, J = _hrf_basis_fit(z, y, t_r, dur)
+            return hrfs, theta, J[None, :]
+        hrfs, _, J = _hrf_basis_fit(z, np.asarray(y)[:, None], t_r, dur)
+        return hrfs[:, 0], [J[0]]
+    if np.ndim(y) == 2:
+        return _hrf_estim_batch(z, y, t_r, dur, verbose=verbose)
+
+    from scipy.optimize import fmin_l_bfgs_b  # lazy: heavy import
+
     args = (z, y, t_r, dur)
     bounds = [(MIN_DELTA + 1.0e-1, MAX_DELTA - 1.0e-1)]
     f_cost = Tracker(hrf_fit_err, args, verbose)
@@ -239,56 +544,122 @@ def hrf_estim(z, y, t_r, dur, verbose=0):
     return h, J
 
 
-@numba.jit((numba.float64[:], numba.float64[:], numba.float64[:, :],
-            numba.float64, numba.int64, numba.boolean, numba.int64,
-            numba.float64),
-           cache=True, nopython=True)
-def _loops_deconv(y, diff_z, H, lbda, nb_iter, early_stopping, wind, tol):
-    """ Main loop for deconvolution.
+@jit([(numba.float64[::1], numba.float64[::1], numba.float64[:, ::1],
+       numba.float64, numba.float64, numba.int64, numba.boolean,
+       numba.int64, numba.float64),
+      (numba.float32[::1], numba.float32[::1], numba.float32[:, ::1],
+       numba.float64, numba.float64, numba.int64, numba.boolean,
+       numba.int64, numba.float64)],
+     cache=True, nopython=True, nogil=True)
+def _loops_deconv(A_t_y, diff_z, A_t_A, grad_lipschitz_cst, lbda, nb_iter,
+                  early_stopping, wind, tol):
+    """ Main loop for deconvolution, with A_t_A the normal matrix of the
+    'HRF convolution + integration' operator A, grad_lipschitz_cst the
+    constant of the gradient step (e.g. 0.9 times the largest eigenvalue of
+    A_t_A, as in deconv) and A_t_y the adjoint of A applied on the observed
+    signal.
+    diff_z is updated in-place, the number of iterations done is returned
+    along.
     """
-    L = np.tril(np.ones((len(y), len(y))), 0)
-    A = H.dot(L)
-    A_t_A = A.T.dot(A)
-    A_t_y = A.T.dot(y)
-    grad_lipschitz_cst = np.linalg.norm(A_t_A)
+    N = len(A_t_y)
     step = 1.0 / grad_lipschitz_cst
-    th = lbda / grad_lipschitz_cst
-    diff_z_old = np.zeros(len(y))
-    t = t_old = 1
+    th = np.full(1, lbda / grad_lipschitz_cst)
+    diff_z_2d = diff_z.reshape((N, 1))
+    A_t_y_2d = A_t_y.reshape((N, 1))
+    normal_z = np.empty(N, dtype=A_t_y.dtype)
+    grad_z = np.empty((N, 1), dtype=A_t_y.dtype)
+    crit = np.empty((3, 1))
+    t = t_old = 1.0
+    nb_iter_done = 0
 
     for j in range(nb_iter):
 
-        diff_z -= step * (A_t_A.dot(diff_z) - A_t_y)
-        diff_z = np.sign(diff_z) * np.maximum(np.abs(diff_z) - th, 0)
-
+        nb_iter_done += 1
+        np.dot(A_t_A, diff_z, normal_z)
         t = 0.5 * (1.0 + np.sqrt(1 + 4*t_old**2))
-        diff_z = diff_z + (t_old-1)/t * (diff_z - diff_z_old)
+        _prox_momentum_update(diff_z_2d, grad_z, normal_z.reshape((N, 1)),
+                              A_t_y_2d, step, th, (t_old-1)/t, crit)
 
         if early_stopping:
             if j > 2:
-                crit_num = np.linalg.norm(diff_z - diff_z_old)
-                crit_deno = np.linalg.norm(diff_z)
-                diff = crit_num / (crit_deno + 1.0e-10)
+                diff = np.sqrt(crit[0, 0]) / (np.sqrt(crit[1, 0]) + 1.0e-10)
                 if diff < tol:
                     break
 
         t_old = t
-        diff_z_old = diff_z
 
-    return diff_z
+    return diff_z, nb_iter_done
 
 
 def bd(y, t_r, lbda=1.0, theta_0=None, z_0=None, hrf_dur=20.0,  # noqa
        bounds=None, nb_iter=100, nb_sub_iter=1000, nb_last_iter=10000,
-       print_period=50, early_stopping=False, wind=4, tol=1.0e-12, verbose=0):
+       print_period=50, early_stopping=False, wind=4, tol=1.0e-12,
+       sub_tol=None, dtype=np.float64, model='scaled', profile=False,
+       verbose=0):
     """ BOLD blind deconvolution function based on a scaled HRF model and an
     blocs BOLD model.
+
+    Each of the nb_iter outer iterations runs a deconvolution step
+    (nb_sub_iter iterations, warm-started) then an HRF step, a last
+    deconvolution (nb_last_iter iterations) being run with the final HRF.
+    These budgets used to be ignored (each step ran nb_iter iterations): with
+    the defaults, a call with a small nb_iter is now several times slower,
+    lower nb_sub_iter and nb_last_iter for quick runs.
+
+    By default (sub_tol=None) the deconvolution steps are exact: they run
+    their whole budget, unless early_stopping. With sub_tol (e.g. 1.0e-2)
+    they are inexact: their tolerance (on the relative change of the
+    iterate) starts at sub_tol and tightens, down to tol, as the relative
+    change of theta between two outer iterations, so the early steps stop
+    after a few iterations. It is faster, but theta may then stall on a
+    poor HRF and reach a worse cost-function.
+
+    dtype (np.float32 or np.float64, default=np.float64) sets the precision
+    of the deconvolution steps, with float32 the estimated signals differ
+    from the float64 ones by up to 1.0e-3 (relative l2-norm), the HRF
+    estimation and the cost-function being still computed in float64.
+
+    model (str, default='scaled') sets the HRF step: 'scaled' fits the time
+    scaling parameter theta of the SPM HRF (L-BFGS-B), 'basis' takes one
+    closed-form (Gauss-Newton) step: the least-squares fit of the SPM HRF
+    at the current theta plus its derivative with respect to delta (see
+    hrf_estim), theta being moved by the coefficient of the derivative
+    (theta_0 being 1.0 by default). The HRF remains a scaled SPM HRF, so
+    its amplitude is not traded against the one of z. The bloc signal
+    absorbing most of an HRF mismatch, theta stays in the neighbourhood of
+    theta_0 (within a few percent): the basis model refines a theta_0 close
+    to the true delta (e.g. the canonical 1.0), it does not recover a
+    distant one.
+
+    The returned dict d holds the normalized cost-function ('J'), residual
+    ('r'), regularization ('g') evolutions and the estimated time scaling
+    parameter of the HRF ('theta').
+
+    profile (bool, default=False) adds d['profile'] to the returned dict: the
+    wall time per stage ('toeplitz' for the operator construction, 'deconv',
+    'hrf', 'cost' and 'total', in second), the counters ('op', 'adj' and
+    'normal' operator applications, 'hrf_eval' HRF cost evaluations) and,
+    per outer iteration, the number of deconvolution iterations
+    ('nb_inner_iter'), their tolerance ('sub_tol') and the number of HRF
+    cost evaluations ('nb_hrf_eval'). The
+    profile is also passed to the global hook (see
+    pybold.utils.set_profile_hook).
     """
+    from scipy.optimize import fmin_l_bfgs_b  # lazy: heavy import
+
+    if model not in ['scaled', 'basis']:
+        raise ValueError("model should be 'scaled' or 'basis', "
+                         "got {0}".format(model))
+    prof = get_profile(profile)
+
     # force cast for Numba
-    y = y.astype(np.float64)
+    dtype = check_dtype(dtype)
+    y = y.astype(dtype)
 
     # initialization
-    theta = MAX_DELTA if theta_0 is None else theta_0
+    if theta_0 is None:
+        theta_0 = 1.0 if model == 'basis' else MAX_DELTA
+    theta = theta_0
     h, _ = spm_hrf(theta, t_r, hrf_dur, False)
 
     if z_0 is None:
@@ -296,7 +667,7 @@ def bd(y, t_r, lbda=1.0, theta_0=None, z_0=None, hrf_dur=20.0,  # noqa
         z = np.zeros_like(y)
         x = np.zeros_like(y)
     else:
-        diff_z = np.append(0, z_0[1:] - z_0[:-1])
+        diff_z = np.append(0, z_0[1:] - z_0[:-1]).astype(dtype)
         z = z_0
         x = spectral_convolve(h, z)
 
@@ -316,27 +687,61 @@ def bd(y, t_r, lbda=1.0, theta_0=None, z_0=None, hrf_dur=20.0,  # noqa
         print("normalized global cost-function "
               "(init): {0:.6f}".format(d['J'][-1]))
 
+    # inexact deconvolution steps: early stopping on a scheduled tolerance
+    inner_early_stopping = early_stopping or sub_tol is not None
+    inner_tol = tol if sub_tol is None else max(tol, sub_tol)
+
     # main loop
     for idx in range(nb_iter):
 
         # deconvolution
-        H = toeplitz_from_kernel(h, dim_in=len(y), dim_out=len(y))
-        diff_z = _loops_deconv(y, diff_z, H, lbda, nb_iter, early_stopping,
-                               wind, tol)
-        z = np.cumsum(diff_z)
+        with prof.stage('toeplitz'):
+            H = ConvAndLinear(DiscretInteg(), h, dim_in=len(y),
+                              dim_out=len(y), dtype=dtype)
+            H_adj_y, A_t_A = H.adj(y), H.normal_matrix()
+            grad_lipschitz_cst = 0.9 * lipschitz_est(H)
+        with prof.stage('deconv'):
+            diff_z, nb_inner_iter = _loops_deconv(
+                                    H_adj_y, diff_z, A_t_A,
+                                    grad_lipschitz_cst, lbda, nb_sub_iter,
+                                    inner_early_stopping, wind, inner_tol)
+            z = np.cumsum(diff_z)
+        prof.count('adj')
+        prof.count('normal', nb_inner_iter)
+        prof.record('nb_inner_iter', nb_inner_iter)
+        prof.record('sub_tol', inner_tol)
 
         # hrf estimation
+        theta_old = float(np.ravel(theta)[0])
         args = (z, y, t_r, hrf_dur)
-        theta, _, _ = fmin_l_bfgs_b(
-                            func=hrf_fit_err, x0=theta, args=args,
-                            bounds=bounds, approx_grad=True, maxiter=999,
-                            pgtol=1.0e-12)
-        h, _ = spm_hrf(theta, t_r, hrf_dur, False)
-        x = spectral_convolve(h, z)
+        with prof.stage('hrf'):
+            if model == 'basis':
+                _, beta, _ = _hrf_basis_lstsq(z, y[:, None], t_r, hrf_dur,
+                                              delta_0=theta, n_derivatives=1)
+                theta = float(np.clip(theta + beta[0, 0], *bounds[0]))
+                h, _ = spm_hrf(theta, t_r, hrf_dur, False)
+                nb_hrf_eval = 1
+            else:
+                theta, _, info = fmin_l_bfgs_b(
+                                    func=hrf_fit_err, x0=theta, args=args,
+                                    bounds=bounds, approx_grad=True,
+                                    maxiter=999, pgtol=1.0e-12)
+                h, _ = spm_hrf(theta, t_r, hrf_dur, False)
+                nb_hrf_eval = info['funcalls']
+        prof.count('hrf_eval', nb_hrf_eval)
+        prof.record('nb_hrf_eval', nb_hrf_eval)
+
+        # tighten the deconvolution tolerance as theta converges
+        if sub_tol is not None:
+            d_theta = abs(float(np.ravel(theta)[0]) - theta_old) / theta_old
+            inner_tol = max(tol, 0.5 * inner_tol, min(inner_tol, d_theta))
 
         # cost function
-        r = np.sum(np.square(x - y))
-        g = np.sum(np.abs(diff_z))
+        with prof.stage('cost'):
+            x = spectral_convolve(h, z)
+            r = np.sum(np.square(x - y))
+            g = np.sum(np.abs(diff_z))
+        prof.count('op')
         d['J'].append((r + lbda * g) / j_0 + 1.0e-30)
         d['r'].append(r / r_0 + 1.0e-30)
         d['g'].append(g)
@@ -362,15 +767,28 @@ def bd(y, t_r, lbda=1.0, theta_0=None, z_0=None, hrf_dur=20.0,  # noqa
                     break
 
     # last (long) deconvolution
-    H = toeplitz_from_kernel(h, dim_in=len(y), dim_out=len(y))
-    diff_z = _loops_deconv(y, diff_z, H, lbda, nb_iter, early_stopping, wind,
-                           tol)
-    z = np.cumsum(diff_z)
-    x = spectral_convolve(h, z)
+    with prof.stage('toeplitz'):
+        H = ConvAndLinear(DiscretInteg(), h, dim_in=len(y), dim_out=len(y),
+                          dtype=dtype)
+        H_adj_y, A_t_A = H.adj(y), H.normal_matrix()
+        grad_lipschitz_cst = 0.9 * lipschitz_est(H)
+    with prof.stage('deconv'):
+        diff_z, nb_inner_iter = _loops_deconv(H_adj_y, diff_z, A_t_A,
+                                              grad_lipschitz_cst, lbda,
+                                              nb_last_iter,
+                                              inner_early_stopping, wind,
+                                              tol)
+        z = np.cumsum(diff_z)
+    prof.count('adj')
+    prof.count('normal', nb_inner_iter)
+    prof.record('nb_inner_iter', nb_inner_iter)
 
     # cost function
-    r = np.sum(np.square(x - y))
-    g = np.sum(np.abs(diff_z))
+    with prof.stage('cost'):
+        x = spectral_convolve(h, z)
+        r = np.sum(np.square(x - y))
+        g = np.sum(np.abs(diff_z))
+    prof.count('op')
     d['J'].append((r + lbda * g) / j_0)
     d['r'].append(r / r_0)
     d['g'].append(g)
@@ -378,5 +796,10 @@ def bd(y, t_r, lbda=1.0, theta_0=None, z_0=None, hrf_dur=20.0,  # noqa
     d['J'] = np.array(d['J'])
     d['r'] = np.array(d['r'])
     d['g'] = np.array(d['g'])
+    d['theta'] = float(np.ravel(theta)[0])
+
+    profile_ = prof.finish()
+    if profile:
+        d['profile'] = profile_
 
     return x, z, diff_z, h, d
@@ -0,0 +1,377 @@
+# coding: utf-8
+""" This module gathers the per-voxel caching of the results of deconv, bd
+and hrf_estim.
+
+The results are stored on disk, one file per call, under a key hashing the
+content of the arguments (the voxel signal bytes, the TR, the HRF or the
+initial theta, the solver settings) and the pybold version: re-running an
+analysis after changing some voxels or parameters only recomputes the
+changed calls. The least recently used results are evicted once the cache
+exceeds its size limit, down to a fraction of it so that the scan of the
+directory is amortized over many stored results.
+"""
+import os
+import pickle
+import hashlib
+import threading
+import numpy as np
+from .info import __version__
+from .utils import thread_map
+from .bold_signal import bd, deconv, hrf_estim
+
+
+def _update_hash(h, value):
+    """ Private helper to feed a (nested) argument to the hash h.
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update("array:{0}:{1}:".format(value.dtype.str,
+                                         value.shape).encode())
+        h.update(value.view(np.uint8).data)
+    elif isinstance(value, (list, tuple)):
+        h.update("{0}:{1}:".format(type(value).__name__,
+                                   len(value)).encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        h.update("dict:{0}:".format(len(value)).encode())
+        for name in sorted(value):
+            _update_hash(h, name)
+            _update_hash(h, value[name])
+    elif isinstance(value, type) or isinstance(value, np.dtype):
+        h.update("dtype:{0}:".format(np.dtype(value).str).encode())
+    elif isinstance(value, np.generic):
+        _update_hash(h, value.item())
+    else:
+        h.update("{0}:{1!r}:".format(type(value).__name__, value).encode())
+
+
+class ResultCache:
+    """ On-disk store of function results, keyed by the content of the
+    arguments, with a size limit and least recently used eviction.
+    Thread-safe, and safe with several processes sharing the directory (the
+    entries are written atomically).
+    """
+    def __init__(self, location, max_size=1.0e9, low_water=0.8):
+        """ ResultCache class.
+
+        Parameters:
+        -----------
+        location : str,
+            the cache directory, created if needed.
+
+        max_size : float (default=1.0e9),
+            the size limit (in bytes).
+
+        low_water : float (default=0.8),
+            the fraction of max_size down to which the least recently used
+            results are evicted once the size limit is exceeded.
+        """
+        if not 0.0 <= low_water <= 1.0:
+            raise ValueError("low_water should be in [0, 1],"
+                             " got {0}".format(low_water))
+        self.location = location
+        self.max_size = max_size
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        if not os.path.isdir(location):
+            os.makedirs(location)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        """ Private helper to list the entries: (filename, last access
+        time, size).
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.location):
+            for filename in filenames:
+                if not filename.endswith('.pkl'):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:  # evicted meanwhile
+                    continue
+                entries.append((filename, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _filename(self, key):
+        """ Private helper to return the file of the key.
+        """
+        return os.path.join(self.location, key[:2], key[2:] + '.pkl')
+
+    def key(self, func, *args, **kwargs):
+        """ Return the key of the call func(*args, **kwargs).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        _update_hash(h, [__version__, func.__module__, func.__name__])
+        _update_hash(h, list(args))
+        _update_hash(h, kwargs)
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Return the result stored under key, or None.
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(filename)  # least recently used order
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return result
+
+    def set(self, key, result):
+        """ Store result under key (replacing any stored one), then evict
+        the least recently used results if the size limit is exceeded.
+        """
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        tmp_filename = "{0}.{1}.{2}.tmp".format(filename, os.getpid(),
+                                                threading.get_ident())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_filename)
+        with self._lock:
+            try:
+                size -= os.path.getsize(filename)  # replaced entry
+            except OSError:
+                pass
+            os.replace(tmp_filename, filename)
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """ Private helper to remove the least recently used entries until
+        the cache fits in low_water * max_size.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for filename, _, size in entries:
+            if self._size <= self.low_water * self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self._size -= size
+
+    def size(self):
+        """ Return the size (in bytes) of the stored results.
+        """
+        with self._lock:
+            self._size = sum(size for _, _, size in self._entries())
+            return self._size
+
+    def clear(self):
+        """ Remove all the stored results.
+        """
+        with self._lock:
+            for filename, _, _ in self._entries():
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self._size = 0
+
+    def call(self, func, *args, **kwargs):
+        """ Return func(*args, **kwargs), from the cache if possible.
+        """
+        key = self.key(func, *args, **kwargs)
+        result = self.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            self.set(key, result)
+        return result
+
+
+def _trim_frozen(J):
+    """ Private helper to drop the trailing iterations of a cost-function
+    column of a batched deconv, in which the voxel was already frozen.
+    """
+    changed = np.flatnonzero(J[1:] != J[:-1])
+    return J[:changed[-1] + 2] if len(changed) else J[:1]
+
+
+def _deconv_column(y, t_r, hrf, **kwargs):
+    """ Private helper to deconvolve y as a column of a batch of signals
+    (see deconv), only returning x, z, diff_z and J. It keys the per-voxel
+    results of the batched deconvolution of cached_deconv, which differ from
+    deconv(y, ...) by the rounding errors of the batched products.
+    """
+    x, z, diff_z, J, _, _ = deconv(y[:, None], t_r, hrf, **kwargs)
+    return x[:, 0], z[:, 0], diff_z[:, 0], _trim_frozen(J[:, 0])
+
+
+def cached_deconv(Y, t_r, hrf, cache, n_jobs=1, **kwargs):
+    """ Deconvolve the voxels (columns) of Y given the HRF (see deconv), the
+    result of each voxel being cached: only the voxels not found in the
+    cache are deconvolved, at once if lbda is given, one by one otherwise
+    (the estimation of lbda stopping when all the voxels converged).
+
+    Parameters:
+    -----------
+    Y : 2d np.ndarray,
+        the observed BOLD signals, of shape (n_scans, n_voxels).
+
+    t_r : float,
+        the TR.
+
+    hrf : 1d np.ndarray,
+        the HRF.
+
+    cache : ResultCache,
+        the cache.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    kwargs : dict,
+        the other parameters of deconv.
+
+    Results:
+    --------
+    x : 2d np.ndarray,
+        the estimated convolved signals.
+
+    z : 2d np.ndarray,
+        the estimated bloc signals.
+
+    diff_z : 2d np.ndarray,
+        the estimated spike signals.
+
+    J : list,
+        the cost-function evolution of each voxel.
+    """
+    Y = np.asarray(Y)
+    n_voxels = Y.shape[1]
+    # the result of each voxel is keyed as deconv(Y[:, v], ..., lbda[v]),
+    # or as a column of a batch if lbda is given (see _deconv_column)
+    lbda = kwargs.get('lbda')
+    if lbda is not None:
+        lbda = np.broadcast_to(np.asarray(lbda, dtype=np.float64),
+                               (n_voxels,))
+    kwargs_v = [kwargs if lbda is None else dict(kwargs, lbda=float(lbda[v]))
+                for v in range(n_voxels)]
+    func = deconv if lbda is None else _deconv_column
+    keys = [cache.key(func, Y[:, v], t_r, hrf, **kwargs_v[v])
+            for v in range(n_voxels)]
+    res = [cache.get(key) for key in keys]
+    missing = [v for v, r in enumerate(res) if r is None]
+
+    if missing and lbda is not None:
+        x, z, diff_z, J, _, _ = deconv(Y[:, missing], t_r, hrf,
+                                       **dict(kwargs, lbda=lbda[missing]))
+        for idx, v in enumerate(missing):
+            res[v] = (x[:, idx], z[:, idx], diff_z[:, idx],
+                      _trim_frozen(J[:, idx]))
+            cache.set(keys[v], res[v])
+    elif missing:
+        def _deconv_voxel(v):
+            return cache.call(deconv, Y[:, v], t_r, hrf, **kwargs_v[v])
+        for v, r in zip(missing, thread_map(_deconv_voxel, missing,
+                                            n_jobs=n_jobs)):
+            res[v] = r
+
+    x = np.vstack([r[0] for r in res]).T
+    z = np.vstack([r[1] for r in res]).T
+    diff_z = np.vstack([r[2] for r in res]).T
+
+    return x, z, diff_z, [r[3] for r in res]
+
+
+def cached_bd(Y, t_r, cache, n_jobs=1, **kwargs):
+    """ Blind deconvolution of each voxel (column) of Y (see bd), the result
+    of each voxel being cached.
+
+    Parameters:
+    -----------
+    Y : 2d np.ndarray,
+        the observed BOLD signals, of shape (n_scans, n_voxels).
+
+    t_r : float,
+        the TR.
+
+    cache : ResultCache,
+        the cache.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    kwargs : dict,
+        the other parameters of bd.
+
+    Results:
+    --------
+    x : 2d np.ndarray,
+        the estimated convolved signals.
+
+    z : 2d np.ndarray,
+        the estimated bloc signals.
+
+    diff_z : 2d np.ndarray,
+        the estimated spike signals.
+
+    hrfs : 2d np.ndarray,
+        the estimated HRFs, of shape (n_taps, n_voxels).
+
+    d : list of dict,
+        the cost-function evolutions of each voxel.
+    """
+    Y = np.asarray(Y)
+
+    def _bd_voxel(v):
+        return cache.call(bd, Y[:, v], t_r, **kwargs)
+
+    res = thread_map(_bd_voxel, range(Y.shape[1]), n_jobs=n_jobs)
+    x = np.vstack([r[0] for r in res]).T
+    z = np.vstack([r[1] for r in res]).T
+    diff_z = np.vstack([r[2] for r in res]).T
+    hrfs = np.vstack([r[3] for r in res]).T
+
+    return x, z, diff_z, hrfs, [r[4] for r in res]
+
+
+def cached_hrf_estim(Z, Y, t_r, dur, cache, n_jobs=1):
+    """ HRF estimation of each voxel (column) of Y given its bloc signal
+    (column of Z) (see hrf_estim), the result of each voxel being cached.
+
+    Parameters:
+    -----------
+    Z : 2d np.ndarray,
+        the bloc signals, of shape (n_scans, n_voxels).
+
+    Y : 2d np.ndarray,
+        the observed BOLD signals, of shape (n_scans, n_voxels).
+
+    t_r : float,
+        the TR.
+
+    dur : float,
+        the duration of the HRFs.
+
+    cache : ResultCache,
+        the cache.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    Results:
+    --------
+    hrfs : 2d np.ndarray,
+        the estimated HRFs, of shape (n_taps, n_voxels).
+
+    J : list,
+        the cost-function evolution of each voxel.
+    """
+    Z, Y = np.asarray(Z), np.asarray(Y)
+
+    def _hrf_estim_voxel(v):
+        return cache.call(hrf_estim, Z[:, v], Y[:, v], t_r, dur)
+
+    res = thread_map(_hrf_estim_voxel, range(Y.shape[1]), n_jobs=n_jobs)
+
+    return np.vstack([r[0] for r in res]).T, [r[1] for r in res]
@@ -0,0 +1,308 @@
+# coding: utf-8
+""" This module gathers the command-line entry points of the batch
+deconvolution of a voxel matrix stored in a .npy file, on one host
+(pybold-run) or on several hosts sharing a filesystem (pybold-shard):
+
+    pybold-run deconv --input y.npy --output-dir out --t-r 2.0 --n-jobs 4
+    pybold-run bd --config bd.json --dtype float32
+    pybold-run hrf-estim --input y.npy --z z.npy --output-dir out --t-r 2.0
+
+    pybold-shard split bd --config bd.json --output-dir shards
+    pybold-shard work shards --n-jobs 8  # on each host
+    pybold-shard reduce shards --output-dir out
+
+The solver parameters are given in a JSON config file (the 'params'
+entry, the other entries being the command-line options, e.g. 'input' or
+'n_jobs'), the command-line options overriding it. The outputs are written
+by chunks in memory-mapped .npy files (see driver.run), along with a timing
+report (timing.json). numpy and the solvers are imported after the parsing
+of the command-line, to keep 'pybold-run --help' fast.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+SOLVERS = {'bd': 'bd', 'deconv': 'deconv', 'hrf-estim': 'hrf_estim'}
+TIMING = 'timing.json'
+
+
+def _add_run_arguments(parser, execution=True):
+    """ Private helper to add the solver and the data options to parser, and
+    the execution ones if execution is True.
+    """
+    parser.add_argument('solver', choices=sorted(SOLVERS),
+                        help="the solver: blind deconvolution (bd), "
+                             "deconvolution with a given HRF (deconv) or HRF "
+                             "estimation with given bloc signals "
+                             "(hrf-estim)")
+    parser.add_argument('--config', default=None,
+                        help="JSON config file, the 'params' entry being the "
+                             "solver parameters (e.g. lbda, nb_iter), the "
+                             "other entries the options below (e.g. "
+                             "'input', 't_r')")
+    parser.add_argument('--input', default=None,
+                        help=".npy file of the voxel matrix")
+    parser.add_argument('--output-dir', default=None,
+                        help="output directory (resumed if it holds the "
+                             "manifest of the same run)")
+    parser.add_argument('--t-r', type=float, default=None, help="the TR")
+    parser.add_argument('--hrf', default=None,
+                        help=".npy file of the HRF (deconv), the canonical "
+                             "HRF by default")
+    parser.add_argument('--z', default=None,
+                        help=".npy file of the bloc signal(s) (hrf-estim), "
+                             "1d (shared) or (n_scans, n_voxels)")
+    parser.add_argument('--dtype', choices=['float32', 'float64'],
+                        default=None,
+                        help="compute precision (default=float64)")
+    parser.add_argument('--backend', choices=['toeplitz', 'fourier'],
+                        default=None,
+                        help="convolution operator of deconv: dense "
+                             "Toeplitz (default) or Fourier (long signals)")
+    if execution:
+        _add_execution_arguments(parser)
+        parser.add_argument('--mem-budget', type=float, default=None,
+                            help="memory budget in bytes (e.g. 4e9)")
+        parser.add_argument('--no-resume', action='store_true',
+                            help="restart the run even if a manifest "
+                                 "exists")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="verbosity level")
+
+
+def _add_execution_arguments(parser):
+    """ Private helper to add the threads and chunks options to parser.
+    """
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help="number of threads (default=1, -1 for all the "
+                             "CPUs)")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="number of voxels per chunk (default=128)")
+
+
+def _build_parser():
+    """ Private helper to build the command-line parser of pybold-run.
+    """
+    parser = argparse.ArgumentParser(
+                prog='pybold-run',
+                description="Batch deconvolution of the voxels (columns) of "
+                            "a (n_scans, n_voxels) matrix stored in a .npy "
+                            "file.")
+    _add_run_arguments(parser)
+    return parser
+
+
+def _build_shard_parser():
+    """ Private helper to build the command-line parser of pybold-shard.
+    """
+    parser = argparse.ArgumentParser(
+                prog='pybold-shard',
+                description="Batch deconvolution of the voxels (columns) of "
+                            "a (n_scans, n_voxels) matrix stored in a .npy "
+                            "file by independent workers on several hosts "
+                            "sharing a filesystem.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    split = subparsers.add_parser(
+                'split', help="split the voxels into shards, described by "
+                              "the manifest of the shard directory "
+                              "(--output-dir)")
+    _add_run_arguments(split, execution=False)
+    split.add_argument('--shard-size', type=int, default=1024,
+                       help="number of voxels per shard (default=1024)")
+    work = subparsers.add_parser(
+                'work', help="claim and process the shards until none is "
+                             "left")
+    work.add_argument('shard_dir', help="the shard directory")
+    _add_execution_arguments(work)
+    work.add_argument('--max-shards', type=int, default=None,
+                      help="maximum number of shards processed")
+    work.add_argument('--stale-timeout', type=float, default=None,
+                      help="age (in seconds) from which the lock of a shard "
+                           "is considered as left by a dead worker")
+    work.add_argument('-v', '--verbose', action='count', default=0,
+                      help="verbosity level")
+    reduce = subparsers.add_parser(
+                'reduce', help="merge the outputs of the shards")
+    reduce.add_argument('shard_dir', help="the shard directory")
+    reduce.add_argument('--output-dir', default=None,
+                        help="output directory (default=the shard "
+                             "directory)")
+    return parser
+
+
+def _load_config(args):
+    """ Private helper to merge the config file and the command-line
+    options (the latter taking precedence).
+    """
+    config = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+    params = dict(config.pop('params', {}))
+    options = {'n_jobs': 1, 'chunk_size': 128, 'resume': True}
+    options.update(config)
+    for name in ['input', 'output_dir', 't_r', 'hrf', 'z', 'n_jobs',
+                 'chunk_size', 'mem_budget']:
+        value = getattr(args, name, None)
+        if value is not None:
+            options[name] = value
+    if getattr(args, 'no_resume', False):
+        options['resume'] = False
+    if args.dtype is not None:
+        params['dtype'] = args.dtype
+    if args.backend is not None:
+        params['spectral_conv'] = args.backend == 'fourier'
+    for name in ['input', 'output_dir', 't_r']:
+        if options.get(name) is None:
+            raise ValueError("'{0}' should be given in the command-line or "
+                             "in the config file".format(name))
+    return options, params
+
+
+def _load_arrays(parser, solver, options, params):
+    """ Private helper to return the HRF (deconv) and the bloc signals
+    (hrf_estim) of the options, a .npy file being kept as is for z.
+    """
+    import numpy as np  # lazy: fast command-line parsing
+    from .hrf_model import spm_hrf
+
+    hrf, z = options.get('hrf'), options.get('z')
+    if solver == 'deconv':
+        if isinstance(hrf, str):
+            hrf = np.load(hrf)
+        elif hrf is not None:
+            hrf = np.asarray(hrf, dtype=np.float64)
+        else:
+            hrf = spm_hrf(1.0, t_r=options['t_r'],
+                          dur=params.get('hrf_dur', 20.0))[0]
+    elif solver == 'hrf_estim' and z is None:
+        parser.error("the bloc signals (--z) should be given for hrf-estim")
+    elif solver == 'hrf_estim' and not isinstance(z, str):
+        z = np.asarray(z, dtype=np.float64)
+    return (hrf if solver == 'deconv' else None,
+            z if solver == 'hrf_estim' else None)
+
+
+def _parse_run_arguments(parser, args):
+    """ Private helper to return the solver, the options, the solver
+    parameters, the HRF and the bloc signals of the command-line.
+    """
+    solver = SOLVERS[args.solver]
+    try:
+        options, params = _load_config(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if 'spectral_conv' in params and solver != 'deconv':
+        parser.error("--backend is only available for deconv")
+    hrf, z = _load_arrays(parser, solver, options, params)
+    return solver, options, params, hrf, z
+
+
+def main(argv=None):
+    """ Entry point of pybold-run.
+
+    Parameters:
+    -----------
+    argv : list of str or None (default=None),
+        the command-line arguments, sys.argv[1:] if None.
+
+    Results:
+    --------
+    status : int,
+        the exit status.
+    """
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    solver, options, params, hrf, z = _parse_run_arguments(parser, args)
+
+    import numpy as np  # lazy: fast command-line parsing
+    from .driver import run
+    from .utils import ProfileAggregator, set_profile_hook
+
+    mem_budget = options.get('mem_budget')
+
+    aggregator = ProfileAggregator()
+    old_hook = set_profile_hook(aggregator)
+    t0 = time.time()
+    try:
+        filenames = run(options['input'], options['output_dir'],
+                        options['t_r'], solver=solver,
+                        hrf=hrf, z=z,
+                        chunk_size=int(options['chunk_size']),
+                        n_jobs=int(options['n_jobs']),
+                        mem_budget=(int(mem_budget) if mem_budget is not None
+                                    else None),
+                        resume=options['resume'], verbose=args.verbose,
+                        **params)
+    finally:
+        set_profile_hook(old_hook)
+    wall_time = time.time() - t0
+
+    n_voxels = np.load(options['input'], mmap_mode='r').shape[1]
+    timing = {'solver': solver, 'n_voxels': n_voxels,
+              'wall_time': wall_time,
+              'voxels_per_second': n_voxels / max(wall_time, 1.0e-12),
+              'profile': aggregator.summary()}
+    with open(os.path.join(options['output_dir'], TIMING), 'w') as f:
+        json.dump(timing, f, indent=2, sort_keys=True)
+
+    if args.verbose > 0:
+        print("{0}: {1} voxels in {2:.2f}s ({3:.1f} voxels/s), outputs: "
+              "{4}".format(args.solver, n_voxels, wall_time,
+                           timing['voxels_per_second'],
+                           ", ".join(sorted(filenames.values()))))
+
+    return 0
+
+
+def shard_main(argv=None):
+    """ Entry point of pybold-shard.
+
+    Parameters:
+    -----------
+    argv : list of str or None (default=None),
+        the command-line arguments, sys.argv[1:] if None.
+
+    Results:
+    --------
+    status : int,
+        the exit status.
+    """
+    parser = _build_shard_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'split':
+        solver, options, params, hrf, z = _parse_run_arguments(parser, args)
+        from .sharding import make_shards, load_shards
+        make_shards(options['input'], options['output_dir'], options['t_r'],
+                    solver=solver, hrf=hrf, z=z, shard_size=args.shard_size,
+                    **params)
+        if args.verbose > 0:
+            print("{0} shards in {1}".format(
+                  len(load_shards(options['output_dir'])['shards']),
+                  options['output_dir']))
+    elif args.command == 'work':
+        from .sharding import run_worker
+        run_worker(args.shard_dir,
+                   n_jobs=1 if args.n_jobs is None else args.n_jobs,
+                   chunk_size=(128 if args.chunk_size is None
+                               else args.chunk_size),
+                   max_shards=args.max_shards,
+                   stale_timeout=args.stale_timeout, verbose=args.verbose)
+    else:
+        from .sharding import reduce_shards
+        try:
+            reduce_shards(args.shard_dir, output_dir=args.output_dir)
+        except RuntimeError as e:
+            print("pybold-shard: {0}".format(e), file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
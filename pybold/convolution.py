@@ -2,107 +2,147 @@
 """ This module gathers convolution functions.
 """
 import numpy as np
+import numba
 from numpy.fft import rfft, irfft
 from .padding import custom_padd, unpadd
+from .utils import check_dtype
+from .jit import jit
 
 
-def spectral_convolve(k, x):
+def _along_axis(a, ndim, axis):
+    """ Private helper to reshape the 1d array a to broadcast it along axis of
+    an array with ndim dimensions.
+    """
+    shape = [1] * ndim
+    shape[axis] = -1
+    return a.reshape(shape)
+
+
+def spectral_convolve(k, x, axis=-1, dtype=np.float64):
     """ Return k.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel.
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
-    x, p = custom_padd(x)
-    N = len(x)
-    fft_k = rfft(k, n=N, norm=None)
-    padded_h_conv_x = irfft(fft_k * rfft(x,  n=N, norm=None), norm=None)
-    k_conv_x = unpadd(padded_h_conv_x, p)
+    dtype = check_dtype(dtype)
+    k = np.asarray(k, dtype=dtype)
+    x, p = custom_padd(np.asarray(x, dtype=dtype), axis=axis)
+    N = x.shape[axis]
+    fft_k = _along_axis(rfft(k, n=N, norm=None), x.ndim, axis)
+    fft_x = rfft(x, n=N, axis=axis, norm=None)
+    padded_k_conv_x = irfft(fft_k * fft_x, n=N, axis=axis, norm=None)
+    k_conv_x = unpadd(padded_k_conv_x, p, axis=axis)
 
-    return k_conv_x
+    return k_conv_x.astype(dtype, copy=False)
 
 
-def spectral_retro_convolve(k, x):
+def spectral_retro_convolve(k, x, axis=-1, dtype=np.float64):
     """ Return k_t.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel.
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
-    x, p = custom_padd(x)
-    N = len(x)
-    fft_k = rfft(k, n=N, norm=None).conj()
-    padded_k_conv_x = irfft(fft_k * rfft(x,  n=N, norm=None), norm=None)
-    k_conv_x = unpadd(padded_k_conv_x, p)
+    dtype = check_dtype(dtype)
+    k = np.asarray(k, dtype=dtype)
+    x, p = custom_padd(np.asarray(x, dtype=dtype), axis=axis)
+    N = x.shape[axis]
+    fft_k = _along_axis(rfft(k, n=N, norm=None).conj(), x.ndim, axis)
+    fft_x = rfft(x, n=N, axis=axis, norm=None)
+    padded_k_conv_x = irfft(fft_k * fft_x, n=N, axis=axis, norm=None)
+    k_conv_x = unpadd(padded_k_conv_x, p, axis=axis)
 
-    return k_conv_x
+    return k_conv_x.astype(dtype, copy=False)
 
 
-def spectral_deconvolve(k, x):
+def spectral_deconvolve(k, x, axis=-1, dtype=np.float64):
     """ Return k.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel.
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
-    x, p = custom_padd(x)
-    N = len(x)
-    fft_k = 1.0 / rfft(k, n=N, norm=None)
-    padded_h_conv_x = irfft(fft_k * rfft(x,  n=N, norm=None), norm=None)
-    k_conv_x = unpadd(padded_h_conv_x, p)
+    dtype = check_dtype(dtype)
+    k = np.asarray(k, dtype=dtype)
+    x, p = custom_padd(np.asarray(x, dtype=dtype), axis=axis)
+    N = x.shape[axis]
+    fft_k = _along_axis(1.0 / rfft(k, n=N, norm=None), x.ndim, axis)
+    fft_x = rfft(x, n=N, axis=axis, norm=None)
+    padded_k_conv_x = irfft(fft_k * fft_x, n=N, axis=axis, norm=None)
+    k_conv_x = unpadd(padded_k_conv_x, p, axis=axis)
 
-    return k_conv_x
+    return k_conv_x.astype(dtype, copy=False)
 
 
-def spectral_retro_deconvolve(k, x):
+def spectral_retro_deconvolve(k, x, axis=-1, dtype=np.float64):
     """ Return k.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel.
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
-    x, p = custom_padd(x)
-    N = len(x)
-    fft_k = (1.0 / rfft(k, n=N, norm=None)).conj()
-    padded_h_conv_x = irfft(fft_k * rfft(x,  n=N, norm=None), norm=None)
-    k_conv_x = unpadd(padded_h_conv_x, p)
+    dtype = check_dtype(dtype)
+    k = np.asarray(k, dtype=dtype)
+    x, p = custom_padd(np.asarray(x, dtype=dtype), axis=axis)
+    N = x.shape[axis]
+    fft_k = _along_axis((1.0 / rfft(k, n=N, norm=None)).conj(), x.ndim, axis)
+    fft_x = rfft(x, n=N, axis=axis, norm=None)
+    padded_k_conv_x = irfft(fft_k * fft_x, n=N, axis=axis, norm=None)
+    k_conv_x = unpadd(padded_k_conv_x, p, axis=axis)
 
-    return k_conv_x
+    return k_conv_x.astype(dtype, copy=False)
 
 
-def toeplitz_from_kernel(k, dim_in, dim_out=None):
+def toeplitz_from_kernel(k, dim_in, dim_out=None, dtype=np.float64):
     """ Return the Toeplitz matrix that correspond to k.conv(.).
 
     Parameters:
@@ -114,6 +154,8 @@ def toeplitz_from_kernel(k, dim_in, dim_out=None):
     dim_out : int (default None),
         dimension of the ouput vector (dim of y in y = in k.conv(x)). If None
         dim_out = dim_in.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the dtype of the matrix.
 
     Results:
     --------
@@ -124,7 +166,7 @@ def toeplitz_from_kernel(k, dim_in, dim_out=None):
         dim_out = dim_in
 
     padded_k = np.hstack([np.zeros(dim_in), np.flipud(k), np.zeros(dim_in)])
-    K = np.empty((dim_out, dim_in))
+    K = np.empty((dim_out, dim_in), dtype=check_dtype(dtype))
     for i in range(dim_out):
         start_idx = (dim_in + len(k) - 1) - i
         K[i, :] = padded_k[start_idx: start_idx + dim_in]
@@ -132,65 +174,116 @@ def toeplitz_from_kernel(k, dim_in, dim_out=None):
     return K
 
 
-def simple_convolve(k, x, dim_out=None):
+@jit([(numba.float64[:], numba.float64[:, :], numba.int64),
+      (numba.float32[:], numba.float32[:, :], numba.int64)],
+     cache=True, nopython=True, nogil=True)
+def _direct_convolve(k, x, dim_out):
+    """ Private helper for simple_convolve: row-wise direct convolution of the
+    2d array x (n_signals, dim_in) with k, only summing over the support of k.
+    """
+    n_signals, dim_in = x.shape
+    len_k = len(k)
+    k_conv_x = np.zeros((n_signals, dim_out), dtype=x.dtype)
+    for n in range(n_signals):
+        for i in range(dim_out):
+            j_min = max(0, i - len_k + 1)
+            j_max = min(dim_in, i + 1)
+            acc = 0.0
+            for j in range(j_min, j_max):
+                acc += k[i - j] * x[n, j]
+            k_conv_x[n, i] = acc
+    return k_conv_x
+
+
+@jit([(numba.float64[:], numba.float64[:, :], numba.int64),
+      (numba.float32[:], numba.float32[:, :], numba.int64)],
+     cache=True, nopython=True, nogil=True)
+def _direct_retro_convolve(k, x, dim_out):
+    """ Private helper for simple_retro_convolve: row-wise direct adjoint
+    convolution of the 2d array x (n_signals, dim_in) with k, only summing
+    over the support of k.
+    """
+    n_signals, dim_in = x.shape
+    len_k = len(k)
+    k_conv_x = np.zeros((n_signals, dim_out), dtype=x.dtype)
+    for n in range(n_signals):
+        for i in range(dim_out):
+            j_max = min(dim_in, i + len_k)
+            acc = 0.0
+            for j in range(i, j_max):
+                acc += k[j - i] * x[n, j]
+            k_conv_x[n, i] = acc
+    return k_conv_x
+
+
+def _apply_along_time(func, k, x, dim_out, axis, dtype):
+    """ Private helper to apply a row-wise 2d kernel on a 1d or nd array
+    along the given axis.
+    """
+    dtype = check_dtype(dtype)
+    k = np.ascontiguousarray(k, dtype=dtype)
+    x = np.asarray(x, dtype=dtype)
+    if x.ndim == 1:
+        return func(k, np.ascontiguousarray(x[None, :]), dim_out)[0]
+    x = np.moveaxis(x, axis, -1)
+    batch_shape = x.shape[:-1]
+    x = np.ascontiguousarray(x.reshape(-1, x.shape[-1]))
+    k_conv_x = func(k, x, dim_out).reshape(batch_shape + (dim_out,))
+    return np.moveaxis(k_conv_x, -1, axis)
+
+
+def simple_convolve(k, x, dim_out=None, axis=-1, dtype=np.float64):
     """ Return k.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel.
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
     dim_out : int (default None),
         dimension of the ouput vector (dim of y in y = in k.conv(x)). If None
         d = len(x).
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
     if dim_out is None:
-        dim_out = len(x)
-    dim_in = len(x)
+        dim_out = np.shape(x)[axis]
 
-    padded_k = np.hstack([np.zeros(dim_in), np.flipud(k), np.zeros(dim_in)])
-    k_conv_x = np.empty(dim_out)
+    return _apply_along_time(_direct_convolve, k, x, dim_out, axis, dtype)
 
-    for i in range(dim_out):
-        start_idx = (dim_in + len(k) - 1) - i
-        k_conv_x[i] = (padded_k[start_idx: start_idx + dim_in] * x).sum()
 
-    return k_conv_x
-
-
-def simple_retro_convolve(k, x, dim_out=None):
+def simple_retro_convolve(k, x, dim_out=None, axis=-1, dtype=np.float64):
     """ Return k_t.conv(x).
 
     Parameters:
     -----------
     k : 1d np.ndarray,
         kernel
-    x : 1d np.ndarray,
-        signal.
+    x : 1d or nd np.ndarray,
+        signal, or batch of signals convolved along axis.
     dim_out : int (default None),
         dimension of the ouput vector (dim of y in y = in k.conv(x)). If None
         d = len(x).
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the compute precision.
 
     Results:
     --------
-    k_conv_x : 1d np.ndarray,
-        the convolved signal.
+    k_conv_x : 1d or nd np.ndarray,
+        the convolved signal(s).
     """
     if dim_out is None:
-        dim_out = len(x)
-    dim_in = len(x)
-
-    padded_k = np.hstack([np.zeros(dim_out - 1), k, np.zeros(dim_out - 1)])
-    k_conv_x = np.empty(dim_out)
+        dim_out = np.shape(x)[axis]
 
-    for i in range(dim_out):
-        start_idx = dim_out - 1 - i
-        k_conv_x[i] = (padded_k[start_idx: start_idx + dim_in] * x).sum()
-
-    return k_conv_x
+    return _apply_along_time(_direct_retro_convolve, k, x, dim_out, axis,
+                             dtype)
@@ -1,10 +1,18 @@
 # coding: utf-8
 """ This module gathers usefull data generation.
 """
+import os
 import numpy as np
-from .utils import random_generator
+from numpy.fft import rfft, irfft
+from .utils import random_generator, chunk_slices, thread_map
 from .convolution import simple_convolve
-from .hrf_model import spm_hrf
+from .hrf_model import spm_hrf, spm_hrf_bank, MIN_DELTA, MAX_DELTA
+
+
+# number of voxels generated from the same seed by gen_cohort
+_SEED_BLOCK = 256
+# the arrays written by gen_cohort
+COHORT_FILES = ['noisy_ar_s', 'ar_s', 'ai_s', 'hrfs']
 
 
 def gen_regular_ai_s(dur=10, tr=1.0, dur_bloc=30.0, centered=True):
@@ -30,7 +38,7 @@ def gen_regular_bloc_bold(dur=10, tr=1.0, dur_bloc=30.0, hrf=None, snr=1.0,
     """
     ai_s, i_s, t = gen_regular_ai_s(dur=dur, tr=tr, dur_bloc=dur_bloc)
 
-    hrf = spm_hrf(tr=tr, delta=1.0)[0] if hrf is None else hrf
+    hrf = spm_hrf(t_r=tr, delta=1.0)[0] if hrf is None else hrf
     ar_s = simple_convolve(hrf, ai_s)
 
     noisy_ar_s, noise = add_gaussian_noise(ar_s, snr=snr,
@@ -240,6 +248,148 @@ def gen_rnd_ai_s(dur=3, tr=1.0, nb_events=4, avg_dur=5, std_dur=1,
                        "function with possibly new arguments.")
 
 
+def _rnd_blocks(r, n, nb_events, n_fine, avg_dur, std_dur, nb_try_duration):
+    """ Private helper to draw the on-sets and the durations (in number of
+    fine samples) of the blocks of n signals.
+    """
+    offsets = r.integers(0, n_fine, size=(n, nb_events))
+    durations = avg_dur + std_dur * r.standard_normal((n, nb_events))
+    for _ in range(nb_try_duration):
+        redraw = np.any(durations < 1, axis=1)
+        if not redraw.any():
+            break
+        # null or negative duration events: retry
+        durations[redraw] = avg_dur + std_dur * r.standard_normal(
+                                                (redraw.sum(), nb_events))
+    return offsets, durations.astype(int)
+
+
+def gen_rnd_ai_s_batch(n_voxels, dur=3, tr=1.0, nb_events=4, avg_dur=5,
+                       std_dur=1, overlapping=False, unitary_block=False,
+                       random_state=None, nb_try=1000, nb_try_duration=1000,
+                       centered=False):
+    """ Generate n_voxels Activity inducing signals at once, with the same
+    distribution as gen_rnd_ai_s (without middle_spike).
+
+    The on-sets and the durations of the blocks are drawn on the 1ms grid of
+    gen_rnd_ai_s but the blocks are directly sampled at 1/TR: the block
+    [offset, offset + duration[ covers the scans k such that
+    offset <= k * TR < offset + duration. The rejected signals (overlapping
+    blocks or blocks erased by the sampling) are re-drawn together.
+
+    Parameters:
+    -----------
+    n_voxels : int,
+        the number of signals.
+
+    dur : int (default=3),
+        The length of the BOLD signal (in minutes).
+
+    tr : float (default=1.0),
+        Repetition time
+
+    nb_events : int (default=4),
+        Number of neural activity on-sets.
+
+    avg_dur : int (default=5),
+        The average duration (in second) of neural activity on-sets.
+
+    std_dur : int (default=1),
+        The standard deviation parameter (in second) on the duration of
+        neural activity on-sets, as in gen_rnd_ai_s the durations standard
+        deviation is std_dur**2.
+
+    overlapping : bool (default=False),
+        Whether to authorize overlapping between on-sets.
+
+    unitary_block : bool (default=False),
+        force the block to have unitary amplitude.
+
+    random_state : int, None, np.random.SeedSequence or np.random.Generator
+        (default=None),
+        Whether to impose a seed on the random generation or not (for
+        reproductability).
+
+    nb_try : int (default=1000),
+        Number of try to generate the signals.
+
+    nb_try_duration : int (default=1000),
+        Number of try to generate the durations of the on-sets.
+
+    centered : bool (default=False),
+        Whether to center the signals.
+
+    Results:
+    --------
+    ai_s : 2d np.ndarray,
+        Activity inducing signals, of shape (n_voxels, n_scans).
+
+    i_s : 2d np.ndarray,
+        Innovation signals, of shape (n_voxels, n_scans).
+
+    t : np.ndarray,
+        time scale signal.
+    """
+    dt = 0.001  # on-sets and durations grid, as in gen_rnd_ai_s
+    n_fine = int((dur * 60) / dt)
+    step = int(tr / dt)
+    N = len(range(0, n_fine, step))
+
+    r = np.random.default_rng(random_state)
+
+    ai_s = np.empty((n_voxels, N))
+    todo = np.arange(n_voxels)
+    for _ in range(nb_try):
+        n = len(todo)
+        offsets, durations = _rnd_blocks(r, n, nb_events, n_fine,
+                                         avg_dur / dt, std_dur**2 / dt,
+                                         nb_try_duration)
+        ends = np.minimum(offsets + durations, n_fine)
+
+        # place the blocks, sampled at 1/TR, with a difference array
+        starts_idx = -(-offsets // step)
+        ends_idx = -(-ends // step)
+        rows = np.repeat(np.arange(n), nb_events)
+        edges = np.zeros((n, N + 1))
+        np.add.at(edges, (rows, starts_idx.ravel()), 1.0)
+        np.add.at(edges, (rows, ends_idx.ravel()), -1.0)
+        ai_s_ = np.cumsum(edges[:, :-1], axis=1)
+
+        if overlapping:
+            valid = np.ones(n, dtype=bool)
+            if unitary_block:
+                ai_s_[ai_s_ > 1] = 1  # normalized overlapping ai_s
+        else:
+            # overlapping events on the 1ms grid
+            order = np.argsort(offsets, axis=1)
+            s_offsets = np.take_along_axis(offsets, order, axis=1)
+            s_ends = np.take_along_axis(ends, order, axis=1)
+            valid = np.all(s_offsets[:, 1:] >= s_ends[:, :-1], axis=1)
+            # decimation step erase an event
+            nb_rises = (np.diff(ai_s_, axis=1) > 0.5).sum(axis=1)
+            valid &= (nb_rises == nb_events)
+
+        ai_s[todo[valid]] = ai_s_[valid]
+        todo = todo[~valid]
+        if not len(todo):
+            break
+    else:
+        raise RuntimeError("[Failure] Failed to produce an "
+                           "activity-inducing signal, please re-run "
+                           "gen_rnd_ai_s_batch function with possibly new "
+                           "arguments.")
+
+    i_s = np.zeros_like(ai_s)
+    i_s[:, 1:] = np.diff(ai_s, axis=1)
+    t = np.linspace(0, dur*60, N)
+
+    if centered:
+        ai_s -= ai_s.mean(axis=1, keepdims=True)
+        i_s -= i_s.mean(axis=1, keepdims=True)
+
+    return ai_s, i_s, t
+
+
 def gen_rnd_bloc_bold(dur=5, tr=1.0, hrf=None, nb_events=4, avg_dur=5,
                       std_dur=1, middle_spike=False, overlapping=False,
                       unitary_block=False, snr=1.0, nb_try=1000,
@@ -320,7 +470,7 @@ def gen_rnd_bloc_bold(dur=5, tr=1.0, hrf=None, nb_events=4, avg_dur=5,
                                 unitary_block=unitary_block,
                                 random_state=random_state)
 
-    hrf = spm_hrf(tr=tr, delta=1.0)[0] if hrf is None else hrf
+    hrf = spm_hrf(t_r=tr, delta=1.0)[0] if hrf is None else hrf
     ar_s = simple_convolve(hrf, ai_s)
 
     noisy_ar_s, noise = add_gaussian_noise(ar_s, snr=snr,
@@ -391,7 +541,7 @@ def gen_rnd_event_bold(dur=5, tr=1.0, hrf=None, nb_events=4, avg_ampl=5,
                          avg_ampl=avg_ampl, std_ampl=std_ampl,
                          random_state=random_state)
 
-    hrf = spm_hrf(tr=tr, delta=1.0)[0] if hrf is None else hrf
+    hrf = spm_hrf(t_r=tr, delta=1.0)[0] if hrf is None else hrf
     ar_s = simple_convolve(hrf, i_s)
 
     noisy_ar_s, noise = add_gaussian_noise(ar_s, snr=snr,
@@ -400,18 +550,174 @@ def gen_rnd_event_bold(dur=5, tr=1.0, hrf=None, nb_events=4, avg_ampl=5,
     return noisy_ar_s, ar_s, i_s, t, hrf, noise
 
 
+def _gen_cohort_block(seed, n_voxels, dur, tr, hrf, delta_range, hrf_dur,
+                      nb_events, avg_dur, std_dur, overlapping, unitary_block,
+                      snr):
+    """ Private helper for gen_cohort: generate n_voxels voxels from the given
+    seed (np.random.SeedSequence).
+    """
+    seed_ai_s, seed_hrf, seed_noise = seed.spawn(3)
+
+    ai_s, _, _ = gen_rnd_ai_s_batch(n_voxels, dur=dur, tr=tr,
+                                    nb_events=nb_events, avg_dur=avg_dur,
+                                    std_dur=std_dur, overlapping=overlapping,
+                                    unitary_block=unitary_block,
+                                    random_state=seed_ai_s)
+    N = ai_s.shape[1]
+
+    if hrf is None:
+        deltas = np.random.default_rng(seed_hrf).uniform(
+                                        delta_range[0], delta_range[1],
+                                        n_voxels)
+        hrfs, _ = spm_hrf_bank(deltas, t_r=tr, dur=hrf_dur)
+        # one HRF per voxel: causal convolution in the Fourier domain
+        n_fft = N + hrfs.shape[1] - 1
+        ar_s = irfft(rfft(hrfs, n_fft, axis=1) * rfft(ai_s, n_fft, axis=1),
+                     n_fft, axis=1)[:, :N]
+    else:
+        hrfs = np.repeat(hrf[None, :], n_voxels, axis=0)
+        ar_s = simple_convolve(hrf, ai_s)
+
+    noisy_ar_s, _ = add_gaussian_noise(ar_s, snr, random_state=seed_noise)
+
+    return noisy_ar_s, ar_s, ai_s, hrfs
+
+
+def gen_cohort(dirname, n_voxels, dur=5, tr=1.0, hrf=None,
+               delta_range=(MIN_DELTA, MAX_DELTA), hrf_dur=20.0, nb_events=4,
+               avg_dur=5, std_dur=1, overlapping=False, unitary_block=False,
+               snr=1.0, chunk_size=4096, n_jobs=1, random_state=None,
+               dtype=np.float64):
+    """ Generate a synthetic cohort of BOLD voxels chunk by chunk, directly
+    written in memory-mapped .npy files (noisy_ar_s.npy, ar_s.npy, ai_s.npy
+    and hrfs.npy in dirname), to produce cohorts that do not fit in memory.
+
+    The voxels are generated by blocks of 256 voxels, each one with its own
+    seed spawned from the root seed (np.random.SeedSequence), so the cohort
+    only depends on random_state: not on chunk_size nor on n_jobs.
+
+    Parameters:
+    -----------
+    dirname : str,
+        the output directory, created if needed.
+
+    n_voxels : int,
+        the number of voxels.
+
+    dur : int (default=5),
+        The length of the BOLD signal (in minutes).
+
+    tr : float (default=1.0),
+        Repetition time
+
+    hrf : 1d np.ndarray or None (default=None),
+        Specified HRF shared by all the voxels, if None each voxel has its
+        SPM like HRF with a time scaling parameter drawn uniformly in
+        delta_range.
+
+    delta_range : tuple of float (default=(MIN_DELTA, MAX_DELTA)),
+        the range of the time scaling parameter of the HRFs.
+
+    hrf_dur : float (default=20.0),
+        the duration of the HRFs (in second).
+
+    nb_events : int (default=4),
+        Number of neural activity on-sets.
+
+    avg_dur : int (default=5),
+        The average duration (in second) of neural activity on-sets.
+
+    std_dur : int (default=1),
+        The standard deviation parameter (in second) on the duration of
+        neural activity on-sets (see gen_rnd_ai_s_batch).
+
+    overlapping : bool (default=False),
+        Whether to authorize overlapping between on-sets.
+
+    unitary_block : bool (default=False),
+        force the block to have unitary amplitude.
+
+    snr: float (default=1.0),
+        SNR of the noisy BOLD signals.
+
+    chunk_size : int (default=4096),
+        the number of voxels generated per task, rounded up to a multiple of
+        256.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    random_state : int or None (default=None),
+        the root seed, if None a fresh one is drawn (and returned).
+
+    dtype : np.float32 or np.float64 (default=np.float64),
+        the dtype of the written arrays.
+
+    Results:
+    --------
+    filenames : dict,
+        the path of each written .npy file, per array name: 'noisy_ar_s',
+        'ar_s', 'ai_s' (of shape (n_voxels, n_scans)) and 'hrfs' (of shape
+        (n_voxels, n_taps)).
+
+    entropy : int,
+        the entropy of the root seed, to re-generate the same cohort.
+    """
+    root_seed = np.random.SeedSequence(random_state)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    N = len(gen_rnd_ai_s_batch(0, dur=dur, tr=tr)[2])
+    if hrf is None:
+        n_taps = len(spm_hrf(t_r=tr, delta=1.0, dur=hrf_dur)[0])
+    else:
+        hrf = np.asarray(hrf, dtype=np.float64)
+        n_taps = len(hrf)
+
+    shapes = {'noisy_ar_s': (n_voxels, N), 'ar_s': (n_voxels, N),
+              'ai_s': (n_voxels, N), 'hrfs': (n_voxels, n_taps)}
+    filenames, arrays = {}, {}
+    for name in COHORT_FILES:
+        filenames[name] = os.path.join(dirname, name + '.npy')
+        arrays[name] = np.lib.format.open_memmap(filenames[name], mode='w+',
+                                                 dtype=dtype,
+                                                 shape=shapes[name])
+
+    chunk_size = _SEED_BLOCK * max(1, -(-chunk_size // _SEED_BLOCK))
+
+    def _gen_chunk(chunk):
+        for block in chunk_slices(chunk.stop - chunk.start, _SEED_BLOCK):
+            start = chunk.start + block.start
+            seed = np.random.SeedSequence(root_seed.entropy,
+                                          spawn_key=(start // _SEED_BLOCK,))
+            res = _gen_cohort_block(seed, block.stop - block.start, dur, tr,
+                                    hrf, delta_range, hrf_dur, nb_events,
+                                    avg_dur, std_dur, overlapping,
+                                    unitary_block, snr)
+            for name, arr in zip(COHORT_FILES, res):
+                arrays[name][start:chunk.start + block.stop] = arr
+
+    thread_map(_gen_chunk, chunk_slices(n_voxels, chunk_size), n_jobs=n_jobs)
+    for arr in arrays.values():
+        arr.flush()
+
+    return filenames, root_seed.entropy
+
+
 def add_gaussian_noise(signal, snr, random_state=None):
     """ Add a Gaussian noise to signal to ouput a signal with the targeted snr.
 
     Parameters
     ----------
     signal : np.ndarray,
-        The given signal on which add a Guassian noise.
+        The given signal on which add a Guassian noise, 1d or 2d of shape
+        (n_voxels, n_time), the SNR of each row being set.
 
-    snr : float,
-        The expected SNR for the output signal.
+    snr : float or 1d np.ndarray,
+        The expected SNR for the output signal, or for each row of signal.
 
-    random_state :  int or None (default=None),
+    random_state : int, None, np.random.SeedSequence or np.random.Generator
+        (default=None),
         Whether to impose a seed on the random generation or not (for
         reproductability).
 
@@ -424,23 +730,18 @@ def add_gaussian_noise(signal, snr, random_state=None):
         the additif produced noise.
 
     """
-
-    if isinstance(random_state, int):
-        r = np.random.RandomState(random_state)
-    elif random_state is None:
-        r = np.random
-    else:
-        raise ValueError("random_state could only be seed-int or None, "
-                         "got {0}".format(type(random_state)))
-
-    s_shape = signal.shape
-    noise = r.randn(*s_shape)
-
-    true_snr_num = np.linalg.norm(signal)
-    true_snr_deno = np.linalg.norm(noise)
-    true_snr = true_snr_num / (true_snr_deno + np.finfo(np.float).eps)
-    std_dev = (1.0 / np.sqrt(10**(snr/10.0))) * true_snr
-    noise = std_dev * noise
+    r = np.random.default_rng(random_state)
+
+    signal = np.asarray(signal)
+    dtype = np.float32 if signal.dtype == np.float32 else np.float64
+    noise = np.empty(signal.shape, dtype=dtype)
+    r.standard_normal(out=noise, dtype=dtype)
+
+    true_snr_num = np.linalg.norm(signal, axis=-1)
+    true_snr_deno = np.linalg.norm(noise, axis=-1)
+    true_snr = true_snr_num / (true_snr_deno + np.finfo(dtype).eps)
+    std_dev = (1.0 / np.sqrt(10**(np.asarray(snr)/10.0))) * true_snr
+    noise *= np.asarray(std_dev, dtype=dtype)[..., None]
     noisy_signal = signal + noise
 
     return noisy_signal, noise
@@ -0,0 +1,242 @@
+# coding: utf-8
+""" This module gathers the out-of-core execution of the deconvolution
+functions on a voxel matrix stored in a .npy file.
+
+The voxel matrix (n_scans, n_voxels) is memory-mapped and processed by
+chunks of columns, the results being written in preallocated memory-mapped
+.npy files. A manifest (manifest.json) records the finished chunks, so an
+interrupted run resumes at the unfinished ones.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from .batch import estimate_memory, _estimate_kwargs
+from .bold_signal import bd, deconv, hrf_estim
+from .hrf_model import spm_hrf
+from .utils import check_dtype, get_n_jobs, chunk_slices, thread_map
+
+
+MANIFEST = 'manifest.json'
+
+
+def _jsonable(value):
+    """ Private helper to convert a parameter to a JSON serializable value,
+    arrays being replaced by their hash.
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return 'sha1:' + hashlib.sha1(value.view(np.uint8)).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, type) or isinstance(value, np.dtype):
+        return np.dtype(value).name
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _write_manifest(filename, manifest):
+    """ Private helper to (atomically) write the manifest.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+def _output_shapes(solver, n_scans, n_voxels, t_r, kwargs):
+    """ Private helper to return the shape of each output array.
+    """
+    shapes = {'cost': (n_voxels,)}
+    if solver != 'hrf_estim':
+        shapes['z'] = shapes['diff_z'] = (n_scans, n_voxels)
+    if solver != 'deconv':
+        n_taps = len(spm_hrf(1.0, t_r=t_r,
+                             dur=kwargs.get('hrf_dur', 20.0))[0])
+        shapes['hrf'] = (n_taps, n_voxels)
+    if solver == 'bd':
+        shapes['theta'] = (n_voxels,)
+    return shapes
+
+
+def run(input_file, output_dir, t_r, solver='bd', hrf=None, z=None,
+        voxels=None, chunk_size=128, n_jobs=1, mem_budget=None, resume=True,
+        callback=None, verbose=0, **kwargs):
+    """ Deconvolve (deconv with the given HRF), blind deconvolve (bd) or
+    estimate the HRF (hrf_estim with the given bloc signals) of the voxels
+    of a (n_scans, n_voxels) matrix stored in a .npy file, by chunks of
+    columns, the results being streamed in memory-mapped .npy files of
+    output_dir: cost.npy (the last value of the cost-function, per voxel),
+    for bd and deconv z.npy and diff_z.npy (n_scans, n_voxels), for bd and
+    hrf_estim hrf.npy (n_taps, n_voxels) and for bd theta.npy (n_voxels,).
+
+    The finished chunks are recorded in output_dir/manifest.json: re-running
+    the same command resumes at the first unfinished chunk.
+
+    Parameters:
+    -----------
+    input_file : str,
+        the .npy file of the voxel matrix, of shape (n_scans, n_voxels).
+
+    output_dir : str,
+        the output directory, created if needed.
+
+    t_r : float,
+        the TR.
+
+    solver : str (default='bd'),
+        'bd', 'deconv' or 'hrf_estim'.
+
+    hrf : 1d np.ndarray or None (default=None),
+        the HRF, only for deconv.
+
+    z : 1d np.ndarray, 2d np.ndarray, str or None (default=None),
+        the bloc signal shared by the voxels (1d) or the bloc signals of the
+        voxels (n_scans, n_voxels), or their .npy file, only for hrf_estim.
+
+    voxels : tuple of int or None (default=None),
+        the range (start, stop) of the processed voxels (columns) of the
+        matrix, all the voxels if None.
+
+    chunk_size : int (default=128),
+        the number of voxels per chunk, for deconv it could be reduced to
+        fit in mem_budget. When resuming, the chunk size of the manifest is
+        used.
+
+    n_jobs : int (default=1),
+        the number of threads.
+
+    mem_budget : int or None (default=None),
+        the memory budget (in bytes), the chunk size (for deconv) and the
+        number of threads are reduced to fit in it (see estimate_memory).
+
+    resume : bool (default=True),
+        whether to resume from the manifest of output_dir, if any, else the
+        outputs are re-initialized.
+
+    callback : callable or None (default=None),
+        called with the index of each finished chunk, once recorded in the
+        manifest (e.g. to refresh a lock, see sharding.run_worker).
+
+    verbose : int (default=0),
+        the verbosity level.
+
+    kwargs : dict,
+        the other parameters of bd or deconv ('hrf_dur' and 'model' for
+        hrf_estim).
+
+    Results:
+    --------
+    filenames : dict,
+        the path of each output .npy file, per output name.
+    """
+    if solver not in ['bd', 'deconv', 'hrf_estim']:
+        raise ValueError("solver should be 'bd', 'deconv' or 'hrf_estim', "
+                         "got {0}".format(solver))
+    if (solver == 'deconv') == (hrf is None):
+        raise ValueError("an HRF should be given for deconv (only)")
+    if (solver == 'hrf_estim') == (z is None):
+        raise ValueError("bloc signals should be given for hrf_estim (only)")
+
+    Y = np.load(input_file, mmap_mode='r')
+    dtype = check_dtype(kwargs.get('dtype', np.float64))
+    if isinstance(z, str):
+        z = np.load(z, mmap_mode='r')
+    if voxels is not None:
+        voxels = [int(voxels[0]), int(voxels[1])]
+        Y = Y[:, voxels[0]:voxels[1]]
+        if np.ndim(z) == 2:
+            z = z[:, voxels[0]:voxels[1]]
+    n_scans, n_voxels = Y.shape
+
+    params = {'solver': solver, 't_r': t_r, 'hrf': hrf, 'z': z,
+              'voxels': voxels}
+    params.update(kwargs)
+    params = {name: _jsonable(value) for name, value in params.items()}
+    manifest_file = os.path.join(output_dir, MANIFEST)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    if resume and os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if (manifest['shape'] != [n_scans, n_voxels] or
+                manifest['params'] != params):
+            raise ValueError("the manifest of {0} does not correspond to "
+                             "this run, use resume=False to restart "
+                             "it".format(output_dir))
+        mode = 'r+'
+    else:
+        if mem_budget is not None and solver == 'deconv':
+            # the outputs being on disk, one chunk should fit in the budget
+            fixed = estimate_memory(n_scans, 0, **_estimate_kwargs(kwargs))
+            per_voxel = estimate_memory(n_scans, 1,
+                                        **_estimate_kwargs(kwargs))
+            per_voxel -= fixed
+            chunk_size = int(min(chunk_size,
+                                 max(1, (mem_budget - fixed) // per_voxel)))
+        manifest = {'input_file': os.path.abspath(input_file),
+                    'shape': [n_scans, n_voxels], 'params': params,
+                    'chunk_size': chunk_size, 'done': []}
+        mode = 'w+'
+
+    chunks = chunk_slices(n_voxels, manifest['chunk_size'])
+    shapes = _output_shapes(solver, n_scans, n_voxels, t_r, kwargs)
+    filenames, outputs = {}, {}
+    for name, shape in shapes.items():
+        filenames[name] = os.path.join(output_dir, name + '.npy')
+        out_dtype = dtype if name in ['z', 'diff_z'] else np.float64
+        outputs[name] = np.lib.format.open_memmap(filenames[name], mode=mode,
+                                                  dtype=out_dtype,
+                                                  shape=shape)
+    if mode == 'w+':
+        _write_manifest(manifest_file, manifest)
+
+    if mem_budget is not None and solver != 'hrf_estim':
+        n_voxels_worker = manifest['chunk_size'] if solver == 'deconv' else 1
+        mem_worker = estimate_memory(n_scans, n_voxels_worker, solver=solver,
+                                     **_estimate_kwargs(kwargs))
+        n_jobs = int(max(1, min(get_n_jobs(n_jobs),
+                                mem_budget // mem_worker)))
+
+    done = set(manifest['done'])
+    todo = [idx for idx in range(len(chunks)) if idx not in done]
+    lock = threading.Lock()
+
+    def _run_chunk(idx):
+        chunk = chunks[idx]
+        y = np.array(Y[:, chunk])
+        if solver == 'deconv':
+            _, z_, diff_z, J = deconv(y, t_r, hrf, **kwargs)[:4]
+            res = {'z': z_, 'diff_z': diff_z, 'cost': J[-1]}
+        elif solver == 'hrf_estim':
+            z_chunk = z if np.ndim(z) == 1 else np.array(z[:, chunk])
+            h, _, J = hrf_estim(z_chunk, y, t_r, kwargs.get('hrf_dur', 20.0),
+                                model=kwargs.get('model', 'scaled'))
+            res = {'hrf': h, 'cost': J[-1]}
+        else:
+            res = {name: [] for name in shapes}
+            for y_v in y.T:
+                _, z_, diff_z, h, d = bd(y_v, t_r, **kwargs)
+                for name, value in [('z', z_), ('diff_z', diff_z),
+                                    ('hrf', h), ('theta', d['theta']),
+                                    ('cost', d['J'][-1])]:
+                    res[name].append(value)
+            res = {name: np.array(value).T for name, value in res.items()}
+        for name, value in res.items():
+            outputs[name][..., chunk] = value
+        with lock:
+            for arr in outputs.values():
+                arr.flush()
+            manifest['done'] = sorted(manifest['done'] + [idx])
+            _write_manifest(manifest_file, manifest)
+            if callback is not None:
+                callback(idx)
+        if verbose > 0:
+            print("chunk {0:04d}/{1:04d} done".format(idx + 1, len(chunks)))
+
+    thread_map(_run_chunk, todo, n_jobs=n_jobs)
+
+    return filenames
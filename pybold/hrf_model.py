@@ -2,11 +2,12 @@
 """ This module gathers usefull data generation.
 """
 import numpy as np
-from scipy.stats import gamma
 
 
 MIN_DELTA = 0.5
 MAX_DELTA = 2.0
+# time to peak and FWHM of the SPM HRF with delta = 1, per HRF parameters
+_SPM_HRF_SHAPE = {}
 
 
 def spm_hrf(delta, t_r=1.0, dur=60.0, normalized_hrf=True, dt=0.001, p_delay=6,
@@ -20,6 +21,8 @@ def spm_hrf(delta, t_r=1.0, dur=60.0, normalized_hrf=True, dt=0.001, p_delay=6,
                          ", got delta = {2}".format(MIN_DELTA, MAX_DELTA,
                                                     delta))
 
+    from scipy.stats import gamma  # lazy: heavy import
+
     # dur: the (continious) time segment on which we represent all
     # the HRF. Can cut the HRF too early. The time scale is second.
     t = np.linspace(0, dur, int(float(dur) / dt)) - float(onset) / dt
@@ -37,3 +40,172 @@ def spm_hrf(delta, t_r=1.0, dur=60.0, normalized_hrf=True, dt=0.001, p_delay=6,
     t_hrf = t[::int(t_r/dt)]
 
     return hrf, t_hrf
+
+
+def _spm_hrf_shape(dt=0.001, p_delay=6, undershoot=16.0, p_disp=1.0,
+                   u_disp=1.0, p_u_ratio=0.167):
+    """ Private helper to compute (once per HRF parameters) the time to peak
+    and the FWHM of the continuous SPM HRF with delta = 1, since
+    spm_hrf(delta)(t) = spm_hrf(1.0)(delta * t).
+    """
+    key = (dt, p_delay, undershoot, p_disp, u_disp, p_u_ratio)
+    shape = _SPM_HRF_SHAPE.get(key)
+    if shape is not None:
+        return shape
+
+    from scipy.stats import gamma  # lazy: heavy import
+    from scipy.optimize import brentq, minimize_scalar
+
+    def hrf(s):
+        return (gamma.pdf(s, p_delay/p_disp, loc=dt/p_disp) - p_u_ratio *
+                gamma.pdf(s, undershoot/u_disp, loc=dt/u_disp))
+
+    s = np.linspace(0.0, 2.0 * (p_delay + undershoot), 100000)
+    h = hrf(s)
+    idx_peak = np.argmax(h)
+    s_peak = minimize_scalar(lambda s_: -hrf(s_), method='bounded',
+                             bounds=(s[max(0, idx_peak - 1)],
+                                     s[idx_peak + 1]),
+                             options={'xatol': 1.0e-10}).x
+    half_max = hrf(s_peak) / 2.0
+    idx_fall = idx_peak + np.argmax(h[idx_peak:] < half_max)
+    s_rise = brentq(lambda s_: hrf(s_) - half_max, dt / p_disp, s_peak)
+    s_fall = brentq(lambda s_: hrf(s_) - half_max, s_peak, s[idx_fall])
+
+    shape = _SPM_HRF_SHAPE[key] = (s_peak, s_fall - s_rise)
+    return shape
+
+
+def spm_hrf_tp(delta, dt=0.001, p_delay=6, undershoot=16.0, p_disp=1.0,
+               u_disp=1.0, p_u_ratio=0.167):
+    """ Closed-form time to peak of the (continuous) SPM HRF, with the
+    parameters of spm_hrf, for one or several delta. The onset of spm_hrf
+    shifting its time grid along with the HRF, the time to peak on the
+    returned time grid does not depend on it.
+
+    Parameters:
+    -----------
+    delta : float or np.ndarray,
+        the time scaling parameter(s).
+
+    Results:
+    --------
+    tp : float or np.ndarray,
+        the time to peak (s), s_peak / delta with s_peak the time to peak
+        for delta = 1.
+    """
+    s_peak, _ = _spm_hrf_shape(dt, p_delay, undershoot, p_disp, u_disp,
+                               p_u_ratio)
+    return s_peak / np.asarray(delta, dtype=np.float64)
+
+
+def spm_hrf_fwhm(delta, dt=0.001, p_delay=6, undershoot=16.0, p_disp=1.0,
+                 u_disp=1.0, p_u_ratio=0.167):
+    """ Closed-form full width at half maximum of the (continuous) SPM HRF,
+    with the parameters of spm_hrf, for one or several delta.
+
+    Parameters:
+    -----------
+    delta : float or np.ndarray,
+        the time scaling parameter(s).
+
+    Results:
+    --------
+    fwhm : float or np.ndarray,
+        the FWHM (s), width / delta with width the FWHM for delta = 1.
+    """
+    _, width = _spm_hrf_shape(dt, p_delay, undershoot, p_disp, u_disp,
+                              p_u_ratio)
+    return width / np.asarray(delta, dtype=np.float64)
+
+
+def spm_hrf_bank(deltas, t_r=1.0, dur=60.0, normalized_hrf=True, dt=0.001,
+                 p_delay=6, undershoot=16.0, p_disp=1.0, u_disp=1.0,
+                 p_u_ratio=0.167, onset=0.0):
+    """ SPM canonical HRFs for several time scaling parameters at once, with
+    the parameters of spm_hrf. The HRFs are only evaluated at the TR-sampled
+    time stamps and normalized by the maximum of the continuous HRF.
+
+    Parameters:
+    -----------
+    deltas : 1d np.ndarray,
+        the time scaling parameters.
+
+    Results:
+    --------
+    hrfs : 2d np.ndarray,
+        the HRFs, of shape (len(deltas), n_taps).
+
+    t_hrf : 1d np.ndarray,
+        the time scale HRF.
+    """
+    deltas = np.atleast_1d(np.asarray(deltas, dtype=np.float64))
+    if np.any(deltas < MIN_DELTA) or np.any(deltas > MAX_DELTA):
+        raise ValueError("deltas should belong in [{0}, {1}]; wich "
+                         "correspond to a max FWHM of 10.52s and a min FWHM "
+                         "of 2.80s, got deltas in [{2}, {3}]".format(
+                             MIN_DELTA, MAX_DELTA, deltas.min(),
+                             deltas.max()))
+
+    from scipy.stats import gamma  # lazy: heavy import
+
+    def hrf(s):
+        return (gamma.pdf(s, p_delay/p_disp, loc=dt/p_disp) - p_u_ratio *
+                gamma.pdf(s, undershoot/u_disp, loc=dt/u_disp))
+
+    # same time stamps as spm_hrf, only the TR-sampled ones
+    t = np.linspace(0, dur, int(float(dur) / dt)) - float(onset) / dt
+    t_hrf = t[::int(t_r/dt)]
+    hrfs = hrf(deltas[:, None] * t_hrf[None, :])
+
+    if normalized_hrf:
+        s_peak, _ = _spm_hrf_shape(dt, p_delay, undershoot, p_disp, u_disp,
+                                   p_u_ratio)
+        hrfs /= hrf(s_peak) + 1.0e-30
+
+    return hrfs, t_hrf
+
+
+def spm_hrf_basis(delta=1.0, t_r=1.0, dur=60.0, n_derivatives=2,
+                  normalized_hrf=True, eps=1.0e-3):
+    """ Linear basis of the SPM HRFs around a time scaling parameter: the
+    HRF at delta and its derivatives with respect to delta (by central
+    finite differences).
+
+    Parameters:
+    -----------
+    delta : float (default=1.0),
+        the time scaling parameter around which the HRF is expanded.
+
+    t_r : float (default=1.0),
+        the TR.
+
+    dur : float (default=60.0),
+        the duration of the HRF.
+
+    n_derivatives : int (default=2),
+        the number of derivatives (0, 1 or 2).
+
+    normalized_hrf : bool (default=True),
+        whether the HRFs are normalized (see spm_hrf_bank).
+
+    eps : float (default=1.0e-3),
+        the finite differences step.
+
+    Results:
+    --------
+    basis : 2d np.ndarray,
+        the HRF and its derivatives, of shape (n_taps, 1 + n_derivatives).
+
+    t_hrf : 1d np.ndarray,
+        the time scale HRF.
+    """
+    if n_derivatives not in [0, 1, 2]:
+        raise ValueError("n_derivatives should be 0, 1 or 2, "
+                         "got {0}".format(n_derivatives))
+    hrfs, t_hrf = spm_hrf_bank([delta - eps, delta, delta + eps], t_r=t_r,
+                               dur=dur, normalized_hrf=normalized_hrf)
+    basis = [hrfs[1], (hrfs[2] - hrfs[0]) / (2.0 * eps),
+             (hrfs[2] - 2.0 * hrfs[1] + hrfs[0]) / eps**2]
+
+    return np.vstack(basis[:n_derivatives + 1]).T, t_hrf
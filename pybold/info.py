@@ -32,7 +32,7 @@ _PYBOLD_INSTALL_MSG = "See {0} for installation information.".format(
 #   in some meaningful order (more => less 'core').
 REQUIRED_MODULE_METADATA = (
     ('numba', {
-        'min_version': '0.41.0',
+        'min_version': '0.49.0',
         'required_at_installation': True,
         'install_info': _PYBOLD_INSTALL_MSG}),
     ('joblib', {
@@ -0,0 +1,173 @@
+# coding: utf-8
+""" This module gathers the compilation helpers of the numba kernels.
+
+The kernels are compiled at their first call (for the types they are called
+with), not at import time. If the ahead-of-time compiled module
+pybold._aot_kernels has been built (see build_aot), the kernels are taken
+from it for their declared signatures and compiled just-in-time otherwise.
+"""
+import os
+import importlib
+import numpy as np
+import numba
+from numba.core import types
+from numba.extending import typeof_impl
+from numba.np.numpy_support import as_dtype
+
+
+AOT_MODULE = '_aot_kernels'
+# registered kernels, per qualified name
+_KERNELS = {}
+
+
+class _Kernel:
+    """ Lazily compiled numba kernel: the numba dispatcher compiles at first
+    call, the AOT compiled functions are looked-up at first call too.
+    """
+    def __init__(self, py_func, signatures, options):
+        self.py_func = py_func
+        self.signatures = signatures
+        self.options = options
+        self.name = "{0}_{1}".format(py_func.__module__.split('.')[-1],
+                                     py_func.__name__)
+        self.jit = numba.jit(**options)(py_func)  # lazy, no signature
+        self.__doc__ = py_func.__doc__
+        self.__name__ = py_func.__name__
+        self._aot_funcs = None
+        self._aot_dispatch = {}
+
+    def _load_aot(self):
+        """ Private helper to look-up the AOT compiled functions.
+        """
+        self._aot_funcs = []
+        try:
+            aot = importlib.import_module('pybold.' + AOT_MODULE)
+        except ImportError:
+            return
+        for idx, signature in enumerate(self.signatures):
+            func = getattr(aot, "{0}__{1}".format(self.name, idx), None)
+            if func is not None:
+                self._aot_funcs.append((signature, func))
+
+    def __call__(self, *args):
+        if self._aot_funcs is None:
+            self._load_aot()
+        if not self._aot_funcs:
+            return self.jit(*args)
+        key = tuple((a.dtype, a.ndim, a.flags.c_contiguous)
+                    if isinstance(a, np.ndarray) else type(a) for a in args)
+        func = self._aot_dispatch.get(key)
+        if func is None:
+            # the AOT functions do not check their arguments types
+            func = self.jit
+            for signature, aot_func in self._aot_funcs:
+                if _match(signature, args):
+                    func = aot_func
+                    break
+            self._aot_dispatch[key] = func
+        return func(*args)
+
+
+def _match(signature, args):
+    """ Private helper to check that args can be passed to a function
+    compiled for the given signature without any conversion.
+    """
+    if len(signature) != len(args):
+        return False
+    for arg_type, arg in zip(signature, args):
+        if isinstance(arg_type, types.Array):
+            if not (isinstance(arg, np.ndarray) and
+                    arg.dtype == as_dtype(arg_type.dtype) and
+                    arg.ndim == arg_type.ndim):
+                return False
+            if arg_type.layout == 'C' and not arg.flags.c_contiguous:
+                return False
+        elif isinstance(arg_type, types.Boolean):
+            if not isinstance(arg, (bool, np.bool_)):
+                return False
+        elif isinstance(arg_type, types.Integer):
+            if (isinstance(arg, (bool, np.bool_)) or
+                    not isinstance(arg, (int, np.integer))):
+                return False
+        elif not isinstance(arg, (float, int, np.floating, np.integer)):
+            return False
+    return True
+
+
+@typeof_impl.register(_Kernel)
+def _typeof_kernel(val, c):
+    """ Private helper to let the kernels be called from other kernels.
+    """
+    return types.Dispatcher(val.jit)
+
+
+def jit(signatures, **options):
+    """ Decorator to declare a numba kernel compiled at first call.
+
+    Parameters:
+    -----------
+    signatures : list of tuple,
+        the argument types the kernel is meant to be called with, used to
+        compile the AOT module (the just-in-time compilation specializes on
+        the actual argument types).
+
+    options : dict,
+        the numba.jit options (nopython, cache, nogil...).
+
+    Results:
+    --------
+    decorator : function,
+        the decorator.
+    """
+    if isinstance(signatures, tuple):
+        signatures = [signatures]
+
+    def decorator(py_func):
+        kernel = _Kernel(py_func, signatures, options)
+        _KERNELS[kernel.name] = kernel
+        return kernel
+
+    return decorator
+
+
+def build_aot(output_dir=None, verbose=False):
+    """ Compile ahead-of-time all the kernels of pybold (for their declared
+    signatures) in the pybold._aot_kernels extension module.
+
+    Parameters:
+    -----------
+    output_dir : str or None (default=None),
+        where to write the module, if None in the pybold package directory
+        (where it will be looked-up).
+
+    verbose : bool (default=False),
+        the verbosity.
+
+    Results:
+    --------
+    output_dir : str,
+        the directory of the compiled module.
+    """
+    try:
+        from numba.pycc import CC  # deprecated, removed from recent numba
+    except ImportError:
+        raise ImportError("the ahead-of-time compilation needs numba.pycc, "
+                          "not available with numba {0}: the kernels are "
+                          "compiled just-in-time".format(numba.__version__))
+
+    for module in ['convolution', 'linear', 'bold_signal']:
+        importlib.import_module('pybold.' + module)
+
+    cc = CC(AOT_MODULE)
+    cc.output_dir = output_dir or os.path.dirname(os.path.abspath(__file__))
+    cc.verbose = verbose
+    for name, kernel in sorted(_KERNELS.items()):
+        dispatcher = numba.jit(kernel.signatures, nopython=True)(
+                                                            kernel.py_func)
+        for idx, signature in enumerate(kernel.signatures):
+            full_signature = dispatcher.overloads[signature].signature
+            cc.export("{0}__{1}".format(name, idx),
+                      full_signature)(kernel.py_func)
+    cc.compile()
+
+    return cc.output_dir
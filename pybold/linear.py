@@ -1,9 +1,96 @@
 # coding: utf-8
 """ This module gathers the definition of the HRF operator.
 """
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
+import numba
+from numpy.fft import rfft, irfft
 from .convolution import (toeplitz_from_kernel, spectral_convolve,
                           spectral_retro_convolve)
+from .utils import spectral_radius_est, check_dtype
+from .jit import jit
+
+
+# Lipschitz constants, per (kernel hash, dim_in, dim_out, backend, method)
+_LIPSCHITZ_CACHE = OrderedDict()
+_LIPSCHITZ_CACHE_SIZE = 256
+# last leading eigenvector, per (dim_in, backend), to warm-start the solvers
+_EIGVEC_CACHE = {}
+# the caches are shared by the threads of the batch module
+_CACHE_LOCK = threading.Lock()
+
+
+@jit((numba.float64[:], numba.int64, numba.int64, numba.boolean),
+     cache=True, nopython=True, nogil=True)
+def _gram_from_kernel(k, dim_in, dim_out, integ):
+    """ Private helper to compute, in O(dim_in * dim_out), the Gram matrix
+    K.T.dot(K) of the Toeplitz matrix K of k.conv(.), preceded by the
+    integration (L.T.dot(K.T).dot(K).dot(L)) if integ is True.
+    """
+    D = max(dim_in, dim_out)
+    len_k = len(k)
+    G = np.zeros((D + 1, D + 1))
+    # G[i, j] = sum_{m >= max(i, j)} k[m - i] * k[m - j]
+    for i in range(D - 1, -1, -1):
+        k_i = k[dim_out - 1 - i] if 0 <= dim_out - 1 - i < len_k else 0.0
+        for j in range(D - 1, -1, -1):
+            k_j = k[dim_out - 1 - j] if 0 <= dim_out - 1 - j < len_k else 0.0
+            G[i, j] = G[i + 1, j + 1] + k_i * k_j
+    G = G[:dim_in, :dim_in].copy()
+
+    if integ:  # L.T.dot(G).dot(L) is a double reverse cumsum of G
+        for i in range(dim_in - 2, -1, -1):
+            for j in range(dim_in):
+                G[i, j] += G[i + 1, j]
+        for i in range(dim_in):
+            for j in range(dim_in - 2, -1, -1):
+                G[i, j] += G[i, j + 1]
+
+    return G
+
+
+@jit([(numba.float64[:, :], numba.float64[:, :]),
+      (numba.float32[:, :], numba.float32[:, :])],
+     cache=True, nopython=True, nogil=True)
+def _integ_zero_padd(x, u):
+    """ Private helper to write the time integration (along axis 0) of x in
+    the first rows of u and zeros in the others.
+    """
+    dim_in, n_signals = x.shape
+    for n in range(n_signals):
+        u[0, n] = x[0, n]
+    for i in range(1, dim_in):
+        for n in range(n_signals):
+            u[i, n] = u[i - 1, n] + x[i, n]
+    for i in range(dim_in, u.shape[0]):
+        for n in range(n_signals):
+            u[i, n] = 0.0
+
+
+@jit([(numba.float64[:, :], numba.float64[:, :], numba.float64[:, :],
+       numba.int64, numba.float64[:, :]),
+      (numba.float32[:, :], numba.float32[:, :], numba.float32[:, :],
+       numba.int64, numba.float32[:, :])],
+     cache=True, nopython=True, nogil=True)
+def _tail_correct_adj_integ(w, u, tail_gram, tail_start, out):
+    """ Private helper to remove the contribution of the truncated tail of
+    the convolution from w (the full Gram product) and to write the adj time
+    integration (along axis 0) of the result in out.
+    """
+    dim_in, n_signals = out.shape
+    len_tail = tail_gram.shape[0]
+    for n in range(n_signals):
+        acc = 0.0
+        for i in range(dim_in - 1, -1, -1):
+            w_i = w[i, n]
+            if i >= tail_start:
+                a = i - tail_start
+                for b in range(len_tail):
+                    w_i -= tail_gram[a, b] * u[tail_start + b, n]
+            acc += w_i
+            out[i, n] = acc
 
 
 class DiscretInteg:
@@ -12,41 +99,52 @@ class DiscretInteg:
     def __init__(self):
         pass
 
-    def op(self, x):
+    def op(self, x, out=None):
         """ Return time integration of x.
 
         Parameters:
         -----------
-        x : 1d np.ndarray,
-            signal.
+        x : 1d or 2d np.ndarray,
+            signal, or signals stacked as columns.
+
+        out : np.ndarray or None (default=None),
+            preallocated buffer of the shape of x for the result.
 
         Results:
         --------
         integ_x : np.ndarray,
             the integrated 1d vector.
         """
-        return np.cumsum(x)
+        return np.cumsum(x, axis=0, out=out)
 
-    def adj(self, x):
+    def adj(self, x, out=None):
         """ Return adj time integrated of x.
 
         Parameters:
         -----------
-        x : 1d np.ndarray,
-            signal.
+        x : 1d or 2d np.ndarray,
+            signal, or signals stacked as columns.
+
+        out : np.ndarray or None (default=None),
+            preallocated buffer of the shape of x for the result.
 
         Results:
         --------
         adj_integ_x : np.ndarray,
             the adj integretated 1d vector.
         """
-        return np.flipud(np.cumsum(np.flipud(x)))
+        if out is None:
+            out = np.empty_like(x)
+        # cumsum of the reversed views: no copy is made
+        np.cumsum(x[::-1], axis=0, out=out[::-1])
+        return out
 
 
 class ConvAndLinear:
     """ Linear (Matrix) operator followed by a convolution.
     """
-    def __init__(self, M, kernel, dim_in, dim_out=None, spectral_conv=False):
+    def __init__(self, M, kernel, dim_in, dim_out=None, spectral_conv=False,
+                 dtype=np.float64):
         """ ConvAndLinear linear operator class.
         Parameters:
         -----------
@@ -61,44 +159,84 @@ class ConvAndLinear:
 
         dim_out : int (default None),
             chosen convolution ouput dimension.
+
+        spectral_conv : bool (default False),
+            whether to use the Fourier implementation of the convolution
+            instead of the Toeplitz one.
+
+        dtype : np.float32 or np.float64 (default=np.float64),
+            the compute precision, the precomputations (Gram matrix, kernel
+            spectrum) are done in float64 and stored in dtype.
         """
         self.M = M
-        self.k = kernel
+        self.dtype = check_dtype(dtype)
+        self._k64 = np.ascontiguousarray(kernel, dtype=np.float64)
+        self.k = self._k64.astype(self.dtype, copy=False)
+        self.dim_in = dim_in
+        self.dim_out = dim_in if dim_out is None else dim_out
         self.spectral_conv = spectral_conv
+        self._normal_ready = False  # lazily initialized in normal
+        self._integ = isinstance(self.M, DiscretInteg)
+        self._ws = {}  # flat workspaces, per number of rows
         if not self.spectral_conv:
             self.K = toeplitz_from_kernel(self.k, dim_in=dim_in,
-                                          dim_out=dim_out)
+                                          dim_out=dim_out, dtype=self.dtype)
             self.K_T = self.K.T
 
-    def op(self, x):
+    def _workspace(self, shape):
+        """ Private helper to return a C-contiguous buffer of the given shape,
+        a view on a cached flat buffer (one per number of rows, grown to the
+        largest number of columns requested).
+        """
+        size = int(np.prod(shape))
+        ws = self._ws.get(shape[0])
+        if ws is None or ws.size < size:
+            ws = self._ws[shape[0]] = np.empty(size, dtype=self.dtype)
+        return ws[:size].reshape(shape)
+
+    def op(self, x, out=None):
         """ Return k.convolve(D_hrf.dot(x)).
 
         Parameters:
         -----------
-        x : 1d np.ndarray,
-            signal.
+        x : 1d or 2d np.ndarray,
+            signal, or signals stacked as columns.
+
+        out : np.ndarray or None (default=None),
+            preallocated buffer for the result, with the Toeplitz
+            implementation and a C-contiguous out nothing is allocated.
 
         Results:
         --------
         img_x : np.ndarray,
             the resulting 1d vector.
         """
-        bloc_signal = self.M.op(x)
+        if self._integ:
+            bloc_signal = self.M.op(x, out=self._workspace(np.shape(x)))
+        else:
+            bloc_signal = self.M.op(x)
 
         if self.spectral_conv:
-            convolved_signal = spectral_convolve(self.k, bloc_signal)
-        else:
-            convolved_signal = self.K.dot(bloc_signal)
+            convolved_signal = spectral_convolve(self.k, bloc_signal, axis=0,
+                                                 dtype=self.dtype)
+            if out is None:
+                return convolved_signal
+            out[...] = convolved_signal
+            return out
 
-        return convolved_signal
+        return np.dot(self.K, bloc_signal, out=out)
 
-    def adj(self, x):
+    def adj(self, x, out=None):
         """ Return k.T.convolve(D_hrf.T.dot(x)).
 
         Parameters:
         -----------
-        x : 1d np.ndarray,
-            signal.
+        x : 1d or 2d np.ndarray,
+            signal, or signals stacked as columns.
+
+        out : np.ndarray or None (default=None),
+            preallocated buffer for the result, with the Toeplitz
+            implementation nothing is allocated.
 
         Results:
         --------
@@ -106,8 +244,240 @@ class ConvAndLinear:
             the resulting 1d vector.
         """
         if self.spectral_conv:
-            retro_convolved_signal = spectral_retro_convolve(self.k, x)
+            retro_convolved_signal = spectral_retro_convolve(
+                                        self.k, x, axis=0, dtype=self.dtype)
         else:
-            retro_convolved_signal = self.K_T.dot(x)
+            shape = (self.dim_in,) + np.shape(x)[1:]
+            retro_convolved_signal = np.dot(self.K_T, x,
+                                            out=self._workspace(shape))
+
+        if self._integ:
+            return self.M.adj(retro_convolved_signal, out=out)
+
+        adj_x = self.M.adj(retro_convolved_signal)
+        if out is None:
+            return adj_x
+        out[...] = adj_x
+        return out
+
+    def _init_gram(self):
+        """ Private helper to precompute what the normal operator needs: the
+        dense Gram matrix for the Toeplitz implementation, |K(f)|^2 on the
+        exact (linear) convolution grid and the Gram matrix of the truncated
+        convolution tail for the Fourier implementation.
+        """
+        k = self._k64
+
+        self._normal_ready = True
+        if not self.spectral_conv:
+            self._gram = _gram_from_kernel(k, self.dim_in, self.dim_out,
+                                           self._integ).astype(self.dtype)
+            return
+
+        len_full = self.dim_in + len(k) - 1
+        self._nfft = int(np.power(2, np.ceil(np.log2(len_full))))
+        sq_fft_k = np.abs(rfft(k, n=self._nfft)) ** 2
+        self._sq_fft_k = sq_fft_k.astype(self.dtype)
+        # K.T.dot(K) = F.T.dot(F) - T.T.dot(T), with F the full convolution
+        # and T its truncated rows, only non-zero on the last columns
+        tail_start = max(0, self.dim_out - len(k) + 1)
+        rows = np.arange(max(0, len_full - self.dim_out))[:, None]
+        cols = np.arange(tail_start, self.dim_in)[None, :]
+        idx = self.dim_out + rows - cols
+        valid = (0 <= idx) & (idx < len(k))
+        tail = np.where(valid, k[np.clip(idx, 0, len(k) - 1)], 0.0)
+        self._tail_start = tail_start
+        self._tail_gram = np.ascontiguousarray(tail.T.dot(tail),
+                                               dtype=self.dtype)
+
+    def normal(self, x, out=None):
+        """ Return the normal (Gram) operator applied on x, i.e.
+        self.adj(self.op(x)), in one fused pass.
+
+        With the Toeplitz implementation the dense Gram matrix is computed
+        once in O(N^2), with the Fourier implementation the convolution is
+        done on the exact (linear) convolution grid with a precomputed
+        |K(f)|^2 and the time integrations are fused in compiled kernels.
+
+        Parameters:
+        -----------
+        x : 1d or 2d np.ndarray,
+            signal, or signals stacked as columns.
+
+        out : np.ndarray or None (default=None),
+            preallocated buffer for the result, with the Toeplitz
+            implementation and a C-contiguous out nothing is allocated.
+
+        Results:
+        --------
+        img_x : np.ndarray,
+            the resulting 1d or 2d array.
+        """
+        if not self._normal_ready:
+            self._init_gram()
+
+        if not self.spectral_conv:
+            if self._integ:
+                return np.dot(self._gram, x, out=out)
+            normal_x = self.M.adj(self._gram.dot(self.M.op(x)))
+            if out is None:
+                return normal_x
+            out[...] = normal_x
+            return out
+
+        is_1d = (np.ndim(x) == 1)
+        if self._integ:
+            x_2d = np.asarray(x, dtype=self.dtype)
+            x_2d = np.ascontiguousarray(x_2d[:, None] if is_1d else x_2d)
+            u = self._workspace((self._nfft, x_2d.shape[1]))
+            _integ_zero_padd(x_2d, u)
+        else:
+            m_x = np.asarray(self.M.op(x), dtype=self.dtype)
+            m_x = m_x[:, None] if is_1d else m_x
+            u = np.zeros((self._nfft, m_x.shape[1]), dtype=self.dtype)
+            u[:self.dim_in] = m_x
+        w = irfft(self._sq_fft_k[:, None] * rfft(u, axis=0), n=self._nfft,
+                  axis=0).astype(self.dtype, copy=False)
+
+        if self._integ:
+            if out is None:
+                out = np.empty(np.shape(x), dtype=self.dtype)
+            out_2d = out[:, None] if is_1d else out
+            _tail_correct_adj_integ(w, u, self._tail_gram, self._tail_start,
+                                    out_2d)
+            return out
+
+        w = w[:self.dim_in]
+        w[self._tail_start:] -= self._tail_gram.dot(u[self._tail_start:
+                                                      self.dim_in])
+        normal_x = self.M.adj(w[:, 0] if is_1d else w)
+        if out is None:
+            return normal_x
+        out[...] = normal_x
+        return out
+
+    def normal_matrix(self):
+        """ Return the dense matrix of the normal (Gram) operator, i.e. the
+        matrix of self.adj(self.op(.)), computed once in O(N^2).
+
+        Results:
+        --------
+        gram : 2d np.ndarray,
+            the (dim_in, dim_in) Gram matrix.
+        """
+        if not self._normal_ready:
+            self._init_gram()
+
+        if self.spectral_conv or not self._integ:
+            k = self._k64
+            G = _gram_from_kernel(k, self.dim_in, self.dim_out,
+                                  self._integ).astype(self.dtype)
+            if self._integ:
+                return G
+            # M.T.dot(G).dot(M), G being symmetric
+            return np.apply_along_axis(self.M.adj, 0, np.apply_along_axis(
+                                    self.M.adj, 1, G))
+
+        return self._gram
+
+
+def _kernel_hash(k):
+    """ Private helper to hash the values of the kernel k.
+    """
+    k = np.ascontiguousarray(k, dtype=np.float64)
+    return hashlib.sha1(k.tobytes()).hexdigest()
+
+
+def _sup_sq_fft_kernel(k, nb_grid=None):
+    """ Private helper to return an upper bound of sup_f |K(f)|^2, with
+    K(f) the (continuous) Fourier transform of k, evaluated on a dense grid
+    and corrected by the maximal slope of K(f) between two grid points.
+    """
+    k = np.asarray(k, dtype=np.float64)
+    if nb_grid is None:
+        nb_grid = 16 * int(np.power(2, np.ceil(np.log2(len(k)))))
+    sup_grid = np.max(np.abs(rfft(k, n=nb_grid)))
+    # |K'(w)| <= sum_n n|k_n| and the grid step is 2 * pi / nb_grid
+    slope = np.sum(np.arange(len(k)) * np.abs(k))
+    return (sup_grid + np.pi * slope / nb_grid) ** 2
+
+
+def lipschitz_est(H, method='power', nb_iter=30, tol=1.0e-6, cache=True):
+    """ Estimate the Lipschitz constant of the gradient of
+    0.5 * ||H.op(x) - y||^2, i.e. the largest eigenvalue of H.adj(H.op(.)).
+
+    The estimates are memoized per (kernel, dimensions, implementation,
+    method) for the 'HRF convolution + integration' operators, and the
+    iterative methods are warm-started from the last leading eigenvector
+    computed for the same dimension, so a batch of voxels (or the blind
+    deconvolution loops) pays the estimation (almost) once.
+
+    Parameters:
+    -----------
+    H : ConvAndLinear instance,
+        the operator.
+
+    method : str (default='power'),
+        'power' for the power iteration, 'lanczos' for the (ARPACK) Lanczos
+        method, 'bound' for the closed-form upper bound
+        sup_f |K(f)|^2 / (4 sin^2(pi / (4N + 2))), only available when
+        H.M is a DiscretInteg.
+
+    nb_iter : int (default=30),
+        the maximum number of iterations of the iterative methods.
+
+    tol : float (default=1.0e-6),
+        the relative tolerance of the iterative methods.
+
+    cache : bool (default=True),
+        whether to use the memoized estimates.
+
+    Results:
+    --------
+    lipschitz_cst : float,
+        the Lipschitz constant estimation.
+    """
+    if method not in ['power', 'lanczos', 'bound']:
+        raise ValueError("method should be 'power', 'lanczos' or 'bound', "
+                         "got {0}".format(method))
+
+    cacheable = cache and isinstance(H.M, DiscretInteg)
+    if cacheable:
+        key = (_kernel_hash(H._k64), H.dim_in, H.dim_out, H.spectral_conv,
+               method)
+        with _CACHE_LOCK:
+            lipschitz_cst = _LIPSCHITZ_CACHE.get(key)
+            if lipschitz_cst is not None:
+                _LIPSCHITZ_CACHE.move_to_end(key)
+                return lipschitz_cst
+
+    if method == 'bound':
+        if not isinstance(H.M, DiscretInteg):
+            raise ValueError("closed-form bound only available when the "
+                             "linear operator is a DiscretInteg")
+        sq_norm_integ = 1.0 / (4.0 * np.sin(np.pi / (4 * H.dim_in + 2)) ** 2)
+        lipschitz_cst = _sup_sq_fft_kernel(H._k64) * sq_norm_integ
+
+    else:
+        vec_key = (H.dim_in, H.spectral_conv)
+        x_0 = _EIGVEC_CACHE.get(vec_key)
+        if method == 'lanczos' and H.dim_in > 2:
+            from scipy.sparse.linalg import LinearOperator, eigsh
+            normal = LinearOperator((H.dim_in, H.dim_in), matvec=H.normal,
+                                    dtype=np.float64)
+            eigvals, eigvecs = eigsh(normal, k=1, which='LA', v0=x_0,
+                                     maxiter=nb_iter * H.dim_in, tol=tol)
+            lipschitz_cst, x_0 = float(eigvals[0]), eigvecs[:, 0]
+        else:
+            lipschitz_cst, x_0 = spectral_radius_est(H, (H.dim_in,),
+                                                     nb_iter=nb_iter, tol=tol,
+                                                     x_0=x_0, return_vec=True)
+        _EIGVEC_CACHE[vec_key] = x_0
+
+    if cacheable:
+        with _CACHE_LOCK:
+            _LIPSCHITZ_CACHE[key] = lipschitz_cst
+            if len(_LIPSCHITZ_CACHE) > _LIPSCHITZ_CACHE_SIZE:
+                _LIPSCHITZ_CACHE.popitem(last=False)
 
-        return self.M.adj(retro_convolved_signal)
+    return lipschitz_cst
@@ -5,7 +5,65 @@ implementation for the HRF operator.
 import numpy as np
 
 
-def _padd_symetric(arrays, p, c, paddtype):
+# cache of the zeros-mirror-zeros padding geometry, per input length
+_CUSTOM_PADD_GEOMETRY = {}
+
+
+def _axis_slice(ndim, axis, start, stop):
+    """ Private helper to return the index selecting [start:stop] along axis
+    of an array with ndim dimensions.
+    """
+    idx = [slice(None)] * ndim
+    idx[axis] = slice(start, stop)
+    return tuple(idx)
+
+
+def _padd_one(a, p_left, p_right, c, out=None, axis=-1):
+    """ Private helper to c-padd one array with p_left values on the left and
+    p_right values on the right along axis, in out if given.
+
+    Parameters
+    ----------
+    a : np.ndarray,
+        array to padd.
+
+    p_left : int,
+        length of the left padding.
+
+    p_right : int,
+        length of the right padding.
+
+    c : float,
+        value to padd with.
+
+    out : np.ndarray or None (default=None),
+        preallocated buffer of length a.shape[axis] + p_left + p_right along
+        axis.
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
+    Results
+    -------
+    out : np.ndarray,
+        the padded array.
+    """
+    a = np.asarray(a)
+    n = a.shape[axis]
+    shape = list(a.shape)
+    shape[axis] = n + p_left + p_right
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(a, c))
+    elif list(out.shape) != shape:
+        raise ValueError("out should be of shape {0}, got "
+                         "{1}".format(tuple(shape), out.shape))
+    out[_axis_slice(a.ndim, axis, None, p_left)] = c
+    out[_axis_slice(a.ndim, axis, p_left, p_left + n)] = a
+    out[_axis_slice(a.ndim, axis, p_left + n, None)] = c
+    return out
+
+
+def _padd_symetric(arrays, p, c, paddtype, out=None, axis=-1):
     """ Helper function to c-padd in a symetric way arrays.
 
     Parameters
@@ -22,43 +80,38 @@ def _padd_symetric(arrays, p, c, paddtype):
     paddtype : ['left', 'right'],
         where to place the padding.
 
+    out : np.ndarray or None (default=None),
+        preallocated buffer of the padded length (only for one array).
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
     Results
     -------
     arrays : np.ndarray or list of np.ndarray
         the padded array or list of arrays
     """
+    if paddtype == "center":
+        p_left = int(p / 2)
+        p_right = int(p / 2) + (p % 2)
+    elif paddtype == "left":
+        p_left, p_right = p, 0
+    elif paddtype == "right":
+        p_left, p_right = 0, p
+    else:
+        raise ValueError("paddtype should be ['left', "
+                         "'center', 'right']")
+
     # case list of arrays (symm padd for list of arr)
     if isinstance(arrays, list):
-        if paddtype == "center":
-            p_left = int(p / 2)
-            p_right = int(p / 2) + (p % 2)
-            return [np.hstack([c*np.ones(p_left), a, c*np.ones(p_right)])
-                    for a in arrays]
-        elif paddtype == "left":
-            return [np.hstack([c*np.ones(p), a]) for a in arrays]
-        elif paddtype == "right":
-            return [np.hstack([a, c*np.ones(p)]) for a in arrays]
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return [_padd_one(a, p_left, p_right, c, axis=axis) for a in arrays]
 
     # case one arrays (symm padd for one of arr)
     else:
-        if paddtype == "center":
-            p_left = int(p / 2)
-            p_right = int(p / 2) + (p % 2)
-            return np.hstack([c*np.ones(p_left), arrays,
-                              c*np.ones(p_right)])
-        elif paddtype == "left":
-            return np.hstack([c*np.ones(p), arrays])
-        elif paddtype == "right":
-            return np.hstack([arrays, c*np.ones(p)])
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return _padd_one(arrays, p_left, p_right, c, out=out, axis=axis)
 
 
-def _padd_assymetric(arrays, p, c, paddtype):
+def _padd_assymetric(arrays, p, c, paddtype, out=None, axis=-1):
     """ Helper function to c-padd in an assymetric way arrays.
 
     Parameters
@@ -75,6 +128,12 @@ def _padd_assymetric(arrays, p, c, paddtype):
     paddtype : ['center'],
         where to place the padding.
 
+    out : np.ndarray or None (default=None),
+        preallocated buffer of the padded length (only for one array).
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
     Note:
     -----
     Will raise a ValueError if paddtype is not 'center'.
@@ -84,44 +143,32 @@ def _padd_assymetric(arrays, p, c, paddtype):
     arrays : np.ndarray or list of np.ndarray
         the padded array or list of arrays
     """
+    if paddtype == "left":
+        raise ValueError("Can't have 'left' paddtype with a tuple padd "
+                         " provided")
+    elif paddtype == "right":
+        raise ValueError("Can't have 'right' paddtype with a tuple padd "
+                         " provided")
+    elif paddtype != "center":
+        raise ValueError("paddtype should be ['left', "
+                         "'center', 'right']")
+
     # case list of arrays (assymm padd for one of arr)
     if isinstance(arrays, list):
-        if paddtype == "center":
-            return [np.hstack([c*np.ones(p[0]), a, c*np.ones(p[1])])
-                    for a in arrays]
-        elif paddtype == "left":
-            raise ValueError("Can't have 'left' paddtype with a tuple padd "
-                             " provided")
-        elif paddtype == "right":
-            raise ValueError("Can't have 'right' paddtype with a tuple padd "
-                             " provided")
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return [_padd_one(a, p[0], p[1], c, axis=axis) for a in arrays]
 
     # case one arrays (assymm padd for one of arr)
     else:
-        if paddtype == "center":
-            p_a = np.hstack([c*np.ones(p[0]), arrays, c*np.ones(p[1])])
-            return p_a
-        elif paddtype == "left":
-            raise ValueError("Can't have 'left' paddtype with a tuple padd "
-                             " provided")
-        elif paddtype == "right":
-            raise ValueError("Can't have 'right' paddtype with a tuple padd "
-                             " provided")
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return _padd_one(arrays, p[0], p[1], c, out=out, axis=axis)
 
 
-def padd(arrays, p, c=0.0, paddtype="center"):
+def padd(arrays, p, c=0.0, paddtype="center", out=None, axis=-1):
     """ Padd a list of arrays.
 
     Parameters
     ----------
     arrays : np.ndarray or list of np.ndarray
-        array or list of arrays to padd.
+        array or list of arrays to padd, nd arrays being padded along axis.
 
     p :  int or tuple of int,
         length of padding.
@@ -132,24 +179,47 @@ def padd(arrays, p, c=0.0, paddtype="center"):
     paddtype : ['left', 'right' or 'center'],
         where to place the padding.
 
+    out : np.ndarray or None (default=None),
+        preallocated buffer of the padded length in which the padded array is
+        written, only available for one array.
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
     Results
     -------
     arrays : np.ndarray or list of np.ndarray
         the unpadded array or list of arrays.
     """
+    if (out is not None) and isinstance(arrays, list):
+        raise ValueError("out is only available to padd one array")
+
     # case of assymetric padding
     if isinstance(p, int):
         if p < 1:  # no padding array
-            return arrays
+            if out is None:
+                return arrays
+            out[:] = arrays
+            return out
         else:
-            return _padd_symetric(arrays, p=p, c=c, paddtype=paddtype)
+            return _padd_symetric(arrays, p=p, c=c, paddtype=paddtype,
+                                  out=out, axis=axis)
 
     # case of symetric padding
     else:
-        return _padd_assymetric(arrays, p=p, c=c, paddtype=paddtype)
+        return _padd_assymetric(arrays, p=p, c=c, paddtype=paddtype, out=out,
+                                axis=axis)
+
+
+def _unpadd_one(a, p_left, p_right, axis=-1):
+    """ Private helper to return the view of a without its p_left first and
+    p_right last values along axis.
+    """
+    n = a.shape[axis]
+    return a[_axis_slice(a.ndim, axis, p_left, n - p_right)]
 
 
-def _unpadd_symetric(arrays, p, paddtype):
+def _unpadd_symetric(arrays, p, paddtype, axis=-1):
     """ Helper function to unpadd in an assymetric way arrays.
 
     Parameters
@@ -163,41 +233,35 @@ def _unpadd_symetric(arrays, p, paddtype):
     paddtype : ['left', 'right'],
         where to place the padding.
 
+    axis : int (default=-1),
+        the axis along which to unpadd.
+
     Results
     -------
     arrays : np.ndarray or list of np.ndarray
-        the unpadded array or list of arrays.
+        the unpadded array or list of arrays (views on the given arrays).
     """
+    if paddtype == "center":
+        p_left = int(p / 2)
+        p_right = int(p / 2) + (p % 2)
+    elif paddtype == "left":
+        p_left, p_right = p, 0
+    elif paddtype == "right":
+        p_left, p_right = 0, p
+    else:
+        raise ValueError("paddtype should be ['left', "
+                         "'center', 'right']")
+
     # case list of arrays (symm padd for list of arr)
     if isinstance(arrays, list):
-            if paddtype == "center":
-                p_left = int(p / 2)
-                p_right = int(p / 2) + (p % 2)
-                return [a[p_left:-p_right] for a in arrays]
-            elif paddtype == "left":
-                return [a[p:] for a in arrays]
-            elif paddtype == "right":
-                return [a[:-p] for a in arrays]
-            else:
-                raise ValueError("paddtype should be ['left', "
-                                 "'center', 'right']")
+        return [_unpadd_one(a, p_left, p_right, axis=axis) for a in arrays]
 
     # case one array (symm padd for one of arr)
     else:
-        if paddtype == "center":
-            p_left = int(p / 2)
-            p_right = int(p / 2) + (p % 2)
-            return arrays[p_left:-p_right]
-        elif paddtype == "left":
-            return arrays[p:]
-        elif paddtype == "right":
-            return arrays[:-p]
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return _unpadd_one(arrays, p_left, p_right, axis=axis)
 
 
-def _unpadd_assymetric(arrays, p, paddtype):
+def _unpadd_assymetric(arrays, p, paddtype, axis=-1):
     """ Helper function to unpadd in a symetric way arrays.
 
     Parameters
@@ -211,6 +275,9 @@ def _unpadd_assymetric(arrays, p, paddtype):
     paddtype : ['center'],
         where to place the padding.
 
+    axis : int (default=-1),
+        the axis along which to unpadd.
+
     Note:
     -----
     Will raise a ValueError if paddtype is not 'center'.
@@ -218,44 +285,34 @@ def _unpadd_assymetric(arrays, p, paddtype):
     Results
     -------
     arrays : np.ndarray or list of np.ndarray
-        the unpadded array or list of arrays.
+        the unpadded array or list of arrays (views on the given arrays).
     """
+    if paddtype == "left":
+        raise ValueError("Can't have 'left' paddtype with a tuple padd "
+                         "provided")
+    elif paddtype == "right":
+        raise ValueError("Can't have 'right' paddtype with  a tuple padd "
+                         " provided")
+    elif paddtype != "center":
+        raise ValueError("paddtype should be ['left', "
+                         "'center', 'right']")
+
     # case list of arrays (assymm padd for list of arr)
     if isinstance(arrays, list):
-        if paddtype == "center":
-            return [a[p[0]:-p[1]] for a in arrays]
-        elif paddtype == "left":
-            raise ValueError("Can't have 'left' paddtype with a tuple padd "
-                             "provided")
-        elif paddtype == "right":
-            raise ValueError("Can't have 'right' paddtype with  a tuple padd "
-                             " provided")
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return [_unpadd_one(a, p[0], p[1], axis=axis) for a in arrays]
 
     # case one array (assymm padd for one of arr)
     else:
-        if paddtype == "center":
-            return arrays[p[0]:-p[1]]
-        elif paddtype == "left":
-            raise ValueError("Can't have 'left' paddtype with a tuple padd "
-                             "provided")
-        elif paddtype == "right":
-            raise ValueError("Can't have 'right' paddtype with a tuple "
-                             "provided")
-        else:
-            raise ValueError("paddtype should be ['left', "
-                             "'center', 'right']")
+        return _unpadd_one(arrays, p[0], p[1], axis=axis)
 
 
-def unpadd(arrays, p, paddtype="center"):
+def unpadd(arrays, p, paddtype="center", axis=-1):
     """ Unpadd a list of arrays.
 
     Parameters
     ----------
     arrays : np.ndarray or list of np.ndarray
-        array or list of arrays to padd.
+        array or list of arrays to padd, nd arrays being unpadded along axis.
 
     p :  int or tuple of int,
         length of padding.
@@ -263,32 +320,36 @@ def unpadd(arrays, p, paddtype="center"):
     paddtype : ['left', 'right' or 'center'],
         where to place the padding.
 
+    axis : int (default=-1),
+        the axis along which to unpadd.
+
     Results
     -------
     arrays : np.ndarray or list of np.ndarray
-        the unpadded array or list of arrays.
+        the unpadded array or list of arrays, as views on the given arrays
+        (no copy is made).
     """
     # case of assymetric padding
     if isinstance(p, int):
         if p < 1:  # no padding case
             return arrays
         else:
-            return _unpadd_symetric(arrays, p, paddtype)
+            return _unpadd_symetric(arrays, p, paddtype, axis=axis)
 
     # case of symetric padding
     else:
-        return _unpadd_assymetric(arrays, p, paddtype)
+        return _unpadd_assymetric(arrays, p, paddtype, axis=axis)
 
 
-def _custom_padd(a, min_power_of_2=1024, min_zero_padd=50,
-                 zero_padd_ratio=0.5):
+def _custom_padd_labels(n, min_power_of_2=1024, min_zero_padd=50,
+                        zero_padd_ratio=0.5):
     """ Private helper to make a zeros-mirror-zeros padd to the next power of
-    two of a.
+    two of the labels [1, ..., n], 0 being the label of the zero padds.
 
     Parameters
     ----------
-    arrays : np.ndarray,
-        array to padd.
+    n : int,
+        length of the array to padd.
 
     min_power_of_2 : int (default=512),
         min length (power of two) for the padded array.
@@ -300,14 +361,10 @@ def _custom_padd(a, min_power_of_2=1024, min_zero_padd=50,
     min_zero_padd : int (default=50)
         min zero padd, either for the first or the second zero-padd.
 
-    Note:
-    -----
-    Having a signal close to ~200 can make trouble.
-
     Results
     -------
-    arrays : np.ndarray or list of np.ndarray
-        the unpadded array.
+    labels : np.ndarray,
+        the padded labels.
 
     p : tuple of int,
         the applied padd.
@@ -316,6 +373,8 @@ def _custom_padd(a, min_power_of_2=1024, min_zero_padd=50,
         raise ValueError("min_power_of_2 should be a power of two, "
                          "got {0}".format(min_power_of_2))
 
+    a = np.arange(1, n + 1, dtype=float)
+
     nextpow2 = int(np.power(2, np.ceil(np.log2(len(a)))))
     nextpow2 = min_power_of_2 if nextpow2 < min_power_of_2 else nextpow2
 
@@ -374,14 +433,179 @@ def _custom_padd(a, min_power_of_2=1024, min_zero_padd=50,
         return a, p_total
 
 
+def _custom_padd_geometry(n, min_power_of_2=1024, min_zero_padd=50,
+                          zero_padd_ratio=0.5):
+    """ Private helper to return the (cached) zeros-mirror-zeros padding
+    geometry of an array of length n.
+
+    Parameters
+    ----------
+    n : int,
+        length of the array to padd.
+
+    min_power_of_2 : int (default=512),
+        min length (power of two) for the padded array.
+
+    zero_padd_ratio : float (default=0.5),
+        determine the ratio of the length of zero padds (either for the first
+        or the second zero-padd) w.r.t the array length.
+
+    min_zero_padd : int (default=50)
+        min zero padd, either for the first or the second zero-padd.
+
+    Results
+    -------
+    geometry : tuple,
+        (padded length, applied padd, zero runs, copy runs), with the zero
+        runs as (start, stop) and the copy runs as (start, stop, src_start,
+        src_stop, reversed) w.r.t the padded array.
+    """
+    key = (n, min_power_of_2, min_zero_padd, zero_padd_ratio)
+    geometry = _CUSTOM_PADD_GEOMETRY.get(key)
+    if geometry is not None:
+        return geometry
+
+    labels, p = _custom_padd_labels(n, min_power_of_2=min_power_of_2,
+                                    min_zero_padd=min_zero_padd,
+                                    zero_padd_ratio=zero_padd_ratio)
+    idx = labels.astype(int) - 1  # -1 for the zero padds
+
+    # split the padded labels in zero, forward and backward runs
+    zero_runs, copy_runs = [], []
+    start = 0
+    for i in range(1, len(idx) + 1):
+        if i < len(idx):
+            step = idx[i] - idx[i - 1]
+            run_step = idx[start + 1] - idx[start] if i > start + 1 else step
+            is_zero = (idx[start] < 0) and (idx[i] < 0)
+            is_copy = ((idx[start] >= 0) and (idx[i] >= 0) and
+                       (step in [-1, 1]) and (step == run_step))
+            if is_zero or is_copy:
+                continue
+        if idx[start] < 0:
+            zero_runs.append((start, i))
+        else:
+            lo, hi = min(idx[start], idx[i - 1]), max(idx[start], idx[i - 1])
+            copy_runs.append((start, i, lo, hi + 1, idx[start] > idx[i - 1]))
+        start = i
+
+    geometry = (len(idx), p, tuple(zero_runs), tuple(copy_runs))
+    _CUSTOM_PADD_GEOMETRY[key] = geometry
+
+    return geometry
+
+
+def custom_padd_len(n, min_power_of_2=1024, min_zero_padd=50,
+                    zero_padd_ratio=0.5):
+    """ Return the length of the zeros-mirror-zeros padded array and the
+    applied padd for an array of length n, e.g. to preallocate the out buffer
+    of custom_padd.
+
+    Parameters
+    ----------
+    n : int,
+        length of the array to padd.
+
+    min_power_of_2 : int (default=512),
+        min length (power of two) for the padded array.
+
+    zero_padd_ratio : float (default=0.5),
+        determine the ratio of the length of zero padds (either for the first
+        or the second zero-padd) w.r.t the array length.
+
+    min_zero_padd : int (default=50)
+        min zero padd, either for the first or the second zero-padd.
+
+    Results
+    -------
+    padded_len : int,
+        the length of the padded array.
+
+    p : tuple of int,
+        the applied padd.
+    """
+    padded_len, p, _, _ = _custom_padd_geometry(
+                                        n, min_power_of_2=min_power_of_2,
+                                        min_zero_padd=min_zero_padd,
+                                        zero_padd_ratio=zero_padd_ratio)
+    return padded_len, p
+
+
+def _custom_padd(a, min_power_of_2=1024, min_zero_padd=50,
+                 zero_padd_ratio=0.5, out=None, axis=-1):
+    """ Private helper to make a zeros-mirror-zeros padd to the next power of
+    two of a.
+
+    Parameters
+    ----------
+    arrays : np.ndarray,
+        array to padd.
+
+    min_power_of_2 : int (default=512),
+        min length (power of two) for the padded array.
+
+    zero_padd_ratio : float (default=0.5),
+        determine the ratio of the length of zero padds (either for the first
+        or the second zero-padd) w.r.t the array length.
+
+    min_zero_padd : int (default=50)
+        min zero padd, either for the first or the second zero-padd.
+
+    out : np.ndarray or None (default=None),
+        preallocated buffer of the padded length.
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
+    Note:
+    -----
+    Having a signal close to ~200 can make trouble.
+
+    Results
+    -------
+    arrays : np.ndarray or list of np.ndarray
+        the unpadded array.
+
+    p : tuple of int,
+        the applied padd.
+    """
+    a = np.asarray(a)
+    padded_len, p, zero_runs, copy_runs = _custom_padd_geometry(
+                                        a.shape[axis],
+                                        min_power_of_2=min_power_of_2,
+                                        min_zero_padd=min_zero_padd,
+                                        zero_padd_ratio=zero_padd_ratio)
+
+    shape = list(a.shape)
+    shape[axis] = padded_len
+    if out is None:
+        if p == 0:  # no padding case
+            return a, p
+        out = np.empty(shape, dtype=a.dtype)
+    elif list(out.shape) != shape:
+        raise ValueError("out should be of shape {0}, got "
+                         "{1}".format(tuple(shape), out.shape))
+
+    for start, stop in zero_runs:
+        out[_axis_slice(a.ndim, axis, start, stop)] = 0.0
+    for start, stop, src_start, src_stop, reverse in copy_runs:
+        src = a[_axis_slice(a.ndim, axis, src_start, src_stop)]
+        if reverse:
+            src = np.flip(src, axis=axis)
+        out[_axis_slice(a.ndim, axis, start, stop)] = src
+
+    return out, p
+
+
 def custom_padd(arrays, min_power_of_2=1024, min_zero_padd=50,
-                zero_padd_ratio=0.5):
+                zero_padd_ratio=0.5, out=None, axis=-1):
     """ Zeros-mirror-zeros padding function to the next power of two of arrays.
 
     Parameters
     ----------
     arrays : np.ndarray or list of np.ndarray,
-        array or list of arrays to padd.
+        array or list of arrays to padd, nd arrays (e.g. (n_voxels, n_time))
+        being padded along axis in one vectorized operation.
 
     min_power_of_2 : int (default=512),
         min length (power of two) for the padded array.
@@ -393,6 +617,13 @@ def custom_padd(arrays, min_power_of_2=1024, min_zero_padd=50,
     min_zero_padd : int (default=50)
         min zero padd, either for the first or the second zero-padd.
 
+    out : np.ndarray or None (default=None),
+        preallocated buffer of the padded length (see custom_padd_len) in
+        which the padded array is written, only available for one array.
+
+    axis : int (default=-1),
+        the axis along which to padd.
+
     Note:
     -----
     Having a signal close to ~200 can make trouble.
@@ -406,18 +637,22 @@ def custom_padd(arrays, min_power_of_2=1024, min_zero_padd=50,
         the applied padd (might not be the same for all the arrays).
     """
     if isinstance(arrays, list):
-        _, padd = _custom_padd(arrays[0],
-                               min_power_of_2=min_power_of_2,
-                               min_zero_padd=min_zero_padd,
-                               zero_padd_ratio=zero_padd_ratio)
+        if out is not None:
+            raise ValueError("out is only available to padd one array")
+        _, padd = custom_padd_len(np.shape(arrays[0])[axis],
+                                  min_power_of_2=min_power_of_2,
+                                  min_zero_padd=min_zero_padd,
+                                  zero_padd_ratio=zero_padd_ratio)
         padd_arrays = [_custom_padd(a,
                                     min_power_of_2=min_power_of_2,
                                     min_zero_padd=min_zero_padd,
-                                    zero_padd_ratio=zero_padd_ratio)[0]
+                                    zero_padd_ratio=zero_padd_ratio,
+                                    axis=axis)[0]
                        for a in arrays]
         return padd_arrays, padd
     else:
         return _custom_padd(arrays,
                             min_power_of_2=min_power_of_2,
                             min_zero_padd=min_zero_padd,
-                            zero_padd_ratio=zero_padd_ratio)
+                            zero_padd_ratio=zero_padd_ratio,
+                            out=out, axis=axis)
@@ -0,0 +1,334 @@
+# coding: utf-8
+""" This module gathers the execution of the deconvolution functions on
+several hosts, without a scheduler: the voxel matrix (a .npy file) is split
+into shards (ranges of voxels) described by a manifest (shards.json) in a
+directory of a shared filesystem.
+
+Independent workers (on any host) claim the shards through lock files
+(created with O_CREAT | O_EXCL, which is atomic on local filesystems and on
+NFS v3+), process each one with driver.run (the partial outputs of a shard
+being written in its own sub-directory, so a broken shard resumes at its
+last finished chunk), then reduce_shards merges the partial outputs.
+"""
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+from .driver import run, _jsonable, _write_manifest
+from .utils import chunk_slices
+
+
+SHARDS = 'shards.json'
+DONE = 'done.json'
+
+
+def _shard_name(idx):
+    """ Private helper to return the name of the shard idx.
+    """
+    return "shard_{0:05d}".format(idx)
+
+
+def _lock_file(shard_dir, idx):
+    """ Private helper to return the lock file of the shard idx.
+    """
+    return os.path.join(shard_dir, 'locks', _shard_name(idx) + '.lock')
+
+
+def _done_file(shard_dir, idx):
+    """ Private helper to return the completion marker of the shard idx.
+    """
+    return os.path.join(shard_dir, _shard_name(idx), DONE)
+
+
+def _heartbeat(lock_file):
+    """ Private helper to refresh the lock file of a running shard, so
+    it is not considered as left by a dead worker (see claim_shard).
+    """
+    try:
+        os.utime(lock_file)
+    except OSError:  # broken meanwhile, the shard is then shared
+        pass
+
+
+def worker_id():
+    """ Return the identifier of the current worker (host and process).
+    """
+    return "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(),
+                                threading.get_ident())
+
+
+def make_shards(input_file, shard_dir, t_r, solver='bd', hrf=None, z=None,
+                shard_size=1024, **kwargs):
+    """ Split the voxels (columns) of a (n_scans, n_voxels) matrix stored in
+    a .npy file into shards of shard_size voxels, described by the manifest
+    shard_dir/shards.json (see run_worker and reduce_shards).
+
+    Parameters:
+    -----------
+    input_file : str,
+        the .npy file of the voxel matrix, of shape (n_scans, n_voxels), on
+        the shared filesystem.
+
+    shard_dir : str,
+        the shard directory, on the shared filesystem, created if needed.
+
+    t_r : float,
+        the TR.
+
+    solver : str (default='bd'),
+        'bd', 'deconv' or 'hrf_estim' (see driver.run).
+
+    hrf : 1d np.ndarray or None (default=None),
+        the HRF, only for deconv.
+
+    z : 1d np.ndarray, 2d np.ndarray, str or None (default=None),
+        the bloc signal(s) (or their .npy file), only for hrf_estim.
+
+    shard_size : int (default=1024),
+        the number of voxels per shard.
+
+    kwargs : dict,
+        the other parameters of the solver, JSON serializable.
+
+    Results:
+    --------
+    manifest_file : str,
+        the manifest of the shards.
+    """
+    if solver not in ['bd', 'deconv', 'hrf_estim']:
+        raise ValueError("solver should be 'bd', 'deconv' or 'hrf_estim', "
+                         "got {0}".format(solver))
+    if (solver == 'deconv') == (hrf is None):
+        raise ValueError("an HRF should be given for deconv (only)")
+    if (solver == 'hrf_estim') == (z is None):
+        raise ValueError("bloc signals should be given for hrf_estim (only)")
+    for name, value in kwargs.items():
+        if isinstance(value, np.ndarray):
+            raise ValueError("the parameter '{0}' should be JSON "
+                             "serializable, got an array".format(name))
+
+    n_scans, n_voxels = np.load(input_file, mmap_mode='r').shape
+    for dirname in [shard_dir, os.path.join(shard_dir, 'locks')]:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    manifest = {'input_file': os.path.abspath(input_file),
+                'shape': [n_scans, n_voxels], 'solver': solver, 't_r': t_r,
+                'hrf': None, 'z': None,
+                'params': {name: _jsonable(value)
+                           for name, value in kwargs.items()},
+                'shards': [[chunk.start, chunk.stop] for chunk in
+                           chunk_slices(n_voxels, shard_size)]}
+    # the arrays are shared with the workers through the shard directory
+    for name, value in [('hrf', hrf), ('z', z)]:
+        if isinstance(value, str):
+            manifest[name] = os.path.abspath(value)
+        elif value is not None:
+            manifest[name] = name + '.npy'
+            np.save(os.path.join(shard_dir, manifest[name]),
+                    np.asarray(value, dtype=np.float64))
+    manifest_file = os.path.join(shard_dir, SHARDS)
+    _write_manifest(manifest_file, manifest)
+
+    return manifest_file
+
+
+def load_shards(shard_dir):
+    """ Return the manifest of the shards of shard_dir.
+    """
+    with open(os.path.join(shard_dir, SHARDS)) as f:
+        return json.load(f)
+
+
+def claim_shard(shard_dir, idx, stale_timeout=None):
+    """ Atomically claim the shard idx: return True if the current worker
+    got it, False if another worker holds it.
+
+    Parameters:
+    -----------
+    shard_dir : str,
+        the shard directory.
+
+    idx : int,
+        the shard index.
+
+    stale_timeout : float or None (default=None),
+        if given, a lock older than stale_timeout seconds is considered as
+        left by a dead worker and is broken (the shard then resumes at its
+        last finished chunk), it should be larger than the duration of a
+        chunk (the lock being refreshed after each chunk, see run_worker).
+
+    Results:
+    --------
+    claimed : bool,
+        whether the shard is claimed by the current worker.
+    """
+    lock_file = _lock_file(shard_dir, idx)
+    if stale_timeout is not None:
+        try:
+            stat = os.stat(lock_file)
+        except OSError:  # not locked
+            stat = None
+        if stat is not None and time.time() - stat.st_mtime > stale_timeout:
+            # the rename is atomic: only one worker breaks the lock, the
+            # inode check detecting a lock just re-created by another worker
+            # (renaming it back could overwrite a newer one)
+            broken_file = "{0}.{1}.broken".format(
+                            lock_file, worker_id().replace(':', '_'))
+            try:
+                os.rename(lock_file, broken_file)
+            except OSError:
+                pass
+            else:
+                renewed = os.stat(broken_file).st_ino != stat.st_ino
+                os.remove(broken_file)
+                if renewed:
+                    return False
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker_id(), 'time': time.time()}, f)
+    return True
+
+
+def shard_status(shard_dir):
+    """ Return the state of the shards of shard_dir.
+
+    Parameters:
+    -----------
+    shard_dir : str,
+        the shard directory.
+
+    Results:
+    --------
+    status : dict,
+        the indices of the 'done' shards, of the 'running' ones (claimed but
+        not done) and of the 'todo' ones.
+    """
+    manifest = load_shards(shard_dir)
+    status = {'done': [], 'running': [], 'todo': []}
+    for idx in range(len(manifest['shards'])):
+        if os.path.isfile(_done_file(shard_dir, idx)):
+            status['done'].append(idx)
+        elif os.path.isfile(_lock_file(shard_dir, idx)):
+            status['running'].append(idx)
+        else:
+            status['todo'].append(idx)
+    return status
+
+
+def run_worker(shard_dir, n_jobs=1, chunk_size=128, max_shards=None,
+               stale_timeout=None, verbose=0):
+    """ Process the unclaimed shards of shard_dir until none is left, each
+    shard being claimed atomically, so several workers (on several hosts
+    sharing the filesystem) could be run concurrently.
+
+    Parameters:
+    -----------
+    shard_dir : str,
+        the shard directory (see make_shards).
+
+    n_jobs : int (default=1),
+        the number of threads of the worker.
+
+    chunk_size : int (default=128),
+        the number of voxels per chunk within a shard (see driver.run).
+
+    max_shards : int or None (default=None),
+        the maximum number of shards processed by the worker.
+
+    stale_timeout : float or None (default=None),
+        the age (in seconds) from which a lock is broken (see claim_shard),
+        the lock of a shard being refreshed after each of its chunks.
+
+    verbose : int (default=0),
+        the verbosity level.
+
+    Results:
+    --------
+    processed : list of int,
+        the indices of the shards processed by the worker.
+    """
+    manifest = load_shards(shard_dir)
+    hrf, z = manifest['hrf'], manifest['z']
+    if hrf is not None:
+        hrf = np.load(os.path.join(shard_dir, hrf))
+    if z is not None:
+        z = os.path.join(shard_dir, z)
+
+    processed = []
+    for idx, voxels in enumerate(manifest['shards']):
+        if max_shards is not None and len(processed) >= max_shards:
+            break
+        if os.path.isfile(_done_file(shard_dir, idx)):
+            continue
+        if not claim_shard(shard_dir, idx, stale_timeout=stale_timeout):
+            continue
+        if os.path.isfile(_done_file(shard_dir, idx)):  # done meanwhile
+            continue
+        t0 = time.time()
+        lock_file = _lock_file(shard_dir, idx)
+        run(manifest['input_file'], os.path.join(shard_dir, _shard_name(idx)),
+            manifest['t_r'], solver=manifest['solver'], hrf=hrf, z=z,
+            voxels=voxels, chunk_size=chunk_size, n_jobs=n_jobs,
+            callback=lambda _: _heartbeat(lock_file), **manifest['params'])
+        _write_manifest(_done_file(shard_dir, idx),
+                        {'worker': worker_id(), 'time': time.time() - t0})
+        processed.append(idx)
+        if verbose > 0:
+            print("[{0}] {1} ({2} voxels) done in {3:.2f}s".format(
+                        worker_id(), _shard_name(idx), voxels[1] - voxels[0],
+                        time.time() - t0))
+
+    return processed
+
+
+def reduce_shards(shard_dir, output_dir=None):
+    """ Merge the partial outputs of the shards of shard_dir in .npy files
+    of the whole voxel matrix (see driver.run for the outputs).
+
+    Parameters:
+    -----------
+    shard_dir : str,
+        the shard directory (see make_shards).
+
+    output_dir : str or None (default=None),
+        the output directory, shard_dir if None.
+
+    Results:
+    --------
+    filenames : dict,
+        the path of each output .npy file, per output name.
+    """
+    manifest = load_shards(shard_dir)
+    status = shard_status(shard_dir)
+    if status['running'] or status['todo']:
+        raise RuntimeError("{0} shard(s) of {1} are not done: {2}".format(
+                    len(status['running']) + len(status['todo']), shard_dir,
+                    sorted(status['running'] + status['todo'])))
+    output_dir = shard_dir if output_dir is None else output_dir
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    filenames, outputs = {}, {}
+    for idx, (start, stop) in enumerate(manifest['shards']):
+        dirname = os.path.join(shard_dir, _shard_name(idx))
+        for name in sorted(os.listdir(dirname)):
+            if not name.endswith('.npy'):
+                continue
+            partial = np.load(os.path.join(dirname, name), mmap_mode='r')
+            name = name[:-len('.npy')]
+            if name not in outputs:
+                shape = partial.shape[:-1] + (manifest['shape'][1],)
+                filenames[name] = os.path.join(output_dir, name + '.npy')
+                outputs[name] = np.lib.format.open_memmap(
+                                    filenames[name], mode='w+',
+                                    dtype=partial.dtype, shape=shape)
+            outputs[name][..., start:stop] = partial
+    for arr in outputs.values():
+        arr.flush()
+
+    return filenames
@@ -0,0 +1,100 @@
+""" Test the batch module.
+"""
+import unittest
+import numpy as np
+from pybold.batch import (bd_batch, deconv_batch, chunk_slices,
+                          estimate_memory, plan_batch)
+from pybold.bold_signal import bd, deconv
+from pybold.hrf_model import spm_hrf
+from pybold.tests.utils import gen_voxels
+
+
+class TestBatch(unittest.TestCase):
+    def test_chunk_slices(self):
+        """ Test that the chunks cover the voxels once.
+        """
+        for n_voxels in [1, 7, 10]:
+            for chunk_size in [1, 3, 10, 20]:
+                idx = np.arange(n_voxels)
+                chunks = [idx[s] for s in chunk_slices(n_voxels, chunk_size)]
+                assert(np.array_equal(np.hstack(chunks), idx))
+
+    def test_deconv_batch(self):
+        """ Test the threaded deconvolution against the deconvolution of
+        each voxel.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(100, 5, hrf)
+        params = dict(lbda=1.0, nb_iter=100)
+        for n_jobs, chunk_size in [(1, None), (2, None), (3, 2)]:
+            x, z, _, J = deconv_batch(y, 1.0, hrf, n_jobs=n_jobs,
+                                      chunk_size=chunk_size, **params)
+            assert(z.shape == y.shape)
+            for v in range(y.shape[1]):
+                x_v, z_v, _, _, _, _ = deconv(y[:, v], 1.0, hrf, **params)
+                assert(np.allclose(z[:, v], z_v))
+                assert(np.allclose(x[:, v], x_v))
+        # no voxel
+        x, z, diff_z, J = deconv_batch(y[:, :0], 1.0, hrf, n_jobs=2,
+                                       **params)
+        assert(x.shape == z.shape == diff_z.shape == (y.shape[0], 0))
+        assert(J == [])
+
+    def test_bd_batch(self):
+        """ Test the threaded blind deconvolution against the blind
+        deconvolution of each voxel.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0, dur=20.0, normalized_hrf=False)
+        y = gen_voxels(60, 3, hrf)
+        params = dict(lbda=1.0, nb_iter=2)
+        x, z, _, hrfs, d = bd_batch(y, 1.0, n_jobs=2, **params)
+        assert(hrfs.shape == (len(hrf), y.shape[1]))
+        for v in range(y.shape[1]):
+            x_v, z_v, _, hrf_v, _ = bd(y[:, v], 1.0, **params)
+            assert(np.allclose(z[:, v], z_v, atol=1.0e-6))
+            assert(np.allclose(hrfs[:, v], hrf_v, atol=1.0e-6))
+        # no voxel
+        x, z, diff_z, hrfs, d = bd_batch(y[:, :0], 1.0, n_jobs=2, **params)
+        assert(x.shape == z.shape == diff_z.shape == (y.shape[0], 0))
+        assert(hrfs.shape == (len(hrf), 0))
+        assert(d == [])
+
+    def test_plan_batch(self):
+        """ Test that the planned chunks fit in the memory budget.
+        """
+        n_scans, n_voxels = 1000, 5000
+        for dtype in [np.float64, np.float32]:
+            mem_bd = estimate_memory(n_scans, solver='bd', dtype=dtype)
+            mem_deconv = estimate_memory(n_scans, 100, dtype=dtype)
+            assert(mem_bd > 3 * n_scans**2 * np.dtype(dtype).itemsize)
+            assert(mem_deconv > estimate_memory(n_scans, 10, dtype=dtype))
+            for mem_budget in [5e8, 1e9, 1e10]:
+                chunk_size, n_jobs = plan_batch(n_scans, n_voxels,
+                                                mem_budget, n_jobs=8,
+                                                dtype=dtype)
+                assert(1 <= n_jobs <= 8)
+                mem = n_jobs * estimate_memory(n_scans, chunk_size,
+                                               dtype=dtype)
+                assert(mem <= mem_budget)
+                _, n_jobs = plan_batch(n_scans, n_voxels, mem_budget,
+                                       solver='bd', n_jobs=8, dtype=dtype)
+                assert(n_jobs * mem_bd <= mem_budget)
+        self.assertRaises(MemoryError, plan_batch, n_scans, n_voxels, 1e6)
+
+    def test_deconv_batch_mem_budget(self):
+        """ Test the deconvolution under a memory budget.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(100, 5, hrf)
+        params = dict(lbda=1.0, nb_iter=100)
+        mem_budget = (estimate_memory(100, 2, nb_iter=100) +
+                      6 * y.size * 8)
+        _, z, _, J = deconv_batch(y, 1.0, hrf, n_jobs=2,
+                                  mem_budget=mem_budget, **params)
+        assert(len(J) == 3)
+        _, z_, _, _ = deconv_batch(y, 1.0, hrf, **params)
+        assert(np.allclose(z, z_))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+""" Test the bold_signal module.
+"""
+import unittest
+import numpy as np
+from pybold.bold_signal import deconv, bd, hrf_estim, _fista
+from pybold.linear import ConvAndLinear, DiscretInteg, lipschitz_est
+from pybold.convolution import spectral_convolve
+from pybold.hrf_model import spm_hrf
+from pybold.utils import set_profile_hook, ProfileAggregator
+from pybold.tests.utils import gen_voxels
+
+
+class TestDeconv(unittest.TestCase):
+    def test_deconv_batch(self):
+        """ Test the deconvolution of stacked signals against the
+        deconvolution of each signal.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        n_scans, n_voxels = 120, 6
+        y = gen_voxels(n_scans, n_voxels, hrf)
+        lbda = np.linspace(0.5, 2.0, n_voxels)
+        for early_stopping in [False, True]:
+            params = dict(t_r=1.0, hrf=hrf, nb_iter=200,
+                          early_stopping=early_stopping, tol=3.0e-2)
+            x, z, diff_z, J, _, _ = deconv(y, lbda=lbda, **params)
+            assert(z.shape == (n_scans, n_voxels))
+            assert(J.shape[1] == n_voxels)
+            for v in range(n_voxels):
+                x_v, z_v, _, J_v, _, _ = deconv(y[:, v], lbda=lbda[v],
+                                                **params)
+                assert(np.allclose(z[:, v], z_v))
+                assert(np.allclose(x[:, v], x_v))
+                assert(np.allclose(J[:len(J_v), v], J_v))
+
+    def test_fista_workspaces(self):
+        """ Test that the workspaces of the operator stay bounded while the
+        converged signals are frozen.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        n_scans, n_voxels = 120, 40
+        y = gen_voxels(n_scans, n_voxels, hrf)
+        for spectral_conv in [False, True]:
+            H = ConvAndLinear(DiscretInteg(), hrf, dim_in=n_scans,
+                              spectral_conv=spectral_conv)
+            step = 1.0 / (0.9 * lipschitz_est(H))
+            diff_z = np.zeros_like(y)
+            J = _fista(H, H.adj(y), diff_z, step * np.linspace(0.5, 4.0,
+                                                               n_voxels),
+                       step, 500, True, 6, 1.0e-2, y=y, lbda=1.0)
+            n_frozen = np.sum(J[-1] == J[-2])
+            assert(0 < n_frozen < n_voxels)
+            # one buffer per number of rows (and the FFT grid)
+            assert(len(H._ws) <= 2)
+            nbytes = sum(ws.nbytes for ws in H._ws.values())
+            assert(nbytes <= 4 * y.nbytes)
+
+    def test_deconv_float32(self):
+        """ Test that the float32 deconvolution is close to the float64 one.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(120, 4, hrf)
+        params = dict(t_r=1.0, hrf=hrf, lbda=1.0, nb_iter=200)
+        x, z, _, J, _, _ = deconv(y, **params)
+        x_32, z_32, _, J_32, _, _ = deconv(y, dtype=np.float32, **params)
+        assert(z_32.dtype == np.float32)
+        assert(np.linalg.norm(z_32 - z) < 1.0e-2 * np.linalg.norm(z))
+        assert(np.allclose(J_32[-1], J[-1], rtol=1.0e-3))
+
+
+class TestHrfEstim(unittest.TestCase):
+    def test_hrf_estim_batch(self):
+        """ Test the HRF estimation of stacked signals sharing a bloc signal
+        against the estimation of each signal.
+        """
+        rng = np.random.RandomState(0)
+        n_scans, n_voxels = 150, 5
+        z = np.cumsum(rng.randn(n_scans) * (rng.rand(n_scans) > 0.9))
+        deltas = np.linspace(0.7, 1.8, n_voxels)
+        y = np.vstack([spectral_convolve(spm_hrf(delta, 1.0, 20.0,
+                                                 False)[0], z)
+                       for delta in deltas]).T
+        y += 0.1 * rng.randn(n_scans, n_voxels)
+        hrfs, theta, J = hrf_estim(z, y, 1.0, 20.0)
+        assert(hrfs.shape == (len(spm_hrf(1.0, 1.0, 20.0)[0]), n_voxels))
+        assert(np.allclose(theta, deltas, atol=1.0e-2))
+        for v in range(n_voxels):
+            hrf_v, J_v = hrf_estim(z, y[:, v], 1.0, 20.0)
+            assert(np.allclose(hrfs[:, v], hrf_v, atol=1.0e-6))
+            assert(J[-1, v] <= J_v[-1] * (1.0 + 1.0e-8))
+        # per-voxel bloc signals
+        hrfs_2d, theta_2d, _ = hrf_estim(np.tile(z[:, None], n_voxels), y,
+                                         1.0, 20.0)
+        assert(np.allclose(theta_2d, theta))
+
+    def test_hrf_estim_basis(self):
+        """ Test the HRF estimation in the canonical HRF and derivatives
+        basis, batched and per voxel, and its use in bd.
+        """
+        rng = np.random.RandomState(0)
+        n_scans, n_voxels = 150, 3
+        z = np.cumsum(rng.randn(n_scans) * (rng.rand(n_scans) > 0.9))
+        deltas = np.array([0.9, 1.0, 1.1])
+        h_true = np.vstack([spm_hrf(delta, 1.0, 20.0, False)[0]
+                            for delta in deltas]).T
+        y = np.vstack([spectral_convolve(h_true[:, v], z)
+                       for v in range(n_voxels)]).T
+        y += 0.01 * rng.randn(n_scans, n_voxels)
+        hrfs, theta, J = hrf_estim(z, y, 1.0, 20.0, model='basis')
+        assert(J.shape == (1, n_voxels))
+        assert(np.allclose(theta, deltas, atol=2.0e-2))
+        err = np.linalg.norm(hrfs - h_true, axis=0)
+        assert(np.all(err < 2.0e-2 * np.linalg.norm(h_true, axis=0)))
+        for v in range(n_voxels):
+            hrf_v, J_v = hrf_estim(z, y[:, v], 1.0, 20.0, model='basis')
+            assert(np.allclose(hrf_v, hrfs[:, v]))
+            assert(np.isclose(J_v[-1], J[-1, v]))
+        # per-voxel bloc signals
+        hrfs_2d, theta_2d, J_2d = hrf_estim(np.tile(z[:, None], n_voxels), y,
+                                            1.0, 20.0, model='basis')
+        assert(np.allclose(hrfs_2d, hrfs))
+        assert(np.allclose(theta_2d, theta))
+        assert(np.allclose(J_2d, J))
+        # bd only refines theta around theta_0 (see bd): noiseless voxels
+        # started at their delta
+        for v in [1, 2]:
+            y_v = spectral_convolve(h_true[:, v], z)
+            _, _, _, h, d = bd(y_v, 1.0, lbda=0.01, theta_0=deltas[v],
+                               nb_iter=10, nb_sub_iter=300,
+                               nb_last_iter=1000, model='basis')
+            assert(abs(d['theta'] - deltas[v]) < 3.0e-2)
+            assert(np.allclose(h, spm_hrf(d['theta'], 1.0, 20.0, False)[0]))
+        with self.assertRaises(ValueError):
+            hrf_estim(z, y, 1.0, 20.0, model='fir')
+
+
+class TestProfile(unittest.TestCase):
+    def test_profile(self):
+        """ Test the profile of bd and deconv and its aggregation by the
+        global hook.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(100, 1, hrf)[:, 0]
+
+        _, z, _, _, d = bd(y, 1.0, nb_iter=3, profile=True)
+        _, z_, _, _, d_ = bd(y, 1.0, nb_iter=3)
+        assert('profile' not in d_)
+        assert(np.allclose(z, z_))
+        profile = d['profile']
+        for stage in ['toeplitz', 'deconv', 'hrf', 'cost', 'total']:
+            assert(profile['time'][stage] >= 0.0)
+        assert(len(profile['nb_inner_iter']) == 4)
+        assert(len(profile['nb_hrf_eval']) == 3)
+        assert(profile['count']['hrf_eval'] == sum(profile['nb_hrf_eval']))
+        assert(profile['count']['normal'] == sum(profile['nb_inner_iter']))
+
+        # inner budgets (exact steps) and inexact schedule
+        d = bd(y, 1.0, nb_iter=3, sub_tol=None, nb_sub_iter=7,
+               nb_last_iter=11, profile=True)[4]
+        assert(d['profile']['nb_inner_iter'] == [7, 7, 7, 11])
+        d = bd(y, 1.0, nb_iter=10, nb_sub_iter=50, sub_tol=1.0e-2,
+               profile=True)[4]
+        sub_tol = d['profile']['sub_tol']
+        assert(sub_tol[0] == 1.0e-2)
+        assert(np.all(np.diff(sub_tol) <= 0.0))
+        assert(np.all(np.array(sub_tol[1:]) >= 0.5 * np.array(sub_tol[:-1])))
+        assert(max(d['profile']['nb_inner_iter'][:-1]) <= 50)
+
+        profile = {}
+        res = deconv(y, 1.0, hrf, lbda=1.0, nb_iter=50,
+                     early_stopping=False, profile=profile)
+        assert(len(res) == 6)
+        assert(profile['count']['normal'] == 50)
+
+        agg = ProfileAggregator()
+        old_hook = set_profile_hook(agg)
+        try:
+            bd(y, 1.0, nb_iter=3, nb_sub_iter=3, nb_last_iter=3)
+            res = deconv(y, 1.0, hrf, lbda=1.0, nb_iter=50,
+                         early_stopping=False)
+        finally:
+            set_profile_hook(old_hook)
+        assert(len(res) == 6)
+        summary = agg.summary()
+        assert(summary['n_calls'] == 2)
+        assert(summary['count']['normal'] == 62)
+
+
+if __name__ == '__main__':
+    unittest.main()
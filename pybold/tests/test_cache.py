@@ -0,0 +1,110 @@
+""" Test the cache module.
+"""
+import tempfile
+import unittest
+import numpy as np
+from pybold.cache import ResultCache, cached_deconv, cached_bd
+from pybold.bold_signal import bd, deconv
+from pybold.hrf_model import spm_hrf
+from pybold.tests.utils import gen_voxels
+
+
+class _CountCalls:
+    """ Count the calls of func.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.n_calls = 0
+        self.__module__ = func.__module__
+        self.__name__ = func.__name__
+
+    def __call__(self, *args, **kwargs):
+        self.n_calls += 1
+        return self.func(*args, **kwargs)
+
+
+class TestCache(unittest.TestCase):
+    def test_result_cache(self):
+        """ Test the keys, the hits and the LRU eviction.
+        """
+        func = _CountCalls(np.cumsum)
+        y = np.arange(10.0)
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            assert(cache.key(func, y) == cache.key(func, y.copy()))
+            assert(cache.key(func, y) != cache.key(func, y + 1.0))
+            assert(cache.key(func, y) != cache.key(func, y, axis=0))
+            assert(cache.key(func, y) !=
+                   cache.key(func, y.astype(np.float32)))
+            res = cache.call(func, y)
+            res_ = cache.call(func, y)
+            assert(func.n_calls == 1)
+            assert(np.array_equal(res, res_))
+
+            entry_size = cache.size()
+            cache.set(cache.key(func, y), res)  # replaced entry
+            assert(cache._size == entry_size)
+            cache = ResultCache(dirname, max_size=4.5 * entry_size)
+            for idx in range(1, 4):
+                cache.call(func, y + idx)
+            cache.call(func, y + 1)  # y + 2 is now the least recently used
+            cache.call(func, y + 4)  # evicts y and y + 2 (low water mark)
+            assert(cache.size() == 3 * entry_size)
+            n_calls = func.n_calls
+            for idx in [1, 3, 4]:
+                cache.call(func, y + idx)
+            assert(func.n_calls == n_calls)
+            cache.call(func, y + 2)
+            assert(func.n_calls == n_calls + 1)
+            with self.assertRaises(ValueError):
+                ResultCache(dirname, low_water=1.5)
+
+    def test_cached_deconv(self):
+        """ Test the cached deconvolution against deconv per voxel, and that
+        only the changed voxels are recomputed.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(100, 5, hrf)
+        lbda = np.linspace(0.5, 2.0, 5)
+        params = dict(lbda=lbda, nb_iter=200, tol=3.0e-2)
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            _, z, _, J = cached_deconv(y, 1.0, hrf, cache, **params)
+            for v in range(y.shape[1]):
+                _, z_v, _, J_v, _, _ = deconv(y[:, v], 1.0, hrf,
+                                              lbda=lbda[v], nb_iter=200,
+                                              tol=3.0e-2)
+                assert(np.allclose(z[:, v], z_v))
+                assert(np.allclose(J[v], J_v))
+
+            # the batched columns are not stored as deconv results
+            assert(cache.get(cache.key(deconv, y[:, 0], 1.0, hrf,
+                                       lbda=float(lbda[0]), nb_iter=200,
+                                       tol=3.0e-2)) is None)
+
+            size = cache.size()
+            y[:, 2] += 0.1
+            _, z_, _, _ = cached_deconv(y, 1.0, hrf, cache, **params)
+            assert(np.array_equal(np.delete(z_, 2, axis=1),
+                                  np.delete(z, 2, axis=1)))
+            assert(cache.size() > size)
+
+    def test_cached_bd(self):
+        """ Test the cached blind deconvolution against bd.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0, dur=20.0, normalized_hrf=False)
+        y = gen_voxels(60, 2, hrf)
+        with tempfile.TemporaryDirectory() as dirname:
+            cache = ResultCache(dirname)
+            for _ in range(2):
+                _, z, _, hrfs, d = cached_bd(y, 1.0, cache, lbda=1.0,
+                                             nb_iter=2)
+        for v in range(y.shape[1]):
+            _, z_v, _, hrf_v, d_v = bd(y[:, v], 1.0, lbda=1.0, nb_iter=2)
+            assert(np.allclose(z[:, v], z_v))
+            assert(np.allclose(hrfs[:, v], hrf_v))
+            assert(d[v]['theta'] == d_v['theta'])
+
+
+if __name__ == '__main__':
+    unittest.main()
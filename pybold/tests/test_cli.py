@@ -0,0 +1,78 @@
+""" Test the cli module.
+"""
+import os
+import json
+import tempfile
+import unittest
+import numpy as np
+from pybold.cli import main, TIMING
+from pybold.bold_signal import deconv, hrf_estim
+from pybold.hrf_model import spm_hrf
+from pybold.tests.utils import gen_voxels
+
+
+class TestCli(unittest.TestCase):
+    def test_deconv(self):
+        """ Test pybold-run deconv with a config file against deconv.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(60, 5, hrf)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            hrf_file = os.path.join(dirname, 'hrf.npy')
+            output_dir = os.path.join(dirname, 'out')
+            config_file = os.path.join(dirname, 'config.json')
+            np.save(input_file, y)
+            np.save(hrf_file, hrf)
+            with open(config_file, 'w') as f:
+                json.dump({'input': input_file, 't_r': 1.0, 'hrf': hrf_file,
+                           'params': {'lbda': 1.0, 'nb_iter': 50}}, f)
+            for backend in ['toeplitz', 'fourier']:
+                status = main(['deconv', '--config', config_file,
+                               '--output-dir', output_dir, '--n-jobs', '2',
+                               '--chunk-size', '2', '--backend', backend,
+                               '--no-resume'])
+                assert(status == 0)
+                _, z_ref, _, _, _, _ = deconv(
+                                y, 1.0, hrf, lbda=1.0, nb_iter=50,
+                                spectral_conv=(backend == 'fourier'))
+                z = np.load(os.path.join(output_dir, 'z.npy'))
+                assert(np.allclose(z, z_ref))
+                with open(os.path.join(output_dir, TIMING)) as f:
+                    timing = json.load(f)
+                assert(timing['n_voxels'] == 5)
+                assert(timing['profile']['n_calls'] == 3)
+
+    def test_hrf_estim(self):
+        """ Test pybold-run hrf-estim with a shared bloc signal against
+        hrf_estim.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y, ai_s = gen_voxels(60, 3, hrf, return_ai_s=True)
+        y = y[:, :1] + 0.1 * np.random.RandomState(1).randn(60, 3)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            z_file = os.path.join(dirname, 'z.npy')
+            output_dir = os.path.join(dirname, 'out')
+            np.save(input_file, y)
+            np.save(z_file, ai_s[:, 0])
+            status = main(['hrf-estim', '--input', input_file, '--z', z_file,
+                           '--output-dir', output_dir, '--t-r', '1.0'])
+            assert(status == 0)
+            hrfs = np.load(os.path.join(output_dir, 'hrf.npy'))
+            for v in range(3):
+                hrf_ref, _ = hrf_estim(ai_s[:, 0], y[:, v], 1.0, 20.0)
+                assert(np.allclose(hrfs[:, v], hrf_ref))
+
+    def test_errors(self):
+        """ Test the command-line errors.
+        """
+        with self.assertRaises(SystemExit):
+            main(['bd', '--t-r', '1.0'])  # no input
+        with self.assertRaises(SystemExit):
+            main(['bd', '--input', 'y.npy', '--output-dir', 'out', '--t-r',
+                  '1.0', '--backend', 'fourier'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -231,5 +231,62 @@ class TestToeplitzAdjConvolutionKernelSignal(unittest.TestCase, YieldData):
                     self.yield_blocks_signal())
 
 
+# batch of signals
+
+
+class TestSimpleConvolutionBatch(unittest.TestCase, YieldData):
+    def test_simple_convolution_batch(self):
+        """ Test that the 2d (batch) direct convolution is equal to the
+        convolution of each signal, along both time axis.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            ai_s_batch = np.vstack([ai_s, np.roll(ai_s, 10), -ai_s])
+            ar_s_ref = np.vstack([simple_convolve(hrf, a)
+                                  for a in ai_s_batch])
+            ar_s_test = simple_convolve(hrf, ai_s_batch)
+            assert(np.allclose(ar_s_ref, ar_s_test, atol=1.0e-7))
+            ar_s_test = simple_convolve(hrf, ai_s_batch.T, axis=0)
+            assert(np.allclose(ar_s_ref.T, ar_s_test, atol=1.0e-7))
+
+    def test_simple_retro_convolution_batch(self):
+        """ Test that the 2d (batch) direct adj convolution is equal to the
+        Toeplitz adj convolution of each signal.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            ai_s_batch = np.vstack([ai_s, np.roll(ai_s, 10), -ai_s])
+            H = toeplitz_from_kernel(hrf, len(ai_s), len(ai_s))
+            adj_ar_s_ref = H.T.dot(ai_s_batch.T)
+            adj_ar_s_test = simple_retro_convolve(hrf, ai_s_batch.T, axis=0)
+            assert(np.allclose(adj_ar_s_ref, adj_ar_s_test, atol=1.0e-7))
+
+    def test_spectral_convolution_batch(self):
+        """ Test that the 2d (batch) Fourier convolution is equal to the
+        Fourier convolution of each signal.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            ai_s_batch = np.vstack([ai_s, np.roll(ai_s, 10), -ai_s])
+            ar_s_ref = np.vstack([spectral_convolve(hrf, a)
+                                  for a in ai_s_batch])
+            ar_s_test = spectral_convolve(hrf, ai_s_batch.T, axis=0)
+            assert(np.allclose(ar_s_ref.T, ar_s_test, atol=1.0e-7))
+            adj_ar_s_ref = np.vstack([spectral_retro_convolve(hrf, a)
+                                      for a in ai_s_batch])
+            adj_ar_s_test = spectral_retro_convolve(hrf, ai_s_batch)
+            assert(np.allclose(adj_ar_s_ref, adj_ar_s_test, atol=1.0e-7))
+
+    def test_convolution_float32(self):
+        """ Test that the float32 convolutions are close to the float64 ones.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            ai_s_batch = np.vstack([ai_s, np.roll(ai_s, 10), -ai_s]).T
+            for func in [simple_convolve, simple_retro_convolve,
+                         spectral_convolve, spectral_retro_convolve]:
+                ref = func(hrf, ai_s_batch, axis=0)
+                test = func(hrf, ai_s_batch, axis=0, dtype=np.float32)
+                assert(test.dtype == np.float32)
+                scale = np.max(np.abs(ref))
+                assert(np.allclose(test / scale, ref / scale, atol=1.0e-5))
+
+
 if __name__ == '__main__':
     unittest.main()
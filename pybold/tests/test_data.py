@@ -1,12 +1,15 @@
 """ Test the data module.
 """
+import os
+import tempfile
 import unittest
 import itertools
 from joblib import Parallel, delayed
 import numpy as np
 from numpy.linalg import norm as norm_2
 from pybold.convolution import simple_convolve
-from pybold.data import gen_rnd_bloc_bold
+from pybold.data import (gen_rnd_bloc_bold, gen_rnd_ai_s_batch, gen_cohort,
+                         add_gaussian_noise)
 from pybold.hrf_model import spm_hrf
 
 
@@ -92,5 +95,76 @@ class TestDataGeneration(unittest.TestCase):
                             for res, snr, nb_events in self._yield_data())
 
 
+class TestBatchGeneration(unittest.TestCase):
+
+    def test_gen_rnd_ai_s_batch(self):
+        """ Test the batch activity inducing signals generation:
+            - test the blocks are unitary and not overlapping
+            - test if nb_events is respected
+            - test the reproductibility
+        """
+        n_voxels, nb_events = 50, 3
+        for tr in [0.5, 2.0]:
+            params = {'dur': 3, 'tr': tr, 'nb_events': nb_events,
+                      'avg_dur': 1, 'std_dur': 2, 'random_state': 0}
+            ai_s, i_s, t = gen_rnd_ai_s_batch(n_voxels, **params)
+            assert(ai_s.shape == i_s.shape == (n_voxels, len(t)))
+            assert(np.all((ai_s == 0.0) | (ai_s == 1.0)))
+            assert(np.all(np.sum(i_s > 0.5, axis=1) == nb_events))
+            np.testing.assert_array_equal(
+                                    np.cumsum(i_s, axis=1) + ai_s[:, :1], ai_s)
+            ai_s_, _, _ = gen_rnd_ai_s_batch(n_voxels, **params)
+            np.testing.assert_array_equal(ai_s, ai_s_)
+
+    def test_gen_cohort(self):
+        """ Test the cohort generation:
+            - test the cohort does not depend on the chunking
+            - test the BOLD signals are the convolved blocks
+            - test the SNR of each voxel
+        """
+        n_voxels, snr = 600, 5.0
+        params = {'dur': 3, 'tr': 1.0, 'nb_events': 3, 'snr': snr,
+                  'random_state': 0}
+        with tempfile.TemporaryDirectory() as dirname:
+            filenames, _ = gen_cohort(os.path.join(dirname, 'a'), n_voxels,
+                                      chunk_size=1, **params)
+            filenames_, _ = gen_cohort(os.path.join(dirname, 'b'), n_voxels,
+                                       chunk_size=n_voxels, n_jobs=2,
+                                       **params)
+            for name, filename in filenames.items():
+                np.testing.assert_array_equal(np.load(filename),
+                                              np.load(filenames_[name]))
+
+            noisy_ar_s = np.load(filenames['noisy_ar_s'])
+            ar_s = np.load(filenames['ar_s'])
+            ai_s = np.load(filenames['ai_s'])
+            hrfs = np.load(filenames['hrfs'])
+
+        for idx in [0, 299, 599]:
+            ar_s_test = simple_convolve(hrfs[idx], ai_s[idx])
+            np.testing.assert_almost_equal(ar_s_test, ar_s[idx])
+        true_snr = 20.0 * np.log10(norm_2(ar_s, axis=1) /
+                                   norm_2(noisy_ar_s - ar_s, axis=1))
+        np.testing.assert_almost_equal(true_snr, snr)
+
+    def test_add_gaussian_noise_batch(self):
+        """ Test the per-row SNR of add_gaussian_noise on a 2d signal.
+        """
+        ai_s, _, _ = gen_rnd_ai_s_batch(20, dur=3, random_state=0)
+        snr = np.linspace(1.0, 20.0, 20)
+        for dtype, decimal in [(np.float64, 7), (np.float32, 4)]:
+            signal = ai_s.astype(dtype)
+            for snr_ in [5.0, snr]:
+                noisy_signal, noise = add_gaussian_noise(signal, snr_,
+                                                         random_state=0)
+                assert(noise.dtype == dtype)
+                true_snr = 20.0 * np.log10(norm_2(signal, axis=1) /
+                                           norm_2(noise, axis=1))
+                np.testing.assert_almost_equal(true_snr,
+                                               np.broadcast_to(snr_, 20),
+                                               decimal=decimal)
+                np.testing.assert_array_equal(noisy_signal, signal + noise)
+
+
 if __name__ == '__main__':
     unittest.main()
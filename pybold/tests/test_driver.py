@@ -0,0 +1,80 @@
+""" Test the driver module.
+"""
+import os
+import json
+import tempfile
+import unittest
+import numpy as np
+from pybold.driver import run, MANIFEST
+from pybold.bold_signal import bd, deconv
+from pybold.hrf_model import spm_hrf
+from pybold.tests.utils import gen_voxels
+
+
+class TestDriver(unittest.TestCase):
+    def test_run_deconv_resume(self):
+        """ Test the chunked deconvolution against deconv and its resume
+        from the manifest.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(80, 7, hrf)
+        params = dict(lbda=1.0, nb_iter=50)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            output_dir = os.path.join(dirname, 'out')
+            np.save(input_file, y)
+            filenames = run(input_file, output_dir, 1.0, solver='deconv',
+                            hrf=hrf, chunk_size=3, n_jobs=2, **params)
+            _, z_ref, _, J_ref, _, _ = deconv(y, 1.0, hrf, **params)
+            z = np.load(filenames['z'])
+            assert(np.allclose(z, z_ref))
+            assert(np.allclose(np.load(filenames['cost']), J_ref[-1]))
+
+            # simulate an interruption before the end of the last two chunks
+            manifest_file = os.path.join(output_dir, MANIFEST)
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            assert(manifest['done'] == [0, 1, 2])
+            manifest['done'] = [1]
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f)
+            z_mmap = np.load(filenames['z'], mmap_mode='r+')
+            z_mmap[:, :3] = 0.0
+            z_mmap[:, 6:] = 0.0
+            z_mmap.flush()
+            del z_mmap
+
+            finished = []
+            run(input_file, output_dir, 1.0, solver='deconv', hrf=hrf,
+                chunk_size=3, callback=finished.append, **params)
+            assert(sorted(finished) == [0, 2])
+            assert(np.allclose(np.load(filenames['z']), z))
+            with open(manifest_file) as f:
+                assert(json.load(f)['done'] == [0, 1, 2])
+
+            self.assertRaises(ValueError, run, input_file, output_dir, 1.0,
+                              solver='deconv', hrf=hrf, lbda=2.0, nb_iter=50)
+
+    def test_run_bd(self):
+        """ Test the chunked blind deconvolution against bd.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0, dur=20.0, normalized_hrf=False)
+        y = gen_voxels(60, 3, hrf)
+        params = dict(lbda=1.0, nb_iter=2)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            np.save(input_file, y)
+            filenames = run(input_file, os.path.join(dirname, 'out'), 1.0,
+                            chunk_size=2, mem_budget=1e8, **params)
+            outputs = {name: np.load(filename)
+                       for name, filename in filenames.items()}
+        for v in range(y.shape[1]):
+            _, z_v, _, hrf_v, d = bd(y[:, v], 1.0, **params)
+            assert(np.allclose(outputs['z'][:, v], z_v, atol=1.0e-6))
+            assert(np.allclose(outputs['hrf'][:, v], hrf_v, atol=1.0e-6))
+            assert(np.isclose(outputs['theta'][v], d['theta']))
+            assert(np.isclose(outputs['cost'][v], d['J'][-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+""" Test the jit module and the import time of pybold.
+"""
+import sys
+import subprocess
+import unittest
+import numpy as np
+from pybold.jit import _KERNELS
+from pybold.convolution import simple_convolve
+
+
+# import time budget of pybold.bold_signal, numpy and numba included
+IMPORT_TIME_BUDGET = 2.0  # seconds
+HEAVY_MODULES = ['scipy.optimize', 'scipy.stats', 'scipy.sparse.linalg',
+                 'pywt']
+
+
+def _run(code):
+    """ Private helper to run code in a fresh interpreter and return its
+    stdout.
+    """
+    return subprocess.check_output([sys.executable, '-c', code]).decode()
+
+
+class TestImport(unittest.TestCase):
+    def test_import_bold_signal(self):
+        """ Test that importing pybold.bold_signal compiles nothing, does not
+        import the heavy optional dependencies and stays under the budget.
+        """
+        code = ("import sys, time\n"
+                "t0 = time.time()\n"
+                "import pybold.bold_signal\n"
+                "print(time.time() - t0)\n"
+                "from pybold.jit import _KERNELS\n"
+                "print(sum(len(k.jit.signatures) for k in "
+                "_KERNELS.values()))\n"
+                "print(','.join(m for m in {0} if m in sys.modules))\n"
+                "".format(HEAVY_MODULES))
+        import_time, nb_compiled, heavy_modules = _run(code).splitlines()
+        assert(float(import_time) < IMPORT_TIME_BUDGET)
+        assert(int(nb_compiled) == 0)
+        assert(heavy_modules == '')
+
+
+class TestJit(unittest.TestCase):
+    def test_lazy_kernel(self):
+        """ Test that a kernel is compiled at first call, for the type it is
+        called with.
+        """
+        kernel = _KERNELS['convolution__direct_convolve']
+        for dtype in [np.float64, np.float32]:
+            k_conv_x = simple_convolve(np.ones(3), np.ones(10), dtype=dtype)
+            assert(k_conv_x.dtype == dtype)
+            assert(any(str(sig[1].dtype) == np.dtype(dtype).name
+                       for sig in kernel.jit.signatures))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@
 import unittest
 import numpy as np
 from joblib import Parallel, delayed
-from pybold.linear import DiscretInteg
+from pybold.linear import DiscretInteg, ConvAndLinear, lipschitz_est
 from pybold.tests.utils import YieldData
 from pybold.convolution import simple_convolve, simple_retro_convolve
 
@@ -27,6 +27,101 @@ class TestInteg(unittest.TestCase):
         test_integ_signal = integ_op.adj(signal)
         ref_integ_signal = np.flipud(np.cumsum(np.flipud(signal)))
 
+    def test_integ_out(self):
+        """ Test the integ op and adj operators with preallocated buffers.
+        """
+        integ_op = DiscretInteg()
+        signal = np.random.randn(500)
+        out = np.empty(500)
+        test_integ_signal = integ_op.op(signal, out=out)
+        assert(test_integ_signal is out)
+        assert(np.allclose(test_integ_signal, np.cumsum(signal)))
+        test_integ_signal = integ_op.adj(signal, out=out)
+        ref_integ_signal = np.flipud(np.cumsum(np.flipud(signal)))
+        assert(test_integ_signal is out)
+        assert(np.allclose(test_integ_signal, ref_integ_signal))
+
+
+class TestConvAndLinear(unittest.TestCase, YieldData):
+    def test_normal(self):
+        """ Test the fused normal operator against H.adj(H.op(.)) for the
+        Toeplitz and the Fourier implementation.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            N = len(ai_s)
+            H = ConvAndLinear(DiscretInteg(), hrf, dim_in=N, dim_out=N)
+            H_spectral = ConvAndLinear(DiscretInteg(), hrf, dim_in=N,
+                                       dim_out=N, spectral_conv=True)
+            signals = np.vstack([ai_s, np.random.randn(N)]).T
+            ref_normal = np.vstack([H.adj(H.op(s)) for s in signals.T]).T
+            scale = np.max(np.abs(ref_normal))
+            for H_ in [H, H_spectral]:
+                test_normal = H_.normal(signals)
+                assert(np.allclose(test_normal / scale, ref_normal / scale))
+                test_normal = H_.normal(signals[:, 0])
+                assert(np.allclose(test_normal / scale,
+                                   ref_normal[:, 0] / scale))
+            test_normal = H_spectral.normal_matrix().dot(signals)
+            assert(np.allclose(test_normal / scale, ref_normal / scale))
+
+    def test_op_adj_out(self):
+        """ Test the op, adj and normal operators with preallocated buffers.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            N = len(ai_s)
+            for spectral_conv in [False, True]:
+                H = ConvAndLinear(DiscretInteg(), hrf, dim_in=N, dim_out=N,
+                                  spectral_conv=spectral_conv)
+                for func in [H.op, H.adj, H.normal]:
+                    out = np.empty(N)
+                    test_res = func(ai_s, out=out)
+                    assert(test_res is out)
+                    assert(np.allclose(test_res, func(ai_s)))
+
+    def test_float32(self):
+        """ Test that the float32 operators are close to the float64 ones.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            N = len(ai_s)
+            signals = np.vstack([ai_s, np.random.randn(N)]).T
+            for spectral_conv in [False, True]:
+                H = ConvAndLinear(DiscretInteg(), hrf, dim_in=N, dim_out=N,
+                                  spectral_conv=spectral_conv)
+                H_32 = ConvAndLinear(DiscretInteg(), hrf, dim_in=N,
+                                     dim_out=N, spectral_conv=spectral_conv,
+                                     dtype=np.float32)
+                for name in ['op', 'adj', 'normal']:
+                    ref = getattr(H, name)(signals)
+                    test = getattr(H_32, name)(signals.astype(np.float32))
+                    assert(test.dtype == np.float32)
+                    scale = np.max(np.abs(ref))
+                    assert(np.allclose(test / scale, ref / scale,
+                                       atol=1.0e-5))
+                # the precomputations are done on the float64 kernel
+                assert(np.array_equal(H_32.normal_matrix(),
+                                      H.normal_matrix().astype(np.float32)))
+
+    def test_lipschitz_est(self):
+        """ Test the Lipschitz constant estimations against the largest
+        eigenvalue of the normal matrix.
+        """
+        for ai_s, hrf, _, _ in self.yield_blocks_signal():
+            N = len(ai_s)
+            if N > 2000:  # keep the dense reference affordable
+                continue
+            H = ConvAndLinear(DiscretInteg(), hrf, dim_in=N, dim_out=N)
+            ref_cst = np.linalg.eigvalsh(H.normal_matrix())[-1]
+            for spectral_conv in [False, True]:
+                H = ConvAndLinear(DiscretInteg(), hrf, dim_in=N, dim_out=N,
+                                  spectral_conv=spectral_conv)
+                for method in ['power', 'lanczos']:
+                    test_cst = lipschitz_est(H, method=method, cache=False)
+                    assert(np.isclose(test_cst, ref_cst, rtol=1.0e-5))
+                    # memoized
+                    test_cst = lipschitz_est(H, method=method)
+                    assert(lipschitz_est(H, method=method) == test_cst)
+                test_cst = lipschitz_est(H, method='bound')
+                assert(ref_cst <= test_cst < 2.0 * ref_cst)
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@
 """
 import unittest
 import numpy as np
-from pybold.padding import padd, custom_padd, unpadd
+from pybold.padding import padd, custom_padd, custom_padd_len, unpadd
 
 
 class TestPadding(unittest.TestCase):
@@ -47,6 +47,49 @@ class TestPadding(unittest.TestCase):
             test_signal = unpadd(padded_signal, p)
             assert(np.allclose(signal, test_signal))
 
+    def test_padd_out(self):
+        """ Test if padding in a preallocated buffer is equal to the allocating
+        padding and if the unpadded array is a view on the buffer.
+        """
+        for N in [100, 128, 200, 256, 250, 300, 500, 600, 900, 1000]:
+            signal = np.random.randn(N)
+            padded_signal, p = custom_padd(signal)
+            padded_len, p_out = custom_padd_len(N)
+            out = np.empty(padded_len)
+            test_padded_signal, test_p = custom_padd(signal, out=out)
+            assert(p == p_out == test_p)
+            assert(test_padded_signal is out)
+            assert(np.array_equal(padded_signal, test_padded_signal))
+            test_signal = unpadd(out, p)
+            assert(np.shares_memory(test_signal, out))
+            assert(np.array_equal(signal, test_signal))
+
+            out = np.empty(N + 30)
+            test_padded_signal = padd(signal, p=(10, 20), c=1.0, out=out)
+            assert(test_padded_signal is out)
+            assert(np.array_equal(test_padded_signal[:10], np.ones(10)))
+            assert(np.array_equal(unpadd(out, p=(10, 20)), signal))
+
+    def test_nd_padd_unpadd(self):
+        """ Test if the padding of a 2d array along an axis is equal to the
+        padding of each of its rows/columns.
+        """
+        for N in [100, 128, 200, 256, 250, 300, 500, 600, 900, 1000]:
+            signals = np.random.randn(5, N)
+            padded_signals, p = custom_padd(signals)
+            ref_padded_signals = np.vstack([custom_padd(s)[0]
+                                            for s in signals])
+            assert(np.array_equal(padded_signals, ref_padded_signals))
+            assert(np.array_equal(unpadd(padded_signals, p), signals))
+            padded_signals, p = custom_padd(signals.T, axis=0)
+            assert(np.array_equal(padded_signals, ref_padded_signals.T))
+            assert(np.array_equal(unpadd(padded_signals, p, axis=0),
+                                  signals.T))
+            padded_signals = padd(signals.T, p=(10, 20), axis=0)
+            assert(padded_signals.shape == (N + 30, 5))
+            assert(np.array_equal(unpadd(padded_signals, p=(10, 20), axis=0),
+                                  signals.T))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+""" Test the sharding module.
+"""
+import os
+import json
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+from pybold.sharding import (make_shards, claim_shard, shard_status,
+                             run_worker, reduce_shards, load_shards, DONE)
+from pybold.bold_signal import deconv
+from pybold.hrf_model import spm_hrf
+from pybold.tests.utils import gen_voxels
+
+
+class TestSharding(unittest.TestCase):
+    def test_claim_shard(self):
+        """ Test that a shard is claimed once, and the breaking of the stale
+        locks.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            np.save(input_file, gen_voxels(40, 5, hrf))
+            make_shards(input_file, dirname, 1.0, solver='deconv', hrf=hrf,
+                        shard_size=2)
+            assert(len(load_shards(dirname)['shards']) == 3)
+            assert(claim_shard(dirname, 1))
+            assert(not claim_shard(dirname, 1))
+            assert(not claim_shard(dirname, 1, stale_timeout=60.0))
+            assert(shard_status(dirname) == {'done': [], 'running': [1],
+                                             'todo': [0, 2]})
+            assert(claim_shard(dirname, 1, stale_timeout=-1.0))
+            assert(not [name for name in os.listdir(os.path.join(dirname,
+                                                                 'locks'))
+                        if name.endswith('.broken')])
+
+            # the lock is refreshed after each chunk
+            assert(run_worker(dirname, chunk_size=1, max_shards=1) == [0])
+            lock_file = os.path.join(dirname, 'locks', 'shard_00000.lock')
+            manifest_file = os.path.join(dirname, 'shard_00000',
+                                         'manifest.json')
+            assert(os.stat(lock_file).st_mtime_ns >=
+                   os.stat(manifest_file).st_mtime_ns)
+
+    def test_workers(self):
+        """ Test several worker processes against deconv, and the reduce
+        step.
+        """
+        hrf, _ = spm_hrf(t_r=1.0, delta=1.0)
+        y = gen_voxels(60, 23, hrf)
+        params = dict(lbda=1.0, nb_iter=50)
+        with tempfile.TemporaryDirectory() as dirname:
+            input_file = os.path.join(dirname, 'y.npy')
+            shard_dir = os.path.join(dirname, 'shards')
+            np.save(input_file, y)
+            make_shards(input_file, shard_dir, 1.0, solver='deconv', hrf=hrf,
+                        shard_size=4, **params)
+            with self.assertRaises(RuntimeError):
+                reduce_shards(shard_dir)
+
+            ctx = multiprocessing.get_context('spawn')
+            workers = [ctx.Process(target=run_worker, args=(shard_dir,),
+                                   kwargs=dict(chunk_size=3))
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                assert(worker.exitcode == 0)
+
+            # each shard was processed by exactly one worker
+            status = shard_status(shard_dir)
+            assert(status['done'] == list(range(6)))
+            for idx in range(6):
+                with open(os.path.join(shard_dir,
+                                       "shard_{0:05d}".format(idx),
+                                       DONE)) as f:
+                    assert('worker' in json.load(f))
+            assert(run_worker(shard_dir) == [])
+
+            filenames = reduce_shards(shard_dir,
+                                      os.path.join(dirname, 'out'))
+            _, z_ref, diff_z_ref, J_ref, _, _ = deconv(y, 1.0, hrf, **params)
+            assert(np.allclose(np.load(filenames['z']), z_ref))
+            assert(np.allclose(np.load(filenames['diff_z']), diff_z_ref))
+            assert(np.load(filenames['cost']).shape == (23,))
+
+
+if __name__ == '__main__':
+    unittest.main()
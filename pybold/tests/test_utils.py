@@ -2,7 +2,9 @@
 """
 import unittest
 import numpy as np
-from pybold.utils import inf_norm
+from pybold.utils import (inf_norm, mad_daub_noise_est, fwhm, tp,
+                          batch_fwhm, batch_tp)
+from pybold.hrf_model import spm_hrf, spm_hrf_fwhm, spm_hrf_tp
 
 
 class TestMinMaxNorm(unittest.TestCase):
@@ -15,5 +17,57 @@ class TestMinMaxNorm(unittest.TestCase):
             np.testing.assert_almost_equal(np.max(np.abs(signal)), 1.0)
 
 
+class TestNoiseEst(unittest.TestCase):
+    def test_mad_daub_noise_est_batch(self):
+        """ Test that the noise levels of stacked signals are the noise
+        levels of each signal, along both axis.
+        """
+        for N in [7, 100, 301]:
+            signals = np.random.randn(N, 20)
+            ref_sigma = np.array([mad_daub_noise_est(s) for s in signals.T])
+            test_sigma = mad_daub_noise_est(signals, axis=0)
+            np.testing.assert_allclose(test_sigma, ref_sigma)
+            test_sigma = mad_daub_noise_est(signals.T)
+            np.testing.assert_allclose(test_sigma, ref_sigma)
+
+
+class TestHRFMetrics(unittest.TestCase):
+    def test_batch_fwhm_tp(self):
+        """ Test the batch FWHM and time to peak against the spline FWHM and
+        the time to peak of each HRF.
+        """
+        for t_r, tol in [(0.1, 1.0e-4), (1.0, 5.0e-2)]:
+            hrfs = []
+            for delta in np.linspace(0.5, 2.0, 10):
+                hrf, t_hrf = spm_hrf(delta=delta, t_r=t_r)
+                hrfs.append(hrf)
+            hrfs = np.vstack(hrfs)
+            ref_fwhm = np.array([fwhm(t_hrf, hrf) for hrf in hrfs])
+            np.testing.assert_allclose(batch_fwhm(t_hrf, hrfs), ref_fwhm,
+                                       atol=tol)
+            ref_tp = np.array([tp(t_hrf, hrf) for hrf in hrfs])
+            np.testing.assert_array_equal(batch_tp(t_hrf, hrfs), ref_tp)
+        hrfs = np.ones((2, len(t_hrf)))  # no half maximum crossing
+        np.testing.assert_array_equal(batch_fwhm(t_hrf, hrfs), [-1.0, -1.0])
+
+    def test_spm_hrf_fwhm_tp(self):
+        """ Test the closed-form FWHM and time to peak of the SPM HRF against
+        the ones of the finely sampled HRF.
+        """
+        for delta in [0.5, 1.0, 1.7]:
+            hrf, t_hrf = spm_hrf(delta=delta, t_r=0.001)
+            np.testing.assert_allclose(spm_hrf_fwhm(delta),
+                                       fwhm(t_hrf, hrf), atol=1.0e-4)
+            np.testing.assert_allclose(spm_hrf_tp(delta), tp(t_hrf, hrf),
+                                       atol=1.0e-3)
+            # the onset shifts the time grid along with the HRF
+            hrf, t_hrf = spm_hrf(delta=delta, t_r=0.001, onset=0.001)
+            np.testing.assert_allclose(spm_hrf_tp(delta), tp(t_hrf, hrf),
+                                       atol=1.0e-3)
+        deltas = np.array([0.5, 1.0, 2.0])
+        np.testing.assert_allclose(spm_hrf_fwhm(deltas) * deltas,
+                                   spm_hrf_fwhm(1.0))
+
+
 if __name__ == '__main__':
     unittest.main()
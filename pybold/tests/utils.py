@@ -5,6 +5,20 @@ import itertools
 import numpy as np
 from ..data import gen_rnd_ai_s
 from ..hrf_model import spm_hrf
+from ..convolution import spectral_convolve
+
+
+def gen_voxels(n_scans, n_voxels, hrf, random_state=0, return_ai_s=False):
+    """ Generate noisy BOLD signals (of shape (n_scans, n_voxels)), from
+    random bloc signals convolved with hrf, and their bloc signals if
+    return_ai_s is True.
+    """
+    rng = np.random.RandomState(random_state)
+    ai_s = np.cumsum(rng.randn(n_scans, n_voxels) *
+                     (rng.rand(n_scans, n_voxels) > 0.9), axis=0)
+    y = spectral_convolve(hrf, ai_s, axis=0)
+    y += 0.1 * rng.randn(n_scans, n_voxels)
+    return (y, ai_s) if return_ai_s else y
 
 
 class YieldData():
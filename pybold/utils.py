@@ -1,28 +1,56 @@
 # coding: utf-8
 """ This module gathers usefull usefull functions.
 """
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from numpy.linalg import norm as norm_2
-from scipy.interpolate import splrep, sproot
-import pywt
 
 
-def mad(x, c=0.6744):
-    """ Median absolute deviation.
+# global profiling hook, called with the profile of each bd / deconv call
+_PROFILE_HOOK = None
+
+
+def mad(x, c=0.6744, axis=None):
+    """ Median absolute deviation, of the flattened array if axis is None,
+    along axis otherwise.
     """
-    return np.median(np.abs(x - np.median(x))) / c
+    median = np.median(x, axis=axis, keepdims=True)
+    return np.median(np.abs(x - median), axis=axis) / c
 
 
-def mad_daub_noise_est(x, c=0.6744):
+def mad_daub_noise_est(x, c=0.6744, axis=-1):
     """ Estimate the statistical dispersion of the noise with Median Absolute
     Deviation on the first order detail coefficients of the 1d-Daubechies
     wavelets transform.
+
+    Parameters:
+    -----------
+    x : 1d or nd np.ndarray,
+        signal, or signals along axis.
+
+    c : float (default=0.6744),
+        the MAD normalization constant.
+
+    axis : int (default=-1),
+        the time axis of x, ignored if x is 1d.
+
+    Results:
+    --------
+    sigma : float or np.ndarray,
+        the noise level, or the noise levels of each signal (the shape of x
+        without axis).
     """
+    import pywt  # lazy: heavy import
+
+    x = np.asarray(x)
     try:
-        _, cD = pywt.wavedec(x, pywt.Wavelet('db3'), level=1)
-    except ValueError:
-        cD = pywt.wavedec(x, pywt.Wavelet('db3'), level=0)
-    return mad(cD, c=c)
+        _, cD = pywt.dwt(x, pywt.Wavelet('db3'), axis=axis)
+    except ValueError:  # signal too short for the transform
+        cD = x
+    return mad(cD, c=c, axis=(axis if x.ndim > 1 else None))
 
 
 class Tracker:
@@ -45,6 +73,131 @@ class Tracker:
         self.J.append(j)
 
 
+class _Stage:
+    """ Context manager accumulating the wall time of a stage.
+    """
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.t_0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        delta = time.perf_counter() - self.t_0
+        self.times[self.name] = self.times.get(self.name, 0.0) + delta
+
+
+class _NullStage:
+    """ No-op context manager of a disabled Profile.
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profile:
+    """ Wall time per stage, counters and per (outer) iteration records of
+    one bd / deconv call, all the methods being no-ops if not enabled.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.times = {}
+        self.counts = {}
+        self.records = {}
+        self.t_0 = time.perf_counter()
+
+    def stage(self, name):
+        """ Return a context manager timing the enclosed code as stage name.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self.times, name)
+
+    def count(self, name, n=1):
+        """ Increment the counter name by n.
+        """
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def record(self, name, value):
+        """ Append value to the records name.
+        """
+        if self.enabled:
+            self.records.setdefault(name, []).append(value)
+
+    def finish(self):
+        """ Set the total wall time, pass the profile to the global hook and
+        return it as a dict: 'time' (per stage, in second), 'count' and the
+        records.
+        """
+        if not self.enabled:
+            return None
+        self.times['total'] = time.perf_counter() - self.t_0
+        profile = {'time': dict(self.times), 'count': dict(self.counts)}
+        profile.update(self.records)
+        if _PROFILE_HOOK is not None:
+            _PROFILE_HOOK(profile)
+        return profile
+
+
+def get_profile(profile=False):
+    """ Return the Profile of a bd / deconv call, enabled if profile is True
+    or if a global profiling hook is set.
+    """
+    return Profile(enabled=(profile or _PROFILE_HOOK is not None))
+
+
+def set_profile_hook(hook):
+    """ Set the global profiling hook, called with the profile (dict) of each
+    bd / deconv call, e.g. a ProfileAggregator. None disables it.
+
+    Parameters:
+    -----------
+    hook : callable or None,
+        the new hook.
+
+    Results:
+    --------
+    old_hook : callable or None,
+        the previous hook.
+    """
+    global _PROFILE_HOOK
+    old_hook, _PROFILE_HOOK = _PROFILE_HOOK, hook
+    return old_hook
+
+
+class ProfileAggregator:
+    """ Profiling hook summing the times and the counters of the profiles
+    (e.g. across voxels), thread-safe.
+    """
+    def __init__(self):
+        self.n_calls = 0
+        self.times = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, profile):
+        with self._lock:
+            self.n_calls += 1
+            for name, t in profile['time'].items():
+                self.times[name] = self.times.get(name, 0.0) + t
+            for name, n in profile['count'].items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        """ Return the number of calls, the total times and counters.
+        """
+        with self._lock:
+            return {'n_calls': self.n_calls, 'time': dict(self.times),
+                    'count': dict(self.counts)}
+
+
 def fwhm(t_hrf, hrf, k=3):
     """Return the full width at half maximum.
 
@@ -64,6 +217,8 @@ def fwhm(t_hrf, hrf, k=3):
     fwhm : float,
         the FWHM
     """
+    from scipy.interpolate import splrep, sproot  # lazy: heavy import
+
     half_max = np.amax(hrf) / 2.0
     s = splrep(t_hrf, hrf - half_max, k=k)
     roots = sproot(s)
@@ -79,6 +234,112 @@ def tp(t_hrf, hrf):
     return t_hrf[np.argmax(hrf)]
 
 
+def _local_poly_root(t_hrf, hrfs, level, idx, k):
+    """ Private helper to return, for each row of hrfs, the time in
+    [t_hrf[idx], t_hrf[idx + 1]] where the local interpolation of degree k
+    (1 or 3) of the row crosses level, hrfs[:, idx] and hrfs[:, idx + 1]
+    being on each side of level.
+    """
+    n_hrfs, n_taps = hrfs.shape
+    rows = np.arange(n_hrfs)[:, None]
+    if k == 1 or n_taps < 4:
+        nodes = idx[:, None] + np.arange(2)[None, :]
+    else:  # the 4 nodes around the interval
+        start = np.clip(idx - 1, 0, n_taps - 4)
+        nodes = start[:, None] + np.arange(4)[None, :]
+    t_nodes, h_nodes = t_hrf[nodes], hrfs[rows, nodes] - level[:, None]
+
+    def _poly(t):
+        """ Lagrange interpolation of the nodes, evaluated at t.
+        """
+        res = np.zeros_like(t)
+        for i in range(nodes.shape[1]):
+            w = h_nodes[:, i].copy()
+            for j in range(nodes.shape[1]):
+                if j != i:
+                    w *= ((t - t_nodes[:, j]) /
+                          (t_nodes[:, i] - t_nodes[:, j]))
+            res += w
+        return res
+
+    lower, upper = t_hrf[idx], t_hrf[idx + 1]
+    sign_lower = np.sign(hrfs[np.arange(n_hrfs), idx] - level)
+    for _ in range(50):  # bisection
+        middle = 0.5 * (lower + upper)
+        same_side = (np.sign(_poly(middle)) == sign_lower)
+        lower = np.where(same_side, middle, lower)
+        upper = np.where(same_side, upper, middle)
+
+    return 0.5 * (lower + upper)
+
+
+def batch_fwhm(t_hrf, hrfs, k=3):
+    """ Return the full width at half maximum of each HRF, the crossings of
+    the half maximum being found on a local interpolation (of degree k) of
+    the HRF around its peak, for all the HRFs at once.
+
+    Parameters:
+    -----------
+    t_hrf : 1d np.ndarray,
+        the sampling od time.
+
+    hrfs : 2d np.ndarray,
+        the HRFs, of shape (n_hrfs, n_taps).
+
+    k : int (default=3),
+        the degree of the local interpolation, 1 or 3.
+
+    Return:
+    -------
+    fwhm : 1d np.ndarray,
+        the FWHM of each HRF, -1 if the HRF does not cross its half maximum
+        on both sides of its peak.
+    """
+    if k not in [1, 3]:
+        raise ValueError("k should be 1 or 3, got {0}".format(k))
+    t_hrf = np.asarray(t_hrf, dtype=np.float64)
+    hrfs = np.atleast_2d(np.asarray(hrfs, dtype=np.float64))
+    n_hrfs, n_taps = hrfs.shape
+
+    idx_peak = np.argmax(hrfs, axis=1)
+    half_max = hrfs[np.arange(n_hrfs), idx_peak] / 2.0
+    below = hrfs < half_max[:, None]
+    taps = np.arange(n_taps)[None, :]
+    # last sample below before the peak, first sample below after the peak
+    idx_rise = np.max(np.where(below & (taps < idx_peak[:, None]), taps, -1),
+                      axis=1)
+    idx_fall = np.min(np.where(below & (taps > idx_peak[:, None]), taps,
+                               n_taps), axis=1)
+    valid = (idx_rise >= 0) & (idx_fall < n_taps)
+
+    fwhm = np.full(n_hrfs, -1.0)
+    if np.any(valid):
+        hrfs, half_max = hrfs[valid], half_max[valid]
+        t_rise = _local_poly_root(t_hrf, hrfs, half_max, idx_rise[valid], k)
+        t_fall = _local_poly_root(t_hrf, hrfs, half_max,
+                                  idx_fall[valid] - 1, k)
+        fwhm[valid] = t_fall - t_rise
+
+    return fwhm
+
+
+def batch_tp(t_hrf, hrfs):
+    """ Return time to peak of each HRF (row) of hrfs.
+    """
+    return np.asarray(t_hrf)[np.argmax(np.atleast_2d(hrfs), axis=1)]
+
+
+def check_dtype(dtype):
+    """ Return the np.dtype corresponding to dtype, the compute precision,
+    only float32 and float64 being supported.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in [np.float32, np.float64]:
+        raise ValueError("dtype could only be float32 or float64, "
+                         "got {0}".format(dtype))
+    return dtype
+
+
 def random_generator(random_state):
     """ Return a random instance with a fix seed if random_state is a int.
     """
@@ -91,22 +352,64 @@ def random_generator(random_state):
                          "got {0}".format(type(random_state)))
 
 
-def spectral_radius_est(L, x_shape, nb_iter=30, tol=1.0e-6, verbose=False):
+def spectral_radius_est(L, x_shape, nb_iter=30, tol=1.0e-6, verbose=False,
+                        x_0=None, return_vec=False):
     """ EStimation of the spectral radius of the operator L.
+
+    Parameters:
+    -----------
+    L : operator,
+        with op and adj methods, or a normal method.
+
+    x_shape : tuple,
+        the shape of the input of L.
+
+    nb_iter : int (default=30),
+        the maximum number of power iterations.
+
+    tol : float (default=1.0e-6),
+        the tolerance on the relative variation of the estimation.
+
+    verbose : bool (default=False),
+        the verbosity.
+
+    x_0 : np.ndarray or None (default=None),
+        the initial vector, a random one if None (a previous leading
+        eigenvector makes the iterations converge almost immediately).
+
+    return_vec : bool (default=False),
+        whether to return the leading eigenvector estimation too.
+
+    Results:
+    --------
+    rho : float,
+        the spectral radius estimation.
+
+    x : np.ndarray,
+        the (normalized) leading eigenvector estimation, only returned if
+        return_vec is True.
     """
-    x_old = np.random.randn(*x_shape)
+    normal = getattr(L, 'normal', lambda x: L.adj(L.op(x)))
+    if x_0 is None or np.shape(x_0) != tuple(x_shape):
+        x_0 = np.random.randn(*x_shape)
+    x_old = x_0 / norm_2(x_0)
 
     stopped = False
+    rho_old = 0.0
     for i in range(nb_iter):
-        x_new = L.adj(L.op(x_old)) / norm_2(x_old)
-        if(np.abs(norm_2(x_new) - norm_2(x_old)) < tol):
+        x_new = normal(x_old)
+        rho = norm_2(x_new)
+        x_new /= rho
+        if np.abs(rho - rho_old) < tol * rho:
             stopped = True
             break
-        x_old = x_new
+        x_old, rho_old = x_new, rho
     if not stopped and verbose:
         print("Spectral radius estimation did not converge")
 
-    return norm_2(x_new)
+    if return_vec:
+        return rho, x_new
+    return rho
 
 
 def __inf_norm(x):
@@ -136,3 +439,31 @@ def inf_norm(arrays, axis=1):
         return [_inf_norm(a, axis=axis) for a in arrays]
     else:
         return _inf_norm(arrays, axis=axis)
+
+
+def get_n_jobs(n_jobs):
+    """ Return the effective number of workers, with the joblib convention
+    for negative values (-1 for all the CPUs, -2 for all but one...).
+    """
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(1, n_jobs)
+
+
+def chunk_slices(n_voxels, chunk_size):
+    """ Return the slices of the consecutive chunks of chunk_size voxels
+    (the last one being possibly shorter).
+    """
+    return [slice(start, min(start + chunk_size, n_voxels))
+            for start in range(0, n_voxels, chunk_size)]
+
+
+def thread_map(func, iterable, n_jobs=1):
+    """ Return the list of func applied on each element of iterable, in a
+    pool of n_jobs threads if n_jobs > 1.
+    """
+    n_jobs = get_n_jobs(n_jobs)
+    if n_jobs == 1:
+        return [func(elt) for elt in iterable]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(func, iterable))
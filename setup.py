@@ -71,8 +71,14 @@ if __name__ == "__main__":
               'Topic :: Scientific/Engineering',
               'Operating System :: POSIX',
               'Operating System :: Unix',
-              'Programming Language :: Python :: 2.7',
+              'Programming Language :: Python :: 3.6',
+              'Programming Language :: Python :: 3.7',
+              'Programming Language :: Python :: 3.8',
           ],
           packages=find_packages(),
           install_requires=install_requires,
+          entry_points={
+              'console_scripts': ['pybold-run = pybold.cli:main',
+                                  'pybold-shard = pybold.cli:shard_main'],
+          },
           )